@@ -2,10 +2,13 @@
 Description: 
 Author: Damocles_lin
 Date: 2025-07-06 16:53:45
-LastEditTime: 2025-07-13 17:31:33
+LastEditTime: 2026-10-19 20:34:12
 LastEditors: Damocles_lin
 '''
-from reconstruction.pipeline import run_colmap_pipeline
+from reconstruction.pipeline import run_colmap_pipeline, PIPELINE_STAGES
+from reconstruction.ingest import watch_image_dir
+from reconstruction.mvs import DENSE_QUALITY_PROFILES
+from reconstruction.spatial_query import run_query_benchmark
 import argparse
 import os
 import time
@@ -24,6 +27,40 @@ def main():
                         help=f"输入图像目录路径 (默认: {DEFAULT_IMAGE_DIR})")
     parser.add_argument("--output_dir", type=str, default=DEFAULT_OUTPUT_DIR, 
                         help=f"输出结果目录路径 (默认: {DEFAULT_OUTPUT_DIR})")
+    parser.add_argument("--quality", type=str, default="high", choices=list(DENSE_QUALITY_PROFILES),
+                        help="稠密重建质量档位，决定去畸变图像的最大尺寸 (默认: high)")
+    parser.add_argument("--num_workers", type=int, default=None,
+                        help="并行工作进程数量 (默认: CPU核数)")
+    parser.add_argument("--memory_budget", type=float, default=None,
+                        help="内存预算(GB)，设置后在运行前规划各阶段选项以满足预算")
+    parser.add_argument("--triage", action="store_true",
+                        help="特征提取前剔除近重复帧与模糊图像，剔除报告见stats/triage_report.txt")
+    parser.add_argument("--duplicate_threshold", type=int, default=6,
+                        help="近重复判定的感知哈希汉明距离上限（64位） (默认: 6)")
+    parser.add_argument("--blur_ratio", type=float, default=0.3,
+                        help="清晰度低于中位数的该比例时视为模糊图像 (默认: 0.3)")
+    parser.add_argument("--extraction_shards", type=int, default=1,
+                        help="特征提取分片数量，大于1时各分片由独立进程写入分片数据库后合并 (默认: 1)")
+    parser.add_argument("--matching_workers", type=int, default=0,
+                        help="分块可恢复匹配的工作进程数量，0表示使用单次穷举匹配 (默认: 0)")
+    parser.add_argument("--from", dest="from_stage", type=str, default=None, choices=PIPELINE_STAGES,
+                        help="从指定阶段开始运行，之前阶段的输出从磁盘恢复")
+    parser.add_argument("--to", dest="to_stage", type=str, default=None, choices=PIPELINE_STAGES,
+                        help="运行到指定阶段为止（仅运行其依赖的阶段）")
+    parser.add_argument("--max_parallel_stages", type=int, default=4,
+                        help="可同时运行的相互独立阶段数量 (默认: 4)")
+    parser.add_argument("--streaming_dense", action="store_true",
+                        help="流式稠密重建：按参考图像流水线执行去畸变、立体匹配与增量融合")
+    parser.add_argument("--max_source_images", type=int, default=10,
+                        help="立体匹配中每个参考图像的源图像数量上限，按共视图权重选取 (默认: 10)")
+    parser.add_argument("--benchmark_spatial_query", type=int, default=None, metavar="NUM_POINTS",
+                        help="在指定点数的合成点云上测试空间查询延迟（如100000000），不运行重建流程")
+    parser.add_argument("--watch", action="store_true",
+                        help="监控模式：持续将图像目录中的新图像注册到已有重建中")
+    parser.add_argument("--poll_interval", type=float, default=5.0,
+                        help="监控模式下的轮询间隔秒数 (默认: 5.0)")
+    parser.add_argument("--max_neighbors", type=int, default=10,
+                        help="监控模式下每张新图像匹配的近邻图像数量上限 (默认: 10)")
     # 解析参数
     args = parser.parse_args()
     
@@ -37,8 +74,38 @@ def main():
     
     print(f"开始处理: 图像目录={args.image_dir}, 输出目录={args.output_dir}")
     
-    # 运行COLMAP流程
-    run_colmap_pipeline(args.image_dir, args.output_dir)
+    if args.benchmark_spatial_query:
+        # 空间查询基准测试：合成点云与索引位于 output_dir/benchmark
+        from utils import logging_utils
+        logging_utils.configure_logging(args.output_dir)
+        run_query_benchmark(args.output_dir, num_points=args.benchmark_spatial_query)
+    elif args.watch:
+        # 监控模式：增量注册新图像（Ctrl+C退出）
+        from utils import logging_utils
+        logging_utils.configure_logging(args.output_dir)
+        try:
+            watch_image_dir(args.image_dir, args.output_dir,
+                            poll_interval=args.poll_interval,
+                            max_neighbors=args.max_neighbors,
+                            quality=args.quality,
+                            triage=args.triage,
+                            duplicate_threshold=args.duplicate_threshold,
+                            blur_ratio=args.blur_ratio)
+        except KeyboardInterrupt:
+            print("监控已停止")
+    else:
+        # 运行COLMAP流程
+        run_colmap_pipeline(args.image_dir, args.output_dir,
+                            quality=args.quality, num_workers=args.num_workers,
+                            memory_budget_gb=args.memory_budget,
+                            extraction_shards=args.extraction_shards,
+                            matching_workers=args.matching_workers,
+                            from_stage=args.from_stage, to_stage=args.to_stage,
+                            max_parallel_stages=args.max_parallel_stages,
+                            streaming_dense=args.streaming_dense,
+                            max_source_images=args.max_source_images,
+                            triage=args.triage, duplicate_threshold=args.duplicate_threshold,
+                            blur_ratio=args.blur_ratio)
     
     # 计算总耗时
     total_elapsed = time.time() - total_start
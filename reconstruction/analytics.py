@@ -0,0 +1,226 @@
+'''
+Description: 稀疏模型的批量重投影误差与轨迹分析
+Author: Damocles_lin
+Date: 2026-10-19 11:05:43
+LastEditTime: 2026-10-19 22:27:16
+LastEditors: Damocles_lin
+'''
+import logging
+import numpy as np
+from utils.camera_utils import stack_intrinsics, FISHEYE_MODEL_IDS, PROJECTION_MODEL_IDS
+
+def collect_observations(reconstruction):
+    """
+    将重建模型中的相机、位姿、三维点和二维观测一次性堆叠为数组
+    所有观测以 (图像行号, 三维点行号, 像素坐标) 的形式平铺存储
+    """
+    cameras = {camera_id: {"model": int(camera.model), "params": camera.params}
+               for camera_id, camera in reconstruction.cameras.items()}
+    camera_ids, model_ids, K, distortion = stack_intrinsics(cameras)
+
+    image_ids = np.array(sorted(reconstruction.images), dtype=np.int64)
+    point_ids = np.array(sorted(reconstruction.points3D), dtype=np.int64)
+    point_xyz = np.zeros((len(point_ids), 3))
+
+    # 只遍历三维点轨迹中的观测（已三角化），不逐个检查图像的全部关键点
+    obs_image_ids, obs_point2D_idxs, obs_point_rows = [], [], []
+    for point_row, point_id in enumerate(point_ids):
+        point3D = reconstruction.points3D[point_id]
+        point_xyz[point_row] = point3D.xyz
+        elements = point3D.track.elements
+        for element in elements:
+            obs_image_ids.append(element.image_id)
+            obs_point2D_idxs.append(element.point2D_idx)
+        obs_point_rows.extend([point_row] * len(elements))
+    obs_image_rows = np.searchsorted(image_ids, np.array(obs_image_ids, dtype=np.int64))
+    obs_point2D_idxs = np.array(obs_point2D_idxs, dtype=np.int64)
+    obs_xy = np.zeros((len(obs_image_rows), 2))
+
+    rotations = np.zeros((len(image_ids), 3, 3))
+    translations = np.zeros((len(image_ids), 3))
+    image_camera_rows = np.zeros(len(image_ids), dtype=np.int64)
+    image_names = []
+    order = np.argsort(obs_image_rows, kind="stable")
+    bounds = np.searchsorted(obs_image_rows[order], np.arange(len(image_ids) + 1))
+    for row, image_id in enumerate(image_ids):
+        image = reconstruction.images[image_id]
+        cam_from_world = image.cam_from_world()
+        rotations[row] = cam_from_world.rotation.matrix()
+        translations[row] = cam_from_world.translation
+        image_camera_rows[row] = np.searchsorted(camera_ids, image.camera_id)
+        image_names.append(image.name)
+        obs = order[bounds[row]:bounds[row + 1]]
+        if len(obs):
+            points2D = image.points2D
+            obs_xy[obs] = [points2D[idx].xy for idx in obs_point2D_idxs[obs].tolist()]
+
+    return {
+        "camera_ids": camera_ids,
+        "model_ids": model_ids,
+        "K": K,
+        "distortion": distortion,
+        "image_ids": image_ids,
+        "image_names": image_names,
+        "rotations": rotations,
+        "translations": translations,
+        "image_camera_rows": image_camera_rows,
+        "point_ids": point_ids,
+        "point_xyz": point_xyz,
+        "obs_image_rows": obs_image_rows,
+        "obs_point_rows": np.array(obs_point_rows, dtype=np.int64),
+        "obs_xy": obs_xy
+    }
+
+def project_observations(observations):
+    """
+    批量投影所有观测对应的三维点，返回 (像素坐标 (N,2), 相机坐标系深度 (N,))
+    仅PROJECTION_MODEL_IDS中的相机模型投影结果正确，其余模型的观测需由调用方排除
+    """
+    img = observations["obs_image_rows"]
+    cam = observations["image_camera_rows"][img]
+    X = observations["point_xyz"][observations["obs_point_rows"]]
+
+    X_cam = np.einsum("nij,nj->ni", observations["rotations"][img], X) + observations["translations"][img]
+    depth = X_cam[:, 2]
+    safe_depth = np.where(np.abs(depth) < 1e-12, 1e-12, depth)
+    u = X_cam[:, 0] / safe_depth
+    v = X_cam[:, 1] / safe_depth
+
+    # 径向/切向畸变（SIMPLE_RADIAL、RADIAL、OPENCV共用同一公式，缺省参数为0）
+    k1, k2, p1, p2 = observations["distortion"][cam].T
+    r2 = u * u + v * v
+    radial = k1 * r2 + k2 * r2 * r2
+    du = u * radial + 2 * p1 * u * v + p2 * (r2 + 2 * u * u)
+    dv = v * radial + 2 * p2 * u * v + p1 * (r2 + 2 * v * v)
+
+    # 鱼眼模型按入射角畸变
+    fisheye = np.isin(observations["model_ids"][cam], FISHEYE_MODEL_IDS)
+    if np.any(fisheye):
+        r = np.sqrt(r2[fisheye])
+        theta = np.arctan(r)
+        theta2 = theta * theta
+        f1, f2, f3, f4 = observations["distortion"][cam[fisheye]].T
+        theta_d = theta * (1 + theta2 * (f1 + theta2 * (f2 + theta2 * (f3 + theta2 * f4))))
+        scale = np.where(r > 1e-12, theta_d / np.maximum(r, 1e-12), 1.0) - 1.0
+        du[fisheye] = u[fisheye] * scale
+        dv[fisheye] = v[fisheye] * scale
+
+    K = observations["K"][cam]
+    x = K[:, 0, 0] * (u + du) + K[:, 0, 2]
+    y = K[:, 1, 1] * (v + dv) + K[:, 1, 2]
+    return np.stack([x, y], axis=1), depth
+
+def group_percentiles(groups, values, num_groups, quantiles):
+    """按分组计算分位数（排序一次，向量化取值），空分组为NaN"""
+    result = np.full((len(quantiles), num_groups), np.nan)
+    counts = np.bincount(groups, minlength=num_groups)
+    if len(values) == 0:
+        return result
+    sorted_values = values[np.lexsort((values, groups))]
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    valid = counts > 0
+    for row, q in enumerate(quantiles):
+        index = starts[valid] + np.floor(q * (counts[valid] - 1)).astype(np.int64)
+        result[row, valid] = sorted_values[index]
+    return result
+
+def compute_track_analytics(observations, error_bins=None):
+    """
+    单次遍历计算重投影误差分布、每图像/每轨迹统计、三角化角度和轨迹长度直方图
+    三角化角度取各观测射线与平均射线最大夹角的两倍（两视图轨迹时与精确值相同）
+    """
+    if error_bins is None:
+        error_bins = np.array([0, 0.5, 1, 2, 4, 8, np.inf])
+    num_images = len(observations["image_ids"])
+    num_points = len(observations["point_ids"])
+    img = observations["obs_image_rows"]
+    pts = observations["obs_point_rows"]
+
+    projected, depth = project_observations(observations)
+    errors = np.linalg.norm(projected - observations["obs_xy"], axis=1)
+
+    # 不支持的相机模型与位于相机后方的观测（误差无意义）不参与误差统计
+    supported = np.isin(observations["model_ids"], PROJECTION_MODEL_IDS)
+    for model_id in np.unique(observations["model_ids"][~supported]):
+        logging.warning(f"相机模型 {int(model_id)} 的畸变不受支持，其观测不计入重投影误差统计")
+    supported_obs = supported[observations["image_camera_rows"][img]]
+    behind = supported_obs & (depth <= 0)
+    valid = supported_obs & ~behind
+    if behind.any():
+        logging.warning(f"{int(behind.sum())} 个观测的三维点位于相机后方，不计入重投影误差统计")
+    valid_img, valid_pts, valid_errors = img[valid], pts[valid], errors[valid]
+
+    # 每图像误差分布
+    image_counts = np.bincount(img, minlength=num_images)
+    image_valid = np.bincount(valid_img, minlength=num_images)
+    image_mean = np.bincount(valid_img, weights=valid_errors, minlength=num_images) / np.maximum(image_valid, 1)
+    image_median, image_p90, image_max = group_percentiles(valid_img, valid_errors, num_images, [0.5, 0.9, 1.0])
+
+    # 每轨迹误差与长度
+    track_length = np.bincount(pts, minlength=num_points)
+    track_valid = np.bincount(valid_pts, minlength=num_points)
+    track_mean = np.bincount(valid_pts, weights=valid_errors, minlength=num_points) / np.maximum(track_valid, 1)
+    track_max = np.zeros(num_points)
+    np.maximum.at(track_max, valid_pts, valid_errors)
+    track_max[pts[behind]] = np.inf  # 位于相机后方的轨迹视为异常轨迹
+
+    # 三角化角度：观测射线（相机中心指向三维点）与轨迹平均射线的夹角
+    centers = -np.einsum("nji,nj->ni", observations["rotations"], observations["translations"])
+    rays = observations["point_xyz"][pts] - centers[img]
+    rays /= np.maximum(np.linalg.norm(rays, axis=1, keepdims=True), 1e-12)
+    mean_rays = np.zeros((num_points, 3))
+    np.add.at(mean_rays, pts, rays)
+    mean_rays /= np.maximum(np.linalg.norm(mean_rays, axis=1, keepdims=True), 1e-12)
+    cos_angle = np.clip(np.einsum("ni,ni->n", rays, mean_rays[pts]), -1.0, 1.0)
+    half_angle = np.zeros(num_points)
+    np.maximum.at(half_angle, pts, np.arccos(cos_angle))
+    tri_angle = np.degrees(2 * half_angle)
+
+    return {
+        "num_observations": len(errors),
+        "num_valid_observations": len(valid_errors),
+        "mean_error": float(valid_errors.mean()) if len(valid_errors) else 0.0,
+        "median_error": float(np.median(valid_errors)) if len(valid_errors) else 0.0,
+        "error_bins": error_bins,
+        "error_histogram": np.histogram(valid_errors, bins=error_bins)[0],
+        "image_ids": observations["image_ids"],
+        "image_names": observations["image_names"],
+        "image_num_observations": image_counts,
+        "image_mean_error": image_mean,
+        "image_median_error": image_median,
+        "image_p90_error": image_p90,
+        "image_max_error": image_max,
+        "point_ids": observations["point_ids"],
+        "track_length": track_length,
+        "track_length_histogram": np.bincount(track_length),
+        "track_mean_error": track_mean,
+        "track_max_error": track_max,
+        "track_tri_angle": tri_angle,
+        "tri_angle_histogram": np.histogram(tri_angle, bins=[0, 1, 2, 5, 10, 20, 45, 180])[0]
+    }
+
+def find_outlier_tracks(analytics, max_reprojection_error=4.0, min_tri_angle=1.5, min_track_length=2):
+    """返回异常轨迹掩码：最大重投影误差过大、三角化角度过小或轨迹过短"""
+    return ((analytics["track_max_error"] > max_reprojection_error)
+            | (analytics["track_tri_angle"] < min_tri_angle)
+            | (analytics["track_length"] < min_track_length))
+
+def export_outlier_tracks(export_path, analytics, outlier_mask):
+    """导出异常轨迹的ID、长度、误差和三角化角度"""
+    np.savez(
+        export_path,
+        point_ids=analytics["point_ids"][outlier_mask],
+        track_length=analytics["track_length"][outlier_mask],
+        mean_error=analytics["track_mean_error"][outlier_mask],
+        max_error=analytics["track_max_error"][outlier_mask],
+        tri_angle=analytics["track_tri_angle"][outlier_mask]
+    )
+    logging.info(f"导出 {int(outlier_mask.sum())} 条异常轨迹到: {export_path}")
+
+def filter_outlier_tracks(reconstruction, analytics, outlier_mask):
+    """从重建模型中删除异常轨迹对应的三维点，返回删除数量"""
+    outlier_ids = analytics["point_ids"][outlier_mask]
+    for point3D_id in outlier_ids:
+        reconstruction.delete_point3D(int(point3D_id))
+    logging.info(f"已删除 {len(outlier_ids)} 条异常轨迹")
+    return len(outlier_ids)
@@ -0,0 +1,117 @@
+'''
+Description: 共视图构建与MVS源图像选择
+Author: Damocles_lin
+Date: 2026-10-19 17:41:55
+LastEditTime: 2026-10-19 22:27:16
+LastEditors: Damocles_lin
+'''
+import logging
+import numpy as np
+from .analytics import collect_observations
+
+MIN_TRIANGULATION_ANGLE = 1.0     # 低于该交会角（度）的共享点不计入共视权重
+MAX_TRIANGULATION_ANGLE = 60.0    # 高于该交会角的视角差过大，光度一致性不可靠
+IDEAL_TRIANGULATION_ANGLE = 10.0  # 交会角权重在该角度处饱和
+MIN_BASELINE_RATIO = 0.05         # 基线与观测距离之比低于该值时按比例降低权重
+
+def _track_pairs(obs_image_rows, obs_point_rows, num_images):
+    """展开每条轨迹中的全部图像对，返回 (图像行号a, 图像行号b, 三维点行号)，保证 a < b"""
+    keys = np.unique(obs_point_rows * num_images + obs_image_rows)  # 去除同一图像对同一点的重复观测
+    point_rows = keys // num_images
+    image_rows = keys % num_images
+    _, starts, lengths = np.unique(point_rows, return_index=True, return_counts=True)
+
+    track = np.repeat(np.arange(len(starts)), lengths)
+    position = np.arange(len(keys)) - starts[track]
+    remaining = lengths[track] - position - 1
+    first = np.repeat(np.arange(len(keys)), remaining)
+    run_starts = np.cumsum(remaining) - remaining
+    second = first + 1 + np.arange(len(first)) - np.repeat(run_starts, remaining)
+    return image_rows[first], image_rows[second], point_rows[first]
+
+def build_covisibility_graph(reconstruction, min_angle=MIN_TRIANGULATION_ANGLE, max_angle=MAX_TRIANGULATION_ANGLE,
+                             ideal_angle=IDEAL_TRIANGULATION_ANGLE, min_baseline_ratio=MIN_BASELINE_RATIO,
+                             observations=None):
+    """
+    由稀疏模型的三维点轨迹构建共视图（向量化）
+    每条边的权重 = Σ 共享点的交会角权重 min(α/α_ideal, 1)² × 基线权重 min(基线/观测距离 / 比例下限, 1)
+    交会角不在 [min_angle, max_angle] 内的共享点不计入权重
+    返回 {"image_names", "image_a", "image_b", "shared_points", "valid_points",
+          "mean_angle", "baseline_ratio", "score"}，边以图像行号表示
+    """
+    if observations is None:
+        observations = collect_observations(reconstruction)
+    num_images = len(observations["image_ids"])
+    image_a, image_b, point_rows = _track_pairs(observations["obs_image_rows"], observations["obs_point_rows"],
+                                                num_images)
+
+    # 相机中心 C = -Rᵀt
+    centers = -np.einsum("nji,nj->ni", observations["rotations"], observations["translations"])
+    X = observations["point_xyz"][point_rows]
+    ray_a = centers[image_a] - X
+    ray_b = centers[image_b] - X
+    dist_a = np.linalg.norm(ray_a, axis=1)
+    dist_b = np.linalg.norm(ray_b, axis=1)
+    cos_angle = np.einsum("ni,ni->n", ray_a, ray_b) / np.maximum(dist_a * dist_b, 1e-12)
+    angle = np.degrees(np.arccos(np.clip(cos_angle, -1.0, 1.0)))
+    valid = (angle >= min_angle) & (angle <= max_angle)
+
+    # 按图像对聚合
+    pair_keys, inverse = np.unique(image_a * num_images + image_b, return_inverse=True)
+    num_pairs = len(pair_keys)
+    shared = np.bincount(inverse, minlength=num_pairs)
+    valid_count = np.bincount(inverse, weights=valid, minlength=num_pairs)
+    angle_weight = np.minimum(angle / ideal_angle, 1.0) ** 2 * valid
+    weight_sum = np.bincount(inverse, weights=angle_weight, minlength=num_pairs)
+    mean_angle = np.bincount(inverse, weights=angle * valid, minlength=num_pairs) / np.maximum(valid_count, 1)
+    mean_distance = np.bincount(inverse, weights=(dist_a + dist_b) / 2, minlength=num_pairs) / np.maximum(shared, 1)
+
+    pair_a, pair_b = pair_keys // num_images, pair_keys % num_images
+    baseline = np.linalg.norm(centers[pair_a] - centers[pair_b], axis=1)
+    baseline_ratio = baseline / np.maximum(mean_distance, 1e-12)
+    baseline_weight = np.minimum(baseline_ratio / min_baseline_ratio, 1.0)
+
+    return {
+        "image_names": list(observations["image_names"]),
+        "image_a": pair_a,
+        "image_b": pair_b,
+        "shared_points": shared,
+        "valid_points": valid_count.astype(np.int64),
+        "mean_angle": mean_angle,
+        "baseline_ratio": baseline_ratio,
+        "score": weight_sum * baseline_weight
+    }
+
+def select_source_views(graph, max_sources=10, min_valid_points=10, min_score=1.0):
+    """
+    为每个参考图像按共视权重选取不超过max_sources个源图像
+    返回 {参考图像名: [源图像名, ...]}，权重排序从高到低；没有任何合格邻居的图像不列出
+    """
+    keep = (graph["valid_points"] >= min_valid_points) & (graph["score"] >= min_score)
+    a, b, score = graph["image_a"][keep], graph["image_b"][keep], graph["score"][keep]
+    refs = np.concatenate([a, b])
+    srcs = np.concatenate([b, a])
+    scores = np.concatenate([score, score])
+
+    order = np.lexsort((-scores, refs))
+    refs, srcs = refs[order], srcs[order]
+    unique_refs, starts, counts = np.unique(refs, return_index=True, return_counts=True)
+    rank = np.arange(len(refs)) - np.repeat(starts, counts)
+    selected = rank < max_sources
+    refs, srcs = refs[selected], srcs[selected]
+
+    names = graph["image_names"]
+    sources = {}
+    for ref, src in zip(refs.tolist(), srcs.tolist()):
+        sources.setdefault(names[ref], []).append(names[src])
+
+    num_skipped = len(names) - len(sources)
+    mean_sources = np.mean([len(v) for v in sources.values()]) if sources else 0.0
+    logging.info(f"共视图: {len(graph['score'])} 条边，{int(keep.sum())} 条合格；"
+                 f"{len(sources)} 个参考图像，平均 {mean_sources:.1f} 个源图像，跳过 {num_skipped} 张无共视邻居的图像")
+    return sources
+
+def compute_source_views(reconstruction, max_sources=10, observations=None, **kwargs):
+    """由稀疏模型直接计算每个参考图像的源图像列表（observations为已收集的观测，避免重复遍历模型）"""
+    graph = build_covisibility_graph(reconstruction, observations=observations)
+    return select_source_views(graph, max_sources=max_sources, **kwargs)
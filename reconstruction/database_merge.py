@@ -0,0 +1,196 @@
+'''
+Description: 合并多个分片COLMAP数据库，统一重新编号相机、图像、rig与frame ID
+Author: Damocles_lin
+Date: 2026-10-19 14:12:37
+LastEditTime: 2026-10-19 21:40:09
+LastEditors: Damocles_lin
+'''
+import os
+import logging
+import sqlite3
+from .matching import image_ids_to_pair_id, pair_id_to_image_ids
+
+SENSOR_TYPE_CAMERA = 0  # COLMAP中sensor_type=0表示相机
+
+def _table_columns(conn, table):
+    """返回表的列名列表，表不存在时返回空列表"""
+    return [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+
+def _read_rows(conn, table):
+    """以字典形式读取整张表"""
+    columns = _table_columns(conn, table)
+    if not columns:
+        return []
+    cursor = conn.execute(f"SELECT {', '.join(columns)} FROM {table}")
+    return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+def _insert_row(conn, table, row):
+    columns = list(row)
+    placeholders = ", ".join("?" for _ in columns)
+    conn.execute(f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({placeholders})",
+                 [row[c] for c in columns])
+
+def _next_id(conn, table, column):
+    return (conn.execute(f"SELECT COALESCE(MAX({column}), 0) FROM {table}").fetchone()[0] or 0) + 1
+
+def _copy_schema(source_path, target_conn):
+    """将分片数据库中目标库缺失的表和索引结构复制到目标库"""
+    source = sqlite3.connect(source_path)
+    try:
+        statements = source.execute(
+            "SELECT type, name, sql FROM sqlite_master "
+            "WHERE sql IS NOT NULL AND name NOT LIKE 'sqlite_%' ORDER BY type DESC"
+        ).fetchall()
+    finally:
+        source.close()
+    existing = {row[0] for row in target_conn.execute("SELECT name FROM sqlite_master")}
+    for _, name, sql in statements:
+        if name not in existing:
+            target_conn.execute(sql)
+
+def _merge_shard(conn, shard_path, share_cameras=False):
+    """将一个分片数据库合并到目标库，返回 (新增图像数, 新增相机数)"""
+    shard = sqlite3.connect(shard_path)
+    try:
+        tables = {row[0] for row in shard.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+
+        # 1. 图像：按名称去重（重复合并同一分片时已存在的图像被跳过）
+        existing_names = {row[0] for row in conn.execute("SELECT name FROM images")}
+        shard_images = []
+        for row in _read_rows(shard, "images"):
+            if row["name"] in existing_names:
+                logging.warning(f"合并数据库时跳过重复图像: {row['name']}")
+                continue
+            existing_names.add(row["name"])
+            shard_images.append(row)
+
+        # 2. 相机：只合并被新图像使用的相机，每个相机分配新ID；
+        #    仅当特征提取本身配置为共享相机时，参数完全相同的相机才复用已有ID
+        existing_cameras = {}
+        if share_cameras:
+            for row in _read_rows(conn, "cameras"):
+                key = tuple(v for k, v in row.items() if k != "camera_id")
+                existing_cameras[key] = row["camera_id"]
+        used_cameras = {row["camera_id"] for row in shard_images}
+        camera_map = {}
+        new_cameras = 0
+        for row in _read_rows(shard, "cameras"):
+            if row["camera_id"] not in used_cameras:
+                continue
+            key = tuple(v for k, v in row.items() if k != "camera_id")
+            if key in existing_cameras:
+                camera_map[row["camera_id"]] = existing_cameras[key]
+                continue
+            new_id = _next_id(conn, "cameras", "camera_id")
+            camera_map[row["camera_id"]] = new_id
+            if share_cameras:
+                existing_cameras[key] = new_id
+            _insert_row(conn, "cameras", dict(row, camera_id=new_id))
+            new_cameras += 1
+
+        def remap_sensor(sensor_id, sensor_type):
+            return camera_map.get(sensor_id, sensor_id) if sensor_type == SENSOR_TYPE_CAMERA else sensor_id
+
+        # 新图像追加在已有最大ID之后
+        image_map = {}
+        for row in shard_images:
+            new_id = _next_id(conn, "images", "image_id")
+            image_map[row["image_id"]] = new_id
+            _insert_row(conn, "images", dict(row, image_id=new_id, camera_id=camera_map[row["camera_id"]]))
+
+        # 3. rig与frame（新版COLMAP）：单相机rig随相机复用
+        rig_map, frame_map = {}, {}
+        if "rigs" in tables:
+            existing_rigs = {(row["ref_sensor_id"], row["ref_sensor_type"]): row["rig_id"]
+                             for row in _read_rows(conn, "rigs")}
+            shard_sensors = _read_rows(shard, "rig_sensors") if "rig_sensors" in tables else []
+            for row in _read_rows(shard, "rigs"):
+                if row["ref_sensor_type"] == SENSOR_TYPE_CAMERA and row["ref_sensor_id"] not in camera_map:
+                    continue  # 参考相机未被合并（其图像均已存在）的rig
+                key = (remap_sensor(row["ref_sensor_id"], row["ref_sensor_type"]), row["ref_sensor_type"])
+                if key in existing_rigs:
+                    rig_map[row["rig_id"]] = existing_rigs[key]
+                    continue
+                new_id = _next_id(conn, "rigs", "rig_id")
+                rig_map[row["rig_id"]] = new_id
+                existing_rigs[key] = new_id
+                _insert_row(conn, "rigs", dict(row, rig_id=new_id, ref_sensor_id=key[0]))
+                for sensor in shard_sensors:
+                    if sensor["rig_id"] == row["rig_id"]:
+                        _insert_row(conn, "rig_sensors", dict(
+                            sensor, rig_id=new_id,
+                            sensor_id=remap_sensor(sensor["sensor_id"], sensor["sensor_type"])))
+
+        if "frames" in tables:
+            frame_data = _read_rows(shard, "frame_data") if "frame_data" in tables else []
+            # 仅合并至少包含一张新合并图像的frame，图像均被跳过（重复）的frame不插入
+            merged_frames = {row["frame_id"] for row in frame_data
+                             if row["sensor_type"] == SENSOR_TYPE_CAMERA and row["data_id"] in image_map}
+            for row in _read_rows(shard, "frames"):
+                if row["frame_id"] not in merged_frames:
+                    continue
+                new_id = _next_id(conn, "frames", "frame_id")
+                frame_map[row["frame_id"]] = new_id
+                _insert_row(conn, "frames", dict(row, frame_id=new_id, rig_id=rig_map.get(row["rig_id"], row["rig_id"])))
+            for row in frame_data:
+                if row["frame_id"] not in frame_map:
+                    continue
+                data_id = row["data_id"]
+                if row["sensor_type"] == SENSOR_TYPE_CAMERA:
+                    if data_id not in image_map:
+                        continue
+                    data_id = image_map[data_id]
+                _insert_row(conn, "frame_data", dict(
+                    row, frame_id=frame_map[row["frame_id"]], data_id=data_id,
+                    sensor_id=remap_sensor(row["sensor_id"], row["sensor_type"])))
+
+        # 4. 按图像ID关联的数据（关键点、描述子、位姿先验等）
+        handled = {"cameras", "images", "rigs", "rig_sensors", "frames", "frame_data",
+                   "matches", "two_view_geometries"}
+        for table in sorted(tables - handled):
+            if table.startswith("sqlite_"):
+                continue
+            columns = _table_columns(shard, table)
+            if "image_id" not in columns:
+                continue
+            for row in _read_rows(shard, table):
+                if row["image_id"] in image_map:
+                    _insert_row(conn, table, dict(row, image_id=image_map[row["image_id"]]))
+
+        # 5. 分片内已有的匹配与几何验证结果
+        for table in ("matches", "two_view_geometries"):
+            if table not in tables:
+                continue
+            for row in _read_rows(shard, table):
+                image_id1, image_id2 = pair_id_to_image_ids(row["pair_id"])
+                if image_id1 not in image_map or image_id2 not in image_map:
+                    continue
+                new_id1, new_id2 = image_map[image_id1], image_map[image_id2]
+                if new_id1 > new_id2:
+                    # 重新编号后顺序颠倒的图像对，匹配方向需要调换，直接丢弃由后续匹配重新计算
+                    continue
+                _insert_row(conn, table, dict(row, pair_id=image_ids_to_pair_id(new_id1, new_id2)))
+    finally:
+        shard.close()
+    return len(image_map), new_cameras
+
+def merge_databases(shard_paths, merged_path, share_cameras=False):
+    """
+    将多个分片数据库合并为一个COLMAP数据库（目标库已存在时追加）
+    share_cameras: 参数完全相同的相机合并为同一个，仅当特征提取本身配置为共享相机
+      （如CameraMode.SINGLE）时开启；CameraMode.AUTO下每张图像有各自的相机，不应共享
+    """
+    shard_paths = [p for p in shard_paths if os.path.exists(p)]
+    if not shard_paths:
+        logging.error("没有可合并的分片数据库")
+        return
+    conn = sqlite3.connect(merged_path)
+    try:
+        _copy_schema(shard_paths[0], conn)
+        for shard_path in shard_paths:
+            num_images, num_cameras = _merge_shard(conn, shard_path, share_cameras=share_cameras)
+            conn.commit()
+            logging.info(f"合并分片 {os.path.basename(shard_path)}: {num_images} 张图像，{num_cameras} 个新相机")
+    finally:
+        conn.close()
+    logging.info(f"分片数据库已合并到: {merged_path}")
@@ -0,0 +1,332 @@
+'''
+Description: 实时增量注册：监控图像目录，将新图像注册到已有重建中
+Author: Damocles_lin
+Date: 2026-10-19 09:45:18
+LastEditTime: 2026-10-19 22:27:16
+LastEditors: Damocles_lin
+'''
+import os
+import time
+import shutil
+import logging
+import numpy as np
+import open3d as o3d
+import pycolmap
+from pathlib import Path
+from utils import stats_utils, logging_utils
+from .sfm import IMAGE_EXTENSIONS, extract_features
+from .matching import read_image_ids, read_descriptors, match_image_pairs, verify_image_pairs
+from .mvs import (DENSE_QUALITY_PROFILES, dense_reconstruction, stereo_matching, fuse_depth_maps,
+                  write_patch_match_config, write_fusion_config)
+from .undistortion import undistort_images_sharded, remove_stereo_outputs
+from .covisibility import compute_source_views
+from .analytics import collect_observations
+from .triage import triage_new_images, load_selection, load_rejected
+from .streaming_dense import VOXEL_BITS, estimate_voxel_size, voxel_keys, _link_workspace
+
+def watch_image_dir(image_dir, output_dir, poll_interval=5.0, settle_time=2.0,
+                    max_neighbors=10, max_iterations=None, quality="high",
+                    triage=False, duplicate_threshold=6, blur_ratio=0.3):
+    """
+    轮询监控图像目录，发现新图像后执行增量注册
+    已有图像筛选结果时（如以triage执行初始重建），新图像先经过同样的近重复/模糊筛选，被剔除的图像不再重复处理
+    """
+    database_path = os.path.join(output_dir, "database.db")
+    sparse_model_path = os.path.join(output_dir, "sparse", "0")
+
+    # 首次运行时先执行完整流程建立初始模型
+    if not os.path.exists(sparse_model_path):
+        from .pipeline import run_colmap_pipeline
+        logging.info("未找到已有稀疏模型，先执行完整重建流程")
+        run_colmap_pipeline(image_dir, output_dir, quality=quality, triage=triage,
+                            duplicate_threshold=duplicate_threshold, blur_ratio=blur_ratio)
+        if not os.path.exists(sparse_model_path):
+            logging.error("初始重建失败，无法进入监控模式")
+            return
+
+    logging.info(f"进入监控模式: {image_dir}，轮询间隔 {poll_interval}秒")
+    first_seen = {}
+    failed_names = set()
+    rejected_names = load_rejected(output_dir)
+    global_descriptors = {}
+    iteration = 0
+    while max_iterations is None or iteration < max_iterations:
+        iteration += 1
+        new_names = find_new_images(image_dir, database_path, first_seen, settle_time,
+                                    excluded=failed_names | rejected_names)
+        if new_names and load_selection(output_dir) is not None:
+            selected = set(triage_new_images([Path(image_dir) / name for name in new_names], output_dir,
+                                             duplicate_threshold=duplicate_threshold, blur_ratio=blur_ratio))
+            for name in new_names:
+                if name not in selected:
+                    rejected_names.add(name)
+                    first_seen.pop(name, None)
+            new_names = [name for name in new_names if name in selected]
+        if new_names:
+            detect_times = {name: first_seen.pop(name) for name in new_names}
+            ingest_new_images(image_dir, output_dir, new_names, detect_times,
+                              max_neighbors=max_neighbors, global_descriptors=global_descriptors,
+                              quality=quality)
+            # 特征提取失败（未写入数据库）的图像不再重复处理
+            failed_names.update(set(new_names) - set(read_image_ids(database_path)))
+        else:
+            time.sleep(poll_interval)
+
+def find_new_images(image_dir, database_path, first_seen, settle_time=2.0, excluded=()):
+    """
+    查找尚未写入数据库且已写入完成（大小在settle_time内不再变化）的新图像
+    excluded: 不再处理的图像（筛选剔除或特征提取失败）
+    """
+    known_names = set(read_image_ids(database_path)) if os.path.exists(database_path) else set()
+    known_names |= set(excluded)
+    now = time.time()
+    ready = []
+    for f in sorted(Path(image_dir).iterdir()):
+        if not f.is_file() or f.suffix.lower() not in IMAGE_EXTENSIONS or f.name in known_names:
+            continue
+        first_seen.setdefault(f.name, now)
+        if now - f.stat().st_mtime >= settle_time:
+            ready.append(f.name)
+    return ready
+
+def compute_global_descriptor(descriptors):
+    """由RootSIFT描述子均值构建图像全局描述子，用于快速检索近邻图像"""
+    if len(descriptors) == 0:
+        return np.zeros(128, dtype=np.float32)
+    d = descriptors.astype(np.float32)
+    d /= np.maximum(d.sum(axis=1, keepdims=True), 1e-6)
+    g = np.sqrt(d).mean(axis=0)
+    return g / max(np.linalg.norm(g), 1e-6)
+
+def select_neighbor_images(database_path, new_ids, candidate_ids, id_to_name,
+                           max_neighbors=10, global_descriptors=None):
+    """
+    为每张新图像选取有限数量的已有近邻图像
+    一半按文件名顺序（连续拍摄），一半按全局描述子相似度
+    """
+    if global_descriptors is None:
+        global_descriptors = {}
+    missing = [i for i in list(new_ids) + list(candidate_ids) if i not in global_descriptors]
+    for image_id, desc in read_descriptors(database_path, missing).items():
+        global_descriptors[image_id] = compute_global_descriptor(desc)
+
+    candidate_ids = sorted(candidate_ids, key=lambda i: id_to_name[i])
+    if not candidate_ids:
+        return {image_id: [] for image_id in new_ids}
+    candidate_names = [id_to_name[i] for i in candidate_ids]
+    candidate_matrix = np.stack([global_descriptors[i] for i in candidate_ids])
+
+    num_sequential = max_neighbors // 2
+    neighbors = {}
+    for image_id in new_ids:
+        # 按文件名顺序选取前后相邻的图像
+        pos = int(np.searchsorted(candidate_names, id_to_name[image_id]))
+        lo = max(0, pos - (num_sequential + 1) // 2)
+        selected = candidate_ids[lo:lo + num_sequential]
+
+        # 按全局描述子相似度补足剩余名额
+        scores = candidate_matrix @ global_descriptors[image_id]
+        for idx in np.argsort(-scores):
+            if len(selected) >= max_neighbors:
+                break
+            if candidate_ids[idx] not in selected:
+                selected.append(candidate_ids[idx])
+        neighbors[image_id] = selected
+    return neighbors
+
+def register_new_images(database_path, image_path, sparse_model_path):
+    """以已有模型为起点执行增量注册，已有图像位姿固定，仅对新图像做局部优化"""
+    mapper_options = pycolmap.IncrementalPipelineOptions()
+    # 不同pycolmap版本的字段名不同
+    for name in ("fix_existing_frames", "fix_existing_images"):
+        if hasattr(mapper_options, name):
+            setattr(mapper_options, name, True)
+            break
+
+    ingest_path = os.path.join(os.path.dirname(sparse_model_path), "_ingest")
+    os.makedirs(ingest_path, exist_ok=True)
+    reconstructions = pycolmap.incremental_mapping(
+        database_path=database_path,
+        image_path=image_path,
+        output_path=ingest_path,
+        options=mapper_options,
+        input_path=sparse_model_path
+    )
+    if not reconstructions:
+        logging.error("增量注册失败！")
+        return None
+
+    reconstruction = reconstructions[0] if 0 in reconstructions else list(reconstructions.values())[0]
+    reconstruction.write(sparse_model_path)
+    shutil.rmtree(ingest_path, ignore_errors=True)
+    return reconstruction
+
+def refresh_dense_region(output_dir, sparse_model_path, image_path, affected_names, quality="high"):
+    """
+    仅对受影响的参考图像重新计算深度图，并局部更新稠密点云
+    局部立体匹配与融合在共享图像和深度图目录的独立工作空间中进行，主工作空间的完整配置文件保持不变
+    """
+    dense_path = os.path.join(output_dir, "dense")
+    results_dir = os.path.join(dense_path, "results")
+    dense_points_path = os.path.join(results_dir, "dense_points.npy")
+
+    # 尚无稠密结果时直接执行完整稠密重建
+    if not os.path.exists(dense_points_path):
+        dense_reconstruction(output_dir, sparse_model_path, image_path, quality=quality)
+        return
+
+    undistort_images_sharded(
+        output_path=dense_path,
+        input_path=sparse_model_path,
+        image_path=image_path,
+        max_image_size=DENSE_QUALITY_PROFILES[quality]["max_image_size"],
+        image_names=affected_names
+    )
+
+    # 删除受影响图像的旧立体匹配输出，确保重新计算
+    remove_stereo_outputs(dense_path, affected_names)
+
+    # 受影响图像按共视图选取源图像，没有共视邻居的图像不参与立体匹配
+    max_image_size = DENSE_QUALITY_PROFILES[quality]["max_image_size"]
+    reconstruction = pycolmap.Reconstruction(sparse_model_path)
+    observations = collect_observations(reconstruction)
+    sources = compute_source_views(reconstruction, observations=observations)
+    ref_names = [name for name in affected_names if name in sources]
+    if not ref_names:
+        logging.warning("受影响图像均没有共视邻居，跳过稠密更新")
+        return
+    workspace_path = _link_workspace(dense_path, os.path.join(dense_path, "ingest"))
+    partial_path = os.path.join(dense_path, "fused_ingest.ply")
+    try:
+        write_patch_match_config(workspace_path, ref_names, sources=sources)
+        stereo_matching(workspace_path)
+        write_fusion_config(workspace_path, ref_names)
+        fuse_depth_maps(workspace_path, partial_path)
+    finally:
+        shutil.rmtree(workspace_path, ignore_errors=True)
+
+    partial = o3d.io.read_point_cloud(partial_path)
+    if not partial or len(partial.points) == 0:
+        logging.warning("受影响区域未融合出稠密点")
+        return
+    fused_path = os.path.join(dense_path, "fused.ply")
+    existing = o3d.io.read_point_cloud(fused_path) if os.path.exists(fused_path) else None
+    if not existing or len(existing.points) == 0:
+        existing = o3d.geometry.PointCloud(o3d.utility.Vector3dVector(np.load(dense_points_path)))
+
+    voxel_size = estimate_voxel_size(reconstruction, max_image_size, observations=observations)
+    merged, replaced = _merge_partial_cloud(existing, partial, voxel_size)
+    dense_points = np.asarray(merged.points)
+    np.save(dense_points_path, dense_points)
+    o3d.io.write_point_cloud(fused_path, merged)
+    os.remove(partial_path)
+    logging.info(f"局部更新稠密点云: 替换 {replaced} 个点，新增 {len(partial.points)} 个点，"
+                 f"当前共 {len(dense_points)} 个点（网格未更新）")
+
+def _cloud_arrays(pcd):
+    """点云的坐标、法向与颜色数组，缺失的法向或颜色补零"""
+    points = np.asarray(pcd.points)
+    normals = np.asarray(pcd.normals) if pcd.has_normals() else np.zeros_like(points)
+    colors = np.asarray(pcd.colors) if pcd.has_colors() else np.zeros_like(points)
+    return points, normals, colors
+
+def _merge_partial_cloud(existing, partial, voxel_size):
+    """
+    用局部重新融合的点替换已有点云中同一体素内的旧点
+    只替换新融合点实际覆盖的体素，受影响区域包围盒内未被覆盖的旧点保留
+    返回 (合并后的点云(含法向与颜色), 被替换的旧点数)
+    """
+    existing_points, existing_normals, existing_colors = _cloud_arrays(existing)
+    partial_points, partial_normals, partial_colors = _cloud_arrays(partial)
+
+    replaced = np.zeros(len(existing_points), dtype=bool)
+    if len(existing_points):
+        # 体素索引需覆盖两个点云的整体范围
+        origin = np.minimum(existing_points.min(axis=0), partial_points.min(axis=0))
+        upper = np.maximum(existing_points.max(axis=0), partial_points.max(axis=0))
+        voxel_size = max(voxel_size or 0.0, float((upper - origin).max()) / ((1 << VOXEL_BITS) - 1), 1e-12)
+        partial_keys, _ = voxel_keys(partial_points, origin, voxel_size)
+        existing_keys, _ = voxel_keys(existing_points, origin, voxel_size)
+        replaced = np.isin(existing_keys, partial_keys)
+
+    merged = o3d.geometry.PointCloud()
+    merged.points = o3d.utility.Vector3dVector(np.vstack([existing_points[~replaced], partial_points]))
+    merged.normals = o3d.utility.Vector3dVector(np.vstack([existing_normals[~replaced], partial_normals]))
+    merged.colors = o3d.utility.Vector3dVector(np.vstack([existing_colors[~replaced], partial_colors]))
+    return merged, int(replaced.sum())
+
+def ingest_new_images(image_dir, output_dir, new_names, detect_times,
+                      max_neighbors=10, global_descriptors=None, quality="high"):
+    """将一批新图像注册到已有重建中，并报告单张图像端到端延迟"""
+    database_path = os.path.join(output_dir, "database.db")
+    sparse_model_path = os.path.join(output_dir, "sparse", "0")
+    image_path = str(image_dir)
+    logging.info(f"发现 {len(new_names)} 张新图像，开始增量注册")
+
+    # 1. 仅对新图像提取特征
+    logging_utils.set_stage_verbosity("extraction")
+    t0 = time.time()
+    extract_features(image_dir, database_path, image_names=new_names)
+    t_extract = time.time() - t0
+
+    # 2. 与有限数量的已注册近邻图像匹配
+    logging_utils.set_stage_verbosity("matching")
+    t0 = time.time()
+    name_to_id = read_image_ids(database_path)
+    id_to_name = {image_id: name for name, image_id in name_to_id.items()}
+    new_ids = [name_to_id[name] for name in new_names if name in name_to_id]
+    reconstruction = pycolmap.Reconstruction(sparse_model_path)
+    registered_ids = [name_to_id[image.name] for image in reconstruction.images.values()
+                      if image.name in name_to_id]
+    neighbors = select_neighbor_images(database_path, new_ids, registered_ids, id_to_name,
+                                       max_neighbors=max_neighbors,
+                                       global_descriptors=global_descriptors)
+    image_pairs = [(image_id, neighbor_id) for image_id, ids in neighbors.items() for neighbor_id in ids]
+    # 同一批次内的新图像之间也进行匹配
+    image_pairs += [(a, b) for i, a in enumerate(new_ids) for b in new_ids[i + 1:]]
+    num_matches = match_image_pairs(database_path, image_pairs)
+    verify_image_pairs(database_path, image_pairs, id_to_name)
+    t_match = time.time() - t0
+    logging.info(f"匹配 {len(image_pairs)} 个图像对，共 {num_matches} 个匹配")
+
+    # 3. 注册到已有稀疏模型
+    logging_utils.set_stage_verbosity("mapping")
+    t0 = time.time()
+    reconstruction = register_new_images(database_path, image_path, sparse_model_path)
+    t_register = time.time() - t0
+    registered_names = set()
+    if reconstruction is not None:
+        from .pipeline import save_sparse_results
+        registered_names = {image.name for image in reconstruction.images.values()} & set(new_names)
+        # 刷新results中的位姿、相机与稀疏点云，使其与更新后的稀疏模型一致
+        save_sparse_results(reconstruction, os.path.join(output_dir, "dense", "results"))
+
+    # 4. 局部更新稠密结果（新注册图像及其近邻）
+    logging_utils.set_stage_verbosity("dense")
+    t0 = time.time()
+    if registered_names:
+        affected = set(registered_names)
+        for image_id, ids in neighbors.items():
+            if id_to_name[image_id] in registered_names:
+                affected.update(id_to_name[i] for i in ids)
+        refresh_dense_region(output_dir, sparse_model_path, image_path, sorted(affected), quality=quality)
+    t_dense = time.time() - t0
+
+    # 5. 报告端到端延迟
+    finish_time = time.time()
+    records = []
+    for name in new_names:
+        latency = finish_time - detect_times.get(name, finish_time)
+        records.append({
+            "image_name": name,
+            "registered": name in registered_names,
+            "latency": latency,
+            "extract": t_extract,
+            "match": t_match,
+            "register": t_register,
+            "dense": t_dense
+        })
+        logging.info(f"图像 {name}: {'已注册' if name in registered_names else '注册失败'}，"
+                     f"端到端延迟 {latency:.2f}秒")
+    stats_utils.save_ingest_latency(output_dir, records)
+    return records
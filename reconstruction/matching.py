@@ -0,0 +1,403 @@
+'''
+Description: 
+Author: Damocles_lin
+Date: 2026-10-19 09:12:40
+LastEditTime: 2026-10-19 21:18:26
+LastEditors: Damocles_lin
+'''
+import logging
+import os
+import time
+import shutil
+import sqlite3
+import zlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import pycolmap
+from utils import logging_utils
+from utils.memory_utils import apply_option_overrides
+
+# COLMAP数据库中pair_id的编码常量（kMaxNumImages）
+MAX_IMAGE_ID = 2147483647
+
+def image_ids_to_pair_id(image_id1, image_id2):
+    """将两个图像ID编码为COLMAP的pair_id（小ID在前）"""
+    if image_id1 > image_id2:
+        image_id1, image_id2 = image_id2, image_id1
+    return image_id1 * MAX_IMAGE_ID + image_id2
+
+def pair_id_to_image_ids(pair_id):
+    """将COLMAP的pair_id解码为两个图像ID"""
+    image_id2 = pair_id % MAX_IMAGE_ID
+    image_id1 = (pair_id - image_id2) // MAX_IMAGE_ID
+    return image_id1, image_id2
+
+def read_image_ids(database_path):
+    """读取数据库中的图像名称到图像ID映射"""
+    conn = sqlite3.connect(database_path)
+    try:
+        cursor = conn.execute("SELECT image_id, name FROM images")
+        return {name: image_id for image_id, name in cursor.fetchall()}
+    finally:
+        conn.close()
+
+def read_descriptors(database_path, image_ids):
+    """批量读取指定图像的SIFT描述子，返回 {image_id: (N, 128) uint8}"""
+    descriptors = {}
+    conn = sqlite3.connect(database_path)
+    try:
+        for image_id in image_ids:
+            row = conn.execute(
+                "SELECT rows, cols, data FROM descriptors WHERE image_id = ?", (int(image_id),)
+            ).fetchone()
+            if row is None or row[0] == 0:
+                descriptors[image_id] = np.zeros((0, 128), dtype=np.uint8)
+                continue
+            rows, cols, data = row
+            descriptors[image_id] = np.frombuffer(data, dtype=np.uint8).reshape(rows, cols)
+    finally:
+        conn.close()
+    return descriptors
+
+def read_matched_pair_ids(database_path):
+    """读取数据库中已存在匹配的pair_id集合"""
+    conn = sqlite3.connect(database_path)
+    try:
+        return {row[0] for row in conn.execute("SELECT pair_id FROM matches")}
+    finally:
+        conn.close()
+
+def match_descriptors(descriptors1, descriptors2, max_ratio=0.8, cross_check=True, chunk_size=4096):
+    """
+    基于L2距离的SIFT描述子匹配（比率测试 + 双向一致性检查）
+    返回 (M, 2) uint32 的特征索引对
+    """
+    if len(descriptors1) < 2 or len(descriptors2) < 2:
+        return np.zeros((0, 2), dtype=np.uint32)
+
+    d1 = descriptors1.astype(np.float32)
+    d2 = descriptors2.astype(np.float32)
+    sq1 = np.einsum("ij,ij->i", d1, d1)
+    sq2 = np.einsum("ij,ij->i", d2, d2)
+
+    # 分块计算距离矩阵，限制峰值内存
+    best12 = np.empty(len(d1), dtype=np.int64)
+    ratio_ok = np.empty(len(d1), dtype=bool)
+    best21 = np.full(len(d2), -1, dtype=np.int64)
+    best21_dist = np.full(len(d2), np.inf, dtype=np.float32)
+    for start in range(0, len(d1), chunk_size):
+        stop = min(start + chunk_size, len(d1))
+        dist = sq1[start:stop, None] + sq2[None, :] - 2.0 * (d1[start:stop] @ d2.T)
+        np.maximum(dist, 0, out=dist)
+
+        nearest = np.argpartition(dist, 1, axis=1)[:, :2]
+        nearest_dist = np.take_along_axis(dist, nearest, axis=1)
+        order = np.argsort(nearest_dist, axis=1)
+        nearest = np.take_along_axis(nearest, order, axis=1)
+        nearest_dist = np.take_along_axis(nearest_dist, order, axis=1)
+        best12[start:stop] = nearest[:, 0]
+        ratio_ok[start:stop] = np.sqrt(nearest_dist[:, 0]) < max_ratio * np.sqrt(nearest_dist[:, 1])
+
+        if cross_check:
+            col_best = np.argmin(dist, axis=0)
+            col_dist = dist[col_best, np.arange(dist.shape[1])]
+            better = col_dist < best21_dist
+            best21[better] = col_best[better] + start
+            best21_dist[better] = col_dist[better]
+
+    idx1 = np.nonzero(ratio_ok)[0]
+    idx2 = best12[idx1]
+    if cross_check:
+        mutual = best21[idx2] == idx1
+        idx1, idx2 = idx1[mutual], idx2[mutual]
+
+    return np.stack([idx1, idx2], axis=1).astype(np.uint32)
+
+def write_matches(conn, image_id1, image_id2, matches):
+    """将匹配写入数据库的matches表（自动处理图像ID顺序）"""
+    if image_id1 > image_id2:
+        image_id1, image_id2 = image_id2, image_id1
+        matches = matches[:, ::-1]
+    matches = np.ascontiguousarray(matches, dtype=np.uint32)
+    conn.execute(
+        "INSERT OR REPLACE INTO matches (pair_id, rows, cols, data) VALUES (?, ?, ?, ?)",
+        (image_ids_to_pair_id(image_id1, image_id2), matches.shape[0], 2, matches.tobytes())
+    )
+
+def match_image_pairs(database_path, image_pairs, max_ratio=0.8, cross_check=True):
+    """
+    对给定的图像对列表进行描述子匹配并写入数据库
+    image_pairs: [(image_id1, image_id2), ...]
+    返回写入的匹配总数
+    """
+    image_ids = sorted({image_id for pair in image_pairs for image_id in pair})
+    descriptors = read_descriptors(database_path, image_ids)
+
+    total_matches = 0
+    conn = sqlite3.connect(database_path)
+    try:
+        for image_id1, image_id2 in image_pairs:
+            matches = match_descriptors(
+                descriptors[image_id1], descriptors[image_id2],
+                max_ratio=max_ratio, cross_check=cross_check
+            )
+            write_matches(conn, image_id1, image_id2, matches)
+            total_matches += matches.shape[0]
+        conn.commit()
+    finally:
+        conn.close()
+    return total_matches
+
+def write_pairs_file(pairs_path, image_pairs, id_to_name):
+    """写入COLMAP格式的图像对列表文件（每行: name1 name2）"""
+    with open(pairs_path, "w") as f:
+        for image_id1, image_id2 in image_pairs:
+            f.write(f"{id_to_name[image_id1]} {id_to_name[image_id2]}\n")
+
+def verify_image_pairs(database_path, image_pairs, id_to_name):
+    """对已写入匹配的图像对执行几何验证（已验证的图像对会被COLMAP跳过）"""
+    if not image_pairs:
+        return
+    pairs_path = os.path.join(os.path.dirname(database_path), "verify_pairs.txt")
+    write_pairs_file(pairs_path, image_pairs, id_to_name)
+    verification_options = pycolmap.TwoViewGeometryOptions()
+    pycolmap.verify_matches(database_path, pairs_path, verification_options)
+    logging.info(f"完成 {len(image_pairs)} 个图像对的几何验证")
+
+# ---------------- 分块可恢复匹配调度 ----------------
+
+PROGRESS_TABLE = "matching_progress"
+
+# 分块临时数据库中从主数据库复制的表：相机与rig全部复制，其余按分块图像筛选
+BLOCK_COPY_TABLES = ("cameras", "rigs", "rig_sensors")
+BLOCK_IMAGE_TABLES = ("images", "keypoints", "descriptors")
+BLOCK_RESULT_TABLES = ("matches", "two_view_geometries")
+
+def ensure_progress_table(database_path):
+    """在database.db中创建分块匹配进度表"""
+    conn = sqlite3.connect(database_path)
+    try:
+        conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS {PROGRESS_TABLE} (
+                block_id INTEGER PRIMARY KEY NOT NULL,
+                signature TEXT NOT NULL,
+                status TEXT NOT NULL,
+                num_pairs INTEGER NOT NULL,
+                num_matches INTEGER NOT NULL,
+                worker TEXT,
+                elapsed REAL
+            )
+        """)
+        conn.commit()
+    finally:
+        conn.close()
+
+def read_progress(database_path):
+    """读取分块进度 {block_id: (signature, status)}"""
+    conn = sqlite3.connect(database_path)
+    try:
+        cursor = conn.execute(f"SELECT block_id, signature, status FROM {PROGRESS_TABLE}")
+        return {block_id: (signature, status) for block_id, signature, status in cursor.fetchall()}
+    finally:
+        conn.close()
+
+def reindex_progress(database_path, signatures):
+    """
+    按签名将已有进度对应到当前分块编号：新增图像导致重新切分时，内容未变的分块保留其进度，
+    内容变化或已不存在的分块记录被删除
+    """
+    conn = sqlite3.connect(database_path)
+    try:
+        columns = "signature, status, num_pairs, num_matches, worker, elapsed"
+        by_signature = {row[0]: row for row in conn.execute(f"SELECT {columns} FROM {PROGRESS_TABLE}")}
+        with conn:
+            conn.execute(f"DELETE FROM {PROGRESS_TABLE}")
+            conn.executemany(f"INSERT INTO {PROGRESS_TABLE} (block_id, {columns}) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                             [(i,) + by_signature[sig] for i, sig in enumerate(signatures) if sig in by_signature])
+    finally:
+        conn.close()
+
+def tile_image_pairs(image_ids, block_size):
+    """将图像对矩阵的上三角部分按 block_size x block_size 切分为分块"""
+    image_ids = sorted(image_ids)
+    groups = [image_ids[i:i + block_size] for i in range(0, len(image_ids), block_size)]
+    blocks = []
+    for a, group_a in enumerate(groups):
+        for b in range(a, len(groups)):
+            if a == b:
+                pairs = [(x, y) for i, x in enumerate(group_a) for y in group_a[i + 1:]]
+            else:
+                pairs = [(x, y) for x in group_a for y in groups[b]]
+            if pairs:
+                blocks.append(pairs)
+    return blocks
+
+def tile_pair_list(image_pairs, block_size):
+    """将任意候选图像对列表按图像ID排序后切分为大小约为 block_size^2 的分块"""
+    pairs = sorted({(min(a, b), max(a, b)) for a, b in image_pairs if a != b})
+    chunk = max(1, block_size * block_size)
+    return [pairs[i:i + chunk] for i in range(0, len(pairs), chunk)]
+
+def block_signature(pairs):
+    """分块签名：图像对内容变化（如新增图像导致重新切分）时失效"""
+    first, last = pairs[0], pairs[-1]
+    checksum = zlib.crc32(np.asarray(pairs, dtype=np.int64).tobytes())
+    return f"{len(pairs)}:{first[0]}-{first[1]}:{last[0]}-{last[1]}:{checksum:08x}"
+
+def _build_block_database(database_path, block_path, image_ids):
+    """创建只包含一个分块图像（及其相机、关键点、描述子）的临时数据库，图像ID与主数据库一致"""
+    if os.path.exists(block_path):
+        os.remove(block_path)
+    conn = sqlite3.connect(block_path)
+    try:
+        conn.execute("ATTACH DATABASE ? AS source", (database_path,))
+        schema = dict(conn.execute(
+            "SELECT name, sql FROM source.sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'"))
+        id_list = ", ".join(str(int(image_id)) for image_id in image_ids)
+        for table in BLOCK_COPY_TABLES + BLOCK_IMAGE_TABLES:
+            if table not in schema:
+                continue
+            conn.execute(schema[table])
+            condition = f" WHERE image_id IN ({id_list})" if table in BLOCK_IMAGE_TABLES else ""
+            conn.execute(f"INSERT INTO main.{table} SELECT * FROM source.{table}{condition}")
+        # 新版COLMAP的frame：仅保留包含分块图像的frame
+        if "frames" in schema and "frame_data" in schema:
+            conn.execute(schema["frame_data"])
+            conn.execute(schema["frames"])
+            conn.execute("INSERT INTO main.frame_data SELECT * FROM source.frame_data "
+                         f"WHERE sensor_type = 0 AND data_id IN ({id_list})")
+            conn.execute("INSERT INTO main.frames SELECT * FROM source.frames "
+                         "WHERE frame_id IN (SELECT frame_id FROM main.frame_data)")
+        conn.commit()
+        conn.execute("DETACH DATABASE source")
+    finally:
+        conn.close()
+
+def _read_block_results(block_path):
+    """读取临时数据库中的匹配与几何验证结果 {表名: (列名列表, 行列表)}"""
+    conn = sqlite3.connect(block_path)
+    try:
+        results = {}
+        for table in BLOCK_RESULT_TABLES:
+            columns = [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+            rows = conn.execute(f"SELECT {', '.join(columns)} FROM {table}").fetchall() if columns else []
+            results[table] = (columns, rows)
+        return results
+    finally:
+        conn.close()
+
+def _match_block(database_path, block_id, pairs, scratch_dir, option_overrides, device_name):
+    """
+    工作进程：用COLMAP匹配器（含几何验证）匹配一个分块的图像对列表
+    分块在独立的临时数据库中匹配，避免多个进程同时写入database.db；结果交由主进程写入
+    """
+    start = time.time()
+    image_ids = sorted({image_id for pair in pairs for image_id in pair})
+    block_path = os.path.join(scratch_dir, f"block_{block_id}.db")
+    pairs_path = os.path.join(scratch_dir, f"block_{block_id}_pairs.txt")
+    _build_block_database(database_path, block_path, image_ids)
+    id_to_name = {image_id: name for name, image_id in read_image_ids(block_path).items()}
+    write_pairs_file(pairs_path, pairs, id_to_name)
+
+    sift_options = pycolmap.SiftMatchingOptions()
+    sift_options.num_threads = -1
+    sift_options.use_gpu = True
+    sift_options.gpu_index = "0"
+    apply_option_overrides(sift_options, option_overrides)
+    pairing_options = pycolmap.ImagePairsMatchingOptions()
+    pairing_options.match_list_path = pairs_path
+    pycolmap.match_imagepairs(
+        database_path=block_path,
+        sift_options=sift_options,
+        matching_options=pairing_options,
+        verification_options=pycolmap.TwoViewGeometryOptions(),
+        device=pycolmap.Device.__members__[device_name]
+    )
+
+    results = _read_block_results(block_path)
+    for path in (block_path, pairs_path):
+        os.remove(path)
+    return block_id, f"pid-{os.getpid()}", results, time.time() - start
+
+def match_blocks_scheduled(database_path, blocks, num_workers=None, option_overrides=None, device_name="cuda",
+                           verify_batch_blocks=8):
+    """
+    将图像对分块分发到工作进程池，每个分块由COLMAP匹配器在其图像对列表上匹配一次
+    空闲工作进程从共享队列中领取下一个未完成分块（动态负载均衡），
+    每个分块的匹配结果与进度记录在同一事务中写入database.db，中断后从最后完成的分块继续
+    option_overrides: 覆盖SiftMatchingOptions的选项（如内存规划给出的max_num_matches）
+    返回每个工作进程的吞吐统计
+    """
+    ensure_progress_table(database_path)
+    signatures = [block_signature(pairs) for pairs in blocks]
+    reindex_progress(database_path, signatures)
+    progress = read_progress(database_path)
+
+    pending = [i for i, sig in enumerate(signatures) if progress.get(i, (None, None))[0] != sig]
+    logging.info(f"分块匹配: 共 {len(blocks)} 个分块，已完成 {len(blocks) - len(pending)} 个，"
+                 f"待处理 {len(pending)} 个")
+
+    worker_stats = {}
+    if pending:
+        if num_workers is None:
+            num_workers = os.cpu_count() or 1
+        scratch_dir = os.path.join(os.path.dirname(os.path.abspath(database_path)), "matching_blocks")
+        os.makedirs(scratch_dir, exist_ok=True)
+        conn = sqlite3.connect(database_path, timeout=60)
+        try:
+            # 使用spawn启动工作进程，避免GPU上下文与主进程中的线程在fork后失效
+            with ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context("spawn"),
+                                     initializer=logging_utils.init_worker_logging,
+                                     initargs=(logging_utils.get_log_queue(),)) as executor:
+                futures = [executor.submit(_match_block, database_path, i, blocks[i], scratch_dir,
+                                           option_overrides, device_name)
+                           for i in pending]
+                for future in as_completed(futures):
+                    block_id, worker, results, elapsed = future.result()
+                    match_columns, match_rows = results["matches"]
+                    num_matches = sum(row[match_columns.index("rows")] for row in match_rows)
+                    # 匹配器已完成几何验证的分块直接标记为verified
+                    geometry_rows = results["two_view_geometries"][1]
+                    status = "verified" if len(geometry_rows) >= len(match_rows) else "matched"
+                    with conn:
+                        for table, (columns, rows) in results.items():
+                            if rows:
+                                conn.executemany(
+                                    f"INSERT OR REPLACE INTO {table} ({', '.join(columns)}) "
+                                    f"VALUES ({', '.join('?' for _ in columns)})", rows)
+                        conn.execute(
+                            f"INSERT OR REPLACE INTO {PROGRESS_TABLE} "
+                            "(block_id, signature, status, num_pairs, num_matches, worker, elapsed) "
+                            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                            (block_id, signatures[block_id], status, len(blocks[block_id]), num_matches,
+                             worker, elapsed)
+                        )
+                    stats = worker_stats.setdefault(worker, {"name": worker, "items": 0, "elapsed": 0.0})
+                    stats["items"] += len(blocks[block_id])
+                    stats["elapsed"] += elapsed
+        finally:
+            conn.close()
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+
+    for stats in worker_stats.values():
+        logging.info(f"{stats['name']}: {stats['items']} 个图像对，"
+                     f"{stats['items'] / max(stats['elapsed'], 1e-6):.1f} 对/秒")
+
+    # 几何验证：按批处理状态为matched的分块，完成后标记为verified
+    progress = read_progress(database_path)
+    unverified = [i for i, sig in enumerate(signatures) if progress.get(i) == (sig, "matched")]
+    if unverified:
+        id_to_name = {image_id: name for name, image_id in read_image_ids(database_path).items()}
+        for start in range(0, len(unverified), verify_batch_blocks):
+            batch = unverified[start:start + verify_batch_blocks]
+            verify_image_pairs(database_path, [pair for i in batch for pair in blocks[i]], id_to_name)
+            conn = sqlite3.connect(database_path, timeout=60)
+            try:
+                with conn:
+                    conn.executemany(f"UPDATE {PROGRESS_TABLE} SET status = 'verified' WHERE block_id = ?",
+                                     [(i,) for i in batch])
+            finally:
+                conn.close()
+
+    return list(worker_stats.values())
@@ -0,0 +1,249 @@
+'''
+Description: 运行前的内存预算规划：估算各阶段峰值内存并推导满足预算的选项
+Author: Damocles_lin
+Date: 2026-10-19 13:28:51
+LastEditTime: 2026-10-19 22:18:42
+LastEditors: Damocles_lin
+'''
+import os
+import logging
+import numpy as np
+from pathlib import Path
+from datetime import datetime
+from utils.memory_utils import has_current_rss
+
+GB = 1024 ** 3
+MB = 1024 ** 2
+
+# 候选选项按从高质量到低内存排列，规划时取满足预算的第一个组合
+EXTRACTION_IMAGE_SIZES = [3200, 2400, 1600, 1200, 800]
+EXTRACTION_MAX_FEATURES = [8192, 6144, 4096, 2048]
+STEREO_IMAGE_SIZES = [-1, 3200, 2400, 2000, 1600, 1200, 1000, 800]
+POISSON_DEPTHS = [13, 12, 11, 10, 9, 8]
+
+# 估算模型系数（字节），可依据memory_calibration.csv中的预测值与观测值校准
+MODEL_COEFFICIENTS = {
+    "base": 400 * MB,                 # Python、pycolmap、open3d常驻内存
+    "sift_bytes_per_pixel": 40,       # 高斯/DoG金字塔（float32，约10层等效）
+    "feature_bytes": 128 + 16,        # 每个特征的描述子与关键点
+    "match_bytes_per_pair": 4,        # 每个特征对距离矩阵元素（float32）
+    "observation_bytes": 80,          # 增量重建中每个观测
+    "triangulated_ratio": 0.25,       # 被三角化的特征比例
+    "stereo_bytes_per_pixel": 60,     # 参考图与源图、深度/法向/代价图
+    "dense_points_per_pixel": 0.05,   # 每个参考图像素产生的融合点数
+    "fused_point_bytes": 40,          # 融合点（坐标、法向、颜色、可见性）
+    "poisson_node_bytes": 150,        # Poisson八叉树节点
+    "poisson_nodes_per_level": 4      # 每增加一层深度节点数约增长倍数（曲面）
+}
+
+def _scaled_pixels(resolution, max_image_size):
+    """按最大边长缩放后的像素数"""
+    width, height = resolution
+    if width <= 0 or height <= 0:
+        width, height = 4000, 3000  # 分辨率未知时按常见相机估计
+    longest = max(width, height)
+    if max_image_size > 0 and longest > max_image_size:
+        scale = max_image_size / longest
+        width, height = width * scale, height * scale
+    return width * height
+
+def estimate_extraction(resolutions, max_image_size, max_num_features, num_threads, c=MODEL_COEFFICIENTS):
+    """特征提取峰值：并发线程的图像金字塔 + 特征缓存"""
+    pixels = max(_scaled_pixels(r, max_image_size) for r in resolutions)
+    per_thread = pixels * c["sift_bytes_per_pixel"] + max_num_features * c["feature_bytes"]
+    return c["base"] + num_threads * per_thread
+
+def estimate_matching(num_images, max_num_features, block_size, num_threads, c=MODEL_COEFFICIENTS):
+    """穷举匹配峰值：两个图像块的描述子 + 并发的距离矩阵"""
+    block = min(block_size, num_images)
+    descriptors = 2 * block * max_num_features * c["feature_bytes"]
+    distances = num_threads * max_num_features ** 2 * c["match_bytes_per_pair"]
+    return c["base"] + descriptors + distances
+
+def estimate_mapping(num_images, max_num_features, c=MODEL_COEFFICIENTS):
+    """增量重建峰值：数据库缓存的关键点 + 观测与三维点"""
+    keypoints = num_images * max_num_features * 24
+    observations = num_images * max_num_features * c["triangulated_ratio"]
+    return c["base"] + keypoints + observations * c["observation_bytes"]
+
+def estimate_stereo(resolutions, max_image_size, cache_size_gb, num_sources=20, c=MODEL_COEFFICIENTS):
+    """立体匹配峰值：工作空间缓存 + 单个参考图及其源图的数据"""
+    pixels = max(_scaled_pixels(r, max_image_size) for r in resolutions)
+    problem = (1 + num_sources) * pixels * 4 + pixels * c["stereo_bytes_per_pixel"]
+    return c["base"] + cache_size_gb * GB + problem
+
+def estimate_num_dense_points(resolutions, max_image_size, c=MODEL_COEFFICIENTS):
+    """估算融合后的稠密点数量"""
+    return int(sum(_scaled_pixels(r, max_image_size) for r in resolutions) * c["dense_points_per_pixel"])
+
+def estimate_fusion(num_dense_points, cache_size_gb, c=MODEL_COEFFICIENTS):
+    """深度图融合峰值：工作空间缓存 + 融合点"""
+    return c["base"] + cache_size_gb * GB + num_dense_points * c["fused_point_bytes"]
+
+def estimate_meshing(num_dense_points, depth, c=MODEL_COEFFICIENTS):
+    """Poisson网格重建峰值：输入点 + 八叉树节点"""
+    nodes = c["poisson_nodes_per_level"] ** depth
+    return c["base"] + num_dense_points * c["fused_point_bytes"] + nodes * c["poisson_node_bytes"]
+
+def plan_memory_budget(image_resolutions, budget_gb, num_threads=None, dense_max_image_size=-1,
+                       extraction_shards=1, streaming_dense=False):
+    """
+    根据图像数量和分辨率估算各阶段峰值内存，选取满足预算的选项
+    extraction_shards: 同时运行的特征提取分片数，各分片共享预算，extraction选项中的线程数为单个分片的
+    streaming_dense: 流式稠密重建中立体匹配与融合并发运行，两者的缓存平分剩余预算
+    返回 {阶段: {"options": {...}, "predicted_bytes": int, "fits": bool}}
+    """
+    budget = budget_gb * GB
+    resolutions = list(image_resolutions.values()) or [(0, 0)]
+    num_images = len(image_resolutions)
+    if num_threads is None:
+        num_threads = os.cpu_count() or 1
+    plan = {}
+
+    # 1. 特征提取：优先保持分辨率，其次特征数量，最后减少线程（分片时按分片均分线程，峰值为各分片之和）
+    extraction_shards = max(1, extraction_shards)
+    shard_threads = max(1, num_threads // extraction_shards)
+    extraction = None
+    for threads in sorted({shard_threads, max(1, shard_threads // 2), max(1, shard_threads // 4), 1}, reverse=True):
+        for size in EXTRACTION_IMAGE_SIZES:
+            for features in EXTRACTION_MAX_FEATURES:
+                predicted = extraction_shards * estimate_extraction(resolutions, size, features, threads)
+                if predicted <= budget:
+                    extraction = (size, features, threads, predicted)
+                    break
+            if extraction:
+                break
+        if extraction:
+            break
+    fits = extraction is not None
+    if not fits:
+        size, features, threads = EXTRACTION_IMAGE_SIZES[-1], EXTRACTION_MAX_FEATURES[-1], 1
+        extraction = (size, features, threads,
+                      extraction_shards * estimate_extraction(resolutions, size, features, threads))
+    size, max_num_features, threads, predicted = extraction
+    plan["extraction"] = {
+        "options": {"max_image_size": size, "max_num_features": max_num_features, "num_threads": threads},
+        "predicted_bytes": predicted,
+        "fits": fits
+    }
+
+    # 2. 特征匹配：缩小图像块，必要时限制匹配数
+    matching = None
+    for block_size in (50, 35, 20, 10):
+        for matches in (32768, 16384, 8192):
+            features = min(max_num_features, matches)
+            predicted = estimate_matching(num_images, features, block_size, num_threads)
+            if predicted <= budget:
+                matching = (block_size, matches, predicted)
+                break
+        if matching:
+            break
+    fits = matching is not None
+    if not fits:
+        matching = (10, 8192, estimate_matching(num_images, min(max_num_features, 8192), 10, num_threads))
+    plan["matching"] = {
+        "options": {"block_size": matching[0], "max_num_matches": matching[1]},
+        "predicted_bytes": matching[2],
+        "fits": fits
+    }
+
+    # 3. 增量重建（无直接的内存选项，仅给出预测）
+    predicted = estimate_mapping(num_images, max_num_features)
+    plan["mapping"] = {"options": {}, "predicted_bytes": predicted, "fits": predicted <= budget}
+
+    # 4. 立体匹配：在质量档位上限内选最大尺寸，余量作为缓存
+    #    流式模式下融合与立体匹配同时运行，需同时容纳两者（常驻内存只计一次），缓存各取余量的一半
+    stereo_sizes = [s for s in STEREO_IMAGE_SIZES
+                    if dense_max_image_size <= 0 or (0 < s <= dense_max_image_size)] or [STEREO_IMAGE_SIZES[-1]]
+    cache_shares = 2 if streaming_dense else 1
+
+    def concurrent_fusion(size):
+        if not streaming_dense:
+            return 0
+        return estimate_fusion(estimate_num_dense_points(resolutions, size), 0) - MODEL_COEFFICIENTS["base"]
+
+    stereo = None
+    for size in stereo_sizes:
+        predicted_without_cache = estimate_stereo(resolutions, size, 0) + concurrent_fusion(size)
+        if predicted_without_cache <= budget:
+            cache_gb = float(np.clip((budget - predicted_without_cache) * 0.8 / cache_shares / GB, 1, 32))
+            stereo = (size, cache_gb, estimate_stereo(resolutions, size, cache_gb))
+            break
+    if stereo is None:
+        size = stereo_sizes[-1]
+        stereo = (size, 1.0, estimate_stereo(resolutions, size, 1.0))
+    stereo_size = stereo[0]
+    concurrent = concurrent_fusion(stereo_size) + (stereo[1] * GB if streaming_dense else 0)
+    plan["stereo"] = {
+        "options": {"max_image_size": stereo_size, "cache_size": stereo[1]},
+        "predicted_bytes": stereo[2],
+        "fits": stereo[2] + concurrent <= budget
+    }
+
+    # 5. 深度图融合：缓存取剩余预算（流式模式下与立体匹配平分）
+    num_dense_points = estimate_num_dense_points(resolutions, stereo_size)
+    if streaming_dense:
+        cache_gb = stereo[1]
+    else:
+        fusion_without_cache = estimate_fusion(num_dense_points, 0)
+        cache_gb = float(np.clip((budget - fusion_without_cache) * 0.8 / GB, 1, 32))
+    predicted = estimate_fusion(num_dense_points, cache_gb)
+    plan["fusion"] = {
+        "options": {"max_image_size": stereo_size, "cache_size": cache_gb},
+        "predicted_bytes": predicted,
+        "fits": plan["stereo"]["fits"] if streaming_dense else predicted <= budget
+    }
+
+    # 6. 网格重建：降低八叉树深度
+    meshing = next(((d, estimate_meshing(num_dense_points, d)) for d in POISSON_DEPTHS
+                    if estimate_meshing(num_dense_points, d) <= budget), None)
+    fits = meshing is not None
+    if not fits:
+        meshing = (POISSON_DEPTHS[-1], estimate_meshing(num_dense_points, POISSON_DEPTHS[-1]))
+    plan["meshing"] = {"options": {"depth": meshing[0]}, "predicted_bytes": meshing[1], "fits": fits}
+
+    for stage, entry in plan.items():
+        status = "" if entry["fits"] else "（超出预算）"
+        logging.info(f"内存规划 {stage}: 预测峰值 {entry['predicted_bytes'] / GB:.2f}GB{status}，"
+                     f"选项 {entry['options']}")
+    return plan
+
+def save_memory_report(output_dir, plan, observed_peaks, budget_gb):
+    """
+    保存预测峰值与观测峰值对比，并追加到校准数据文件
+    未安装psutil时观测值为进程历史峰值而非阶段峰值，只写入报告，不追加校准数据
+    """
+    stats_dir = Path(output_dir) / "stats"
+    stats_dir.mkdir(parents=True, exist_ok=True)
+
+    report_file = stats_dir / "memory_plan.txt"
+    calibration_file = stats_dir / "memory_calibration.csv"
+    calibrate = has_current_rss()
+    if not calibrate:
+        logging.warning("未安装psutil，观测峰值为进程历史峰值，不写入memory_calibration.csv")
+    rows = []
+
+    with open(report_file, "w") as report:
+        report.write("===== 内存预算规划 =====\n")
+        report.write(f"内存预算: {budget_gb:.2f}GB\n")
+        if not calibrate:
+            report.write("未安装psutil：观测值为进程历史峰值，不能作为各阶段峰值\n")
+        for stage, entry in plan.items():
+            predicted = entry["predicted_bytes"] / GB
+            observed = observed_peaks.get(stage)
+            observed_text = f"{observed / GB:.2f}GB" if observed is not None else "未观测"
+            report.write(f"{stage}: 预测 {predicted:.2f}GB，观测 {observed_text}，选项 {entry['options']}\n")
+            if observed is not None:
+                rows.append(f"{stage}, {budget_gb:.2f}, {predicted:.3f}, {observed / GB:.3f}")
+                logging.info(f"内存 {stage}: 预测 {predicted:.2f}GB / 观测 {observed / GB:.2f}GB")
+
+    if calibrate and rows:
+        write_header = not calibration_file.exists()
+        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        with open(calibration_file, "a") as calibration:
+            if write_header:
+                calibration.write("timestamp, stage, budget_gb, predicted_gb, observed_gb\n")
+            for row in rows:
+                calibration.write(f"{timestamp}, {row}\n")
+
+    logging.info(f"内存规划报告已保存到: {report_file}")
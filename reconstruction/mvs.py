@@ -2,7 +2,7 @@
 Description: 
 Author: Damocles_lin
 Date: 2025-07-06 16:50:16
-LastEditTime: 2025-07-10 16:44:54
+LastEditTime: 2026-10-19 22:27:16
 LastEditors: Damocles_lin
 '''
 import pycolmap
@@ -11,47 +11,93 @@ import os
 import open3d as o3d
 import numpy as np
 from utils import stats_utils, camera_utils
+from utils.memory_utils import apply_option_overrides
+from .undistortion import undistort_images_sharded
+from .covisibility import compute_source_views
 
-def dense_reconstruction(output_dir, sparse_path, image_path):
-    """执行稠密重建"""
+# 稠密重建质量档位：去畸变图像的最大边长（-1表示保持原始分辨率）
+DENSE_QUALITY_PROFILES = {
+    "low": {"max_image_size": 1000},
+    "medium": {"max_image_size": 1600},
+    "high": {"max_image_size": 2400},
+    "extreme": {"max_image_size": -1}
+}
+
+def dense_reconstruction(output_dir, sparse_path, image_path, quality="high", num_workers=None,
+                         memory_plan=None, memory_monitor=None, max_sources=10):
+    """
+    执行稠密重建
+    memory_plan: 内存规划结果，其中stereo/fusion/meshing阶段的选项会覆盖默认值
+    memory_monitor: 内存监控器，用于记录各子阶段的观测峰值
+    max_sources: 每个参考图像的源图像数量上限（由共视图选取）
+    """
+    memory_plan = memory_plan or {}
     dense_path = os.path.join(output_dir, "dense")
     os.makedirs(dense_path, exist_ok=True)
     
     # 去畸变图像
-    undistort_images(dense_path, sparse_path, image_path)
+    undistort_images(dense_path, sparse_path, image_path, quality=quality, num_workers=num_workers,
+                     max_sources=max_sources)
     
     # 立体匹配
-    stereo_matching(dense_path)
+    if memory_monitor:
+        memory_monitor.start_stage("stereo")
+    stereo_matching(dense_path, memory_plan.get("stereo", {}).get("options"))
+    if memory_monitor:
+        memory_monitor.end_stage("stereo")
     
     # 融合深度图生成稠密点云
+    if memory_monitor:
+        memory_monitor.start_stage("fusion")
     fused_path = os.path.join(dense_path, "fused.ply")
-    fuse_depth_maps(dense_path, fused_path)
+    fuse_depth_maps(dense_path, fused_path, memory_plan.get("fusion", {}).get("options"))
+    if memory_monitor:
+        memory_monitor.end_stage("fusion")
     
     # 保存重建结果
     results_dir = os.path.join(dense_path, "results")
     os.makedirs(results_dir, exist_ok=True)
     
     # 生成网格
+    if memory_monitor:
+        memory_monitor.start_stage("meshing")
     mesh_path = os.path.join(dense_path, "meshed.ply")
-    generate_mesh(fused_path, mesh_path)
+    generate_mesh(fused_path, mesh_path, memory_plan.get("meshing", {}).get("options"))
+    if memory_monitor:
+        memory_monitor.end_stage("meshing")
     
     # 保存重建结果并获取MVS统计信息
     mvs_stats = save_reconstruction_results(results_dir, fused_path, mesh_path)
     
     return mvs_stats
 
-def undistort_images(output_path, input_path, image_path):
-    """去畸变图像"""
-    pycolmap.undistort_images(
+def undistort_images(output_path, input_path, image_path, quality="high", num_workers=None, max_sources=10,
+                     observations=None):
+    """
+    去畸变图像（多进程分片，按质量档位限制输出尺寸），并按共视图写入立体匹配与融合配置
+    observations: 增量重建阶段已收集的稀疏模型观测，给出时不再重新遍历模型
+    """
+    profile = DENSE_QUALITY_PROFILES[quality]
+    undistort_images_sharded(
         output_path=output_path,
         input_path=input_path,
-        image_path=image_path
+        image_path=image_path,
+        max_image_size=profile["max_image_size"],
+        num_workers=num_workers
     )
+    
+    # 仅有共视邻居的图像作为参考图像，使用显式的源图像列表
+    sources = compute_source_views(pycolmap.Reconstruction(input_path), max_sources=max_sources,
+                                   observations=observations)
+    write_patch_match_config(output_path, sorted(sources), sources=sources)
+    write_fusion_config(output_path, sorted(sources))
+    return sources
 
-def stereo_matching(workspace_path):
+def stereo_matching(workspace_path, option_overrides=None):
     """立体匹配"""
     stereo_options = pycolmap.PatchMatchOptions()
     stereo_options.gpu_index = "0"
+    apply_option_overrides(stereo_options, option_overrides)
 
     pycolmap.patch_match_stereo(
         workspace_path=workspace_path,
@@ -59,9 +105,32 @@ def stereo_matching(workspace_path):
         options=stereo_options
     )
 
-def fuse_depth_maps(workspace_path, output_path):
+def write_patch_match_config(workspace_path, ref_image_names, source_spec="__auto__, 20", sources=None):
+    """
+    写入stereo/patch-match.cfg，仅列出的参考图像参与立体匹配
+    sources: {参考图像名: [源图像名, ...]}，给出时为每个参考图像写入显式源图像列表
+    """
+    config_path = os.path.join(workspace_path, "stereo", "patch-match.cfg")
+    os.makedirs(os.path.dirname(config_path), exist_ok=True)
+    with open(config_path, "w") as f:
+        for image_name in ref_image_names:
+            spec = ", ".join(sources[image_name]) if sources is not None else source_spec
+            f.write(f"{image_name}\n{spec}\n")
+    return config_path
+
+def write_fusion_config(workspace_path, image_names):
+    """写入stereo/fusion.cfg，仅列出的图像参与深度图融合"""
+    config_path = os.path.join(workspace_path, "stereo", "fusion.cfg")
+    os.makedirs(os.path.dirname(config_path), exist_ok=True)
+    with open(config_path, "w") as f:
+        for image_name in image_names:
+            f.write(f"{image_name}\n")
+    return config_path
+
+def fuse_depth_maps(workspace_path, output_path, option_overrides=None):
     """融合深度图生成稠密点云"""
     fusion_options = pycolmap.StereoFusionOptions()
+    apply_option_overrides(fusion_options, option_overrides)
     
     pycolmap.stereo_fusion(
         output_path=output_path,
@@ -70,10 +139,11 @@ def fuse_depth_maps(workspace_path, output_path):
         options=fusion_options
     )
 
-def generate_mesh(input_path, output_path):
+def generate_mesh(input_path, output_path, option_overrides=None):
     """生成网格"""
     if os.path.exists(input_path):
-        poisson_options = pycolmap.PoissonMeshingOptions()       
+        poisson_options = pycolmap.PoissonMeshingOptions()
+        apply_option_overrides(poisson_options, option_overrides)
         pycolmap.poisson_meshing(
             input_path=input_path,
             output_path=output_path,
@@ -84,12 +154,19 @@ def generate_mesh(input_path, output_path):
 
 def save_reconstruction_results(results_dir, fused_ply_path, mesh_path):
     """保存重建结果并返回MVS统计信息"""
-    # 初始化统计信息
-    dense_points_count = 0
-    mesh_vertices_count = 0
-    mesh_triangles_count = 0
+    dense_points_count = save_dense_points(results_dir, fused_ply_path)
+    mesh_vertices_count, mesh_triangles_count = save_mesh(results_dir, mesh_path)
     
-    # 保存稠密点云
+    # 返回MVS统计信息
+    return {
+        "dense_points": dense_points_count,
+        "mesh_vertices": mesh_vertices_count,
+        "mesh_triangles": mesh_triangles_count
+    }
+
+def save_dense_points(results_dir, fused_ply_path):
+    """将稠密点云保存为npy，返回点数"""
+    dense_points_count = 0
     if os.path.exists(fused_ply_path):
         pcd = o3d.io.read_point_cloud(fused_ply_path)
         if pcd and len(pcd.points) > 0:
@@ -101,8 +178,12 @@ def save_reconstruction_results(results_dir, fused_ply_path, mesh_path):
             logging.error("读取稠密点云失败或点云为空")
     else:
         logging.error(f"稠密点云文件不存在: {fused_ply_path}")
-    
-    # 保存网格
+    return dense_points_count
+
+def save_mesh(results_dir, mesh_path):
+    """将网格顶点与面片保存为npy，返回 (顶点数, 面片数)"""
+    mesh_vertices_count = 0
+    mesh_triangles_count = 0
     if os.path.exists(mesh_path):
         mesh = o3d.io.read_triangle_mesh(mesh_path)
         if mesh and len(mesh.vertices) > 0:
@@ -117,10 +198,4 @@ def save_reconstruction_results(results_dir, fused_ply_path, mesh_path):
             logging.error("读取网格失败或网格为空")
     else:
         logging.error(f"网格文件不存在: {mesh_path}")
-    
-    # 返回MVS统计信息
-    return {
-        "dense_points": dense_points_count,
-        "mesh_vertices": mesh_vertices_count,
-        "mesh_triangles": mesh_triangles_count
-    }
\ No newline at end of file
+    return mesh_vertices_count, mesh_triangles_count
\ No newline at end of file
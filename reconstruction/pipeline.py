@@ -2,90 +2,48 @@
 Description: 
 Author: Damocles_lin
 Date: 2025-07-06 16:50:16
-LastEditTime: 2025-07-10 16:46:43
+LastEditTime: 2026-10-19 22:27:16
 LastEditors: Damocles_lin
 '''
 import os
+import time
 import logging
+import functools
 import numpy as np
 from pathlib import Path
 import pycolmap
 from utils import logging_utils, timer, stats_utils, camera_utils
-from .sfm import extract_features, match_features, incremental_reconstruction
-from .mvs import dense_reconstruction
+from utils.memory_utils import MemoryMonitor
+from .sfm import (extract_features, extract_features_sharded, match_features, match_features_scheduled,
+                  incremental_reconstruction, list_image_files, read_image_resolutions,
+                  get_total_keypoints, get_matching_stats, calculate_sfm_stats)
+from .mvs import (DENSE_QUALITY_PROFILES, undistort_images, stereo_matching, fuse_depth_maps,
+                  generate_mesh, save_dense_points, save_mesh)
+from .matching import read_image_ids
+from .analytics import collect_observations
+from .spatial_query import build_results_index
+from .triage import triage_images, load_selection
+from .streaming_dense import streaming_dense_reconstruction
+from .memory_planner import plan_memory_budget, save_memory_report
+from .stage_graph import Stage, StageGraph
 
-def run_colmap_pipeline(image_dir, output_dir):
-    # 初始化计时器
-    timer_obj = timer.Timer()
-    
-    # 配置日志
-    log_file = logging_utils.configure_logging(output_dir)
-    logging.info(f"开始COLMAP处理流程，图像目录: {image_dir}, 输出目录: {output_dir}")
-    
-    # 创建输出目录
-    output_path = Path(output_dir)
-    output_path.mkdir(parents=True, exist_ok=True)
-    
-    # 确保目录存在
-    image_dir = Path(image_dir)
-    if not image_dir.exists():
-        logging.error(f"图像目录不存在: {image_dir}")
-        return
-    
-    # 1. 特征提取
-    database_path = str(output_path / "database.db")
-    image_path = str(image_dir)
-    
-    timer_obj.start("特征提取")
-    image_stats = extract_features(image_dir, database_path)
-    if not image_stats:
-        return
-    timer_obj.end()
-    
-    # 2. 特征匹配
-    timer_obj.start("特征匹配")
-    match_stats = match_features(database_path)
-    if not match_stats:
-        return
-    timer_obj.end()
+# 流程阶段名称（--from/--to可选值），按依赖顺序排列
+# streaming_dense仅在流式稠密模式下存在，替代undistortion、stereo与fusion三个阶段
+PIPELINE_STAGES = [
+    "triage", "extraction", "matching", "mapping", "export_sparse", "camera_summary", "undistortion",
+    "stereo", "fusion", "streaming_dense", "meshing", "dense_results", "mesh_results", "spatial_index",
+    "overall_stats"
+]
 
-    # 3. 增量重建
-    sparse_path = str(output_path / "sparse")
-    os.makedirs(sparse_path, exist_ok=True)
-    
-    timer_obj.start("增量重建")
-    result = incremental_reconstruction(
-        database_path, 
-        image_path, 
-        sparse_path,
-        image_stats,
-        match_stats
-    )
-    if not result:
-        return
-    reconstruction, sfm_stats = result
-    timer_obj.end()
-
-    # 4. 稠密重建
-    timer_obj.start("稠密重建")
-    mvs_stats = dense_reconstruction(output_dir, os.path.join(sparse_path, "0"), image_path)
-    timer_obj.end()
-
-    # 5. 保存重建结果
-    timer_obj.start("保存重建结果")
-    
-    # 保存稀疏重建结果
-    results_dir = os.path.join(output_dir, "dense", "results")
+def save_sparse_results(reconstruction, results_dir):
+    """保存稀疏点云、相机参数和图像位姿"""
     os.makedirs(results_dir, exist_ok=True)
-    
+
     # 保存稀疏点云
-    sparse_points = []
-    for point3D_id, point3D in reconstruction.points3D.items():
-        sparse_points.append([point3D.xyz[0], point3D.xyz[1], point3D.xyz[2]])
-    sparse_points = np.array(sparse_points)
+    sparse_points = np.array([point3D.xyz for point3D in reconstruction.points3D.values()]).reshape(-1, 3)
     np.save(os.path.join(results_dir, "sparse_points.npy"), sparse_points)
     logging.info(f"保存稀疏点云: {sparse_points.shape[0]}个点")
-    
+
     # 保存相机参数
     cameras = {}
     for camera_id, camera in reconstruction.cameras.items():
@@ -97,7 +55,7 @@ def run_colmap_pipeline(image_dir, output_dir):
         }
     np.save(os.path.join(results_dir, "cameras.npy"), cameras)
     logging.info(f"保存{len(cameras)}个相机参数")
-    
+
     # 保存图像位姿
     poses = {}
     for image_id, image in reconstruction.images.items():
@@ -112,23 +70,341 @@ def run_colmap_pipeline(image_dir, output_dir):
         }
     np.save(os.path.join(results_dir, "poses.npy"), poses)
     logging.info(f"保存{len(poses)}个相机位姿")
-    
-    # 打印相机示例
-    camera_utils.print_camera_example(results_dir)
-
-    timer_obj.end()
-    
-    # 记录并保存计时摘要
-    summary = timer_obj.log_summary()
+
+def build_pipeline_graph(image_dir, output_dir, quality="high", num_workers=None, memory_plan=None,
+                         memory_monitor=None, extraction_shards=1, matching_workers=0, streaming_dense=False,
+                         max_source_images=10, triage=False, duplicate_threshold=6, blur_ratio=0.3):
+    """
+    构建三维重建流程的阶段依赖图，每个阶段声明其输入与输出数据
+    streaming_dense: 以单个流式阶段替代去畸变、立体匹配与融合之间的阶段级屏障
+    max_source_images: 每个参考图像的源图像数量上限（由共视图选取）
+    triage: 特征提取前剔除近重复帧（dHash汉明距离不超过duplicate_threshold）与模糊图像（清晰度低于blur_ratio×中位数）
+    """
+    memory_plan = memory_plan or {}
+    output_path = Path(output_dir)
+    image_path = str(image_dir)
+    database_path = str(output_path / "database.db")
+    sparse_path = str(output_path / "sparse")
+    sparse_model_path = os.path.join(sparse_path, "0")
+    dense_path = os.path.join(output_dir, "dense")
+    results_dir = os.path.join(dense_path, "results")
+    fused_path = os.path.join(dense_path, "fused.ply")
+    mesh_path = os.path.join(dense_path, "meshed.ply")
+
+    def stage_options(stage):
+        return memory_plan.get(stage, {}).get("options")
+
+    def tracked(stage, verbosity):
+        """阶段函数装饰器：切换pycolmap日志级别，并记录该阶段运行期间的内存峰值"""
+        def decorate(func):
+            @functools.wraps(func)
+            def wrapper(**kwargs):
+                logging_utils.set_stage_verbosity(verbosity)
+                monitored = memory_monitor is not None and stage in memory_plan
+                if monitored:
+                    memory_monitor.start_stage(stage)
+                try:
+                    return func(**kwargs)
+                finally:
+                    if monitored:
+                        memory_monitor.end_stage(stage)
+            return wrapper
+        return decorate
+
+    # 0. 图像筛选（未启用时选中全部图像）
+    def run_triage():
+        image_files = list_image_files(image_dir)
+        if not triage:
+            return {"image_selection": {"input_images": len(image_files),
+                                        "image_names": sorted(f.name for f in image_files)}}
+        selection = triage_images(image_files, output_dir, duplicate_threshold=duplicate_threshold,
+                                  blur_ratio=blur_ratio, num_workers=num_workers)
+        return {"image_selection": selection}
+
+    def load_triage(data):
+        image_files = list_image_files(image_dir)
+        selected = load_selection(output_dir) if triage else None
+        if selected is None:
+            selected = sorted(f.name for f in image_files)
+        return {"image_selection": {"input_images": len(image_files), "image_names": selected}}
+
+    # 1. 特征提取
+    @tracked("extraction", "extraction")
+    def run_extraction(image_selection):
+        image_names = image_selection["image_names"]
+        if extraction_shards > 1:
+            image_stats = extract_features_sharded(image_dir, database_path, extraction_shards,
+                                                   option_overrides=stage_options("extraction"),
+                                                   image_names=image_names)
+        else:
+            image_stats = extract_features(image_dir, database_path, image_names=image_names,
+                                           option_overrides=stage_options("extraction"))
+        if not image_stats:
+            return None
+        image_stats["input_images"] = image_selection["input_images"]
+        return {"image_stats": image_stats}
+
+    def load_extraction(data):
+        if not os.path.exists(database_path):
+            return None
+        image_files = list_image_files(image_dir, read_image_ids(database_path))
+        return {"image_stats": {
+            "input_images": data["image_selection"]["input_images"],
+            "total_images": len(image_files),
+            "image_resolutions": read_image_resolutions(image_files),
+            "total_keypoints": get_total_keypoints(database_path)
+        }}
+
+    # 2. 特征匹配
+    @tracked("matching", "matching")
+    def run_matching(image_stats):
+        if matching_workers > 0:
+            match_stats = match_features_scheduled(database_path, num_workers=matching_workers,
+                                                   option_overrides=stage_options("matching"))
+        else:
+            match_stats = match_features(database_path, option_overrides=stage_options("matching"))
+        return {"match_stats": match_stats} if match_stats else None
+
+    def load_matching(data):
+        if not os.path.exists(database_path):
+            return None
+        match_stats = get_matching_stats(database_path)
+        return {"match_stats": match_stats} if match_stats else None
+
+    # 3. 增量重建
+    @tracked("mapping", "mapping")
+    def run_mapping(image_stats, match_stats):
+        os.makedirs(sparse_path, exist_ok=True)
+        result = incremental_reconstruction(database_path, image_path, sparse_path, image_stats, match_stats)
+        if not result:
+            return None
+        reconstruction, sfm_stats, observations = result
+        return {"reconstruction": reconstruction, "sfm_stats": sfm_stats, "observations": observations}
+
+    def load_mapping(data):
+        if not os.path.exists(sparse_model_path):
+            return None
+        reconstruction = pycolmap.Reconstruction(sparse_model_path)
+        sfm_stats = calculate_sfm_stats(reconstruction)
+        for key in ("image_stats", "match_stats"):
+            sfm_stats.update({k: v for k, v in data.get(key, {}).items() if k != "per_image_matches"})
+        return {"reconstruction": reconstruction, "sfm_stats": sfm_stats,
+                "observations": collect_observations(reconstruction)}
+
+    # 4. 稀疏结果导出与相机摘要（与稠密重建并行）
+    def run_export_sparse(reconstruction):
+        save_sparse_results(reconstruction, results_dir)
+        return {"sparse_results": results_dir}
+
+    def load_export_sparse(data):
+        exists = os.path.exists(os.path.join(results_dir, "poses.npy"))
+        return {"sparse_results": results_dir} if exists else None
+
+    def run_camera_summary(sparse_results):
+        camera_utils.print_camera_example(sparse_results)
+        return {"camera_summary": os.path.join(sparse_results, "cameras_poses_summary.txt")}
+
+    # 5. 稠密重建各子阶段
+    @tracked("undistortion", "dense")
+    def run_undistortion(reconstruction, observations):
+        os.makedirs(dense_path, exist_ok=True)
+        undistort_images(dense_path, sparse_model_path, image_path, quality=quality, num_workers=num_workers,
+                         max_sources=max_source_images, observations=observations)
+        return {"dense_workspace": dense_path}
+
+    def load_undistortion(data):
+        exists = os.path.isdir(os.path.join(dense_path, "sparse"))
+        return {"dense_workspace": dense_path} if exists else None
+
+    @tracked("stereo", "dense")
+    def run_stereo(dense_workspace):
+        stereo_matching(dense_workspace, stage_options("stereo"))
+        return {"depth_maps": os.path.join(dense_workspace, "stereo", "depth_maps")}
+
+    def load_stereo(data):
+        depth_maps = os.path.join(dense_path, "stereo", "depth_maps")
+        return {"depth_maps": depth_maps} if os.path.isdir(depth_maps) else None
+
+    @tracked("fusion", "dense")
+    def run_fusion(depth_maps):
+        fuse_depth_maps(dense_path, fused_path, stage_options("fusion"))
+        return {"fused_ply": fused_path}
+
+    def load_fusion(data):
+        return {"fused_ply": fused_path} if os.path.exists(fused_path) else None
+
+    @tracked("stereo", "dense")
+    def run_streaming_dense(reconstruction, observations):
+        os.makedirs(dense_path, exist_ok=True)
+        stats = streaming_dense_reconstruction(output_dir, sparse_model_path, image_path, quality=quality,
+                                               num_workers=num_workers, memory_plan=memory_plan,
+                                               max_sources=max_source_images, observations=observations)
+        if not os.path.exists(fused_path):
+            return None
+        first_points = stats["time_to_first_points"]
+        logging.info(f"流式稠密重建: 首批稠密点耗时 "
+                     f"{f'{first_points:.2f}秒' if first_points is not None else '未生成'}，"
+                     f"总耗时 {stats['wall_time']:.2f}秒")
+        return {"dense_workspace": dense_path, "depth_maps": os.path.join(dense_path, "stereo", "depth_maps"),
+                "fused_ply": fused_path}
+
+    def load_streaming_dense(data):
+        loaded = [load(data) for load in (load_undistortion, load_stereo, load_fusion)]
+        if any(part is None for part in loaded):
+            return None
+        return {k: v for part in loaded for k, v in part.items()}
+
+    @tracked("meshing", "dense")
+    def run_meshing(fused_ply):
+        generate_mesh(fused_ply, mesh_path, stage_options("meshing"))
+        return {"mesh_ply": mesh_path}
+
+    def load_meshing(data):
+        return {"mesh_ply": mesh_path} if os.path.exists(mesh_path) else None
+
+    # 6. 结果转换（点云转换与网格重建并行）
+    def run_dense_results(fused_ply):
+        os.makedirs(results_dir, exist_ok=True)
+        return {"dense_stats": {"dense_points": save_dense_points(results_dir, fused_ply)}}
+
+    def load_dense_results(data):
+        dense_points_path = os.path.join(results_dir, "dense_points.npy")
+        if not os.path.exists(dense_points_path):
+            return None
+        return {"dense_stats": {"dense_points": np.load(dense_points_path, mmap_mode="r").shape[0]}}
+
+    def run_mesh_results(mesh_ply):
+        os.makedirs(results_dir, exist_ok=True)
+        vertices, triangles = save_mesh(results_dir, mesh_ply)
+        return {"mesh_stats": {"mesh_vertices": vertices, "mesh_triangles": triangles}}
+
+    def load_mesh_results(data):
+        vertices_path = os.path.join(results_dir, "mesh_vertices.npy")
+        triangles_path = os.path.join(results_dir, "mesh_triangles.npy")
+        if not os.path.exists(vertices_path) or not os.path.exists(triangles_path):
+            return None
+        return {"mesh_stats": {
+            "mesh_vertices": np.load(vertices_path, mmap_mode="r").shape[0],
+            "mesh_triangles": np.load(triangles_path, mmap_mode="r").shape[0]
+        }}
+
+    # 7. 结果空间索引（供下游服务按包围盒/半径/近邻查询，不必加载完整点云）
+    def run_spatial_index(sparse_results, dense_stats, mesh_stats):
+        indexes = build_results_index(results_dir)
+        return {"spatial_index": {name: len(index) for name, index in indexes.items()}}
+
+    # 8. 整体统计
+    def run_overall_stats(sfm_stats, dense_stats, mesh_stats):
+        mvs_stats = dict(dense_stats, **mesh_stats)
+        stats_utils.save_overall_stats(output_dir, sfm_stats, mvs_stats)
+        return {"mvs_stats": mvs_stats}
+
+    if streaming_dense:
+        dense_stages = [
+            Stage("streaming_dense", run_streaming_dense, ("reconstruction", "observations"),
+                  ("dense_workspace", "depth_maps", "fused_ply"), "流式稠密重建", load=load_streaming_dense)
+        ]
+    else:
+        dense_stages = [
+            Stage("undistortion", run_undistortion, ("reconstruction", "observations"), ("dense_workspace",),
+                  "图像去畸变", load=load_undistortion),
+            Stage("stereo", run_stereo, ("dense_workspace",), ("depth_maps",), "立体匹配", load=load_stereo),
+            Stage("fusion", run_fusion, ("depth_maps",), ("fused_ply",), "深度图融合", load=load_fusion)
+        ]
+
+    return StageGraph([
+        Stage("triage", run_triage, (), ("image_selection",), "图像筛选", load=load_triage),
+        Stage("extraction", run_extraction, ("image_selection",), ("image_stats",), "特征提取",
+              load=load_extraction),
+        Stage("matching", run_matching, ("image_stats",), ("match_stats",), "特征匹配", load=load_matching),
+        Stage("mapping", run_mapping, ("image_stats", "match_stats"),
+              ("reconstruction", "sfm_stats", "observations"), "增量重建", load=load_mapping),
+        Stage("export_sparse", run_export_sparse, ("reconstruction",), ("sparse_results",),
+              "保存稀疏结果", load=load_export_sparse),
+        Stage("camera_summary", run_camera_summary, ("sparse_results",), ("camera_summary",), "相机位姿摘要"),
+        *dense_stages,
+        Stage("meshing", run_meshing, ("fused_ply",), ("mesh_ply",), "网格重建", load=load_meshing),
+        Stage("dense_results", run_dense_results, ("fused_ply",), ("dense_stats",),
+              "保存稠密点云", load=load_dense_results),
+        Stage("mesh_results", run_mesh_results, ("mesh_ply",), ("mesh_stats",), "保存网格", load=load_mesh_results),
+        Stage("spatial_index", run_spatial_index, ("sparse_results", "dense_stats", "mesh_stats"),
+              ("spatial_index",), "构建空间索引"),
+        Stage("overall_stats", run_overall_stats, ("sfm_stats", "dense_stats", "mesh_stats"), ("mvs_stats",),
+              "保存统计信息")
+    ])
+
+def run_colmap_pipeline(image_dir, output_dir, quality="high", num_workers=None, memory_budget_gb=None,
+                        extraction_shards=1, matching_workers=0, from_stage=None, to_stage=None,
+                        max_parallel_stages=4, streaming_dense=False, max_source_images=10,
+                        triage=False, duplicate_threshold=6, blur_ratio=0.3):
+    # 初始化计时器
+    timer_obj = timer.Timer()
+    wall_start = time.time()
+
+    # 配置日志
+    log_file = logging_utils.configure_logging(output_dir)
+    logging.info(f"开始COLMAP处理流程，图像目录: {image_dir}, 输出目录: {output_dir}")
+
+    # 创建输出目录
+    output_path = Path(output_dir)
+    output_path.mkdir(parents=True, exist_ok=True)
+
+    # 确保目录存在
+    image_dir = Path(image_dir)
+    if not image_dir.exists():
+        logging.error(f"图像目录不存在: {image_dir}")
+        return
+
+    # 0. 内存预算规划（在任何处理开始之前）
+    memory_plan = {}
+    memory_monitor = None
+    if memory_budget_gb:
+        image_resolutions = read_image_resolutions(list_image_files(image_dir))
+        memory_plan = plan_memory_budget(
+            image_resolutions, memory_budget_gb, num_threads=num_workers,
+            dense_max_image_size=DENSE_QUALITY_PROFILES[quality]["max_image_size"],
+            extraction_shards=extraction_shards, streaming_dense=streaming_dense
+        )
+        memory_monitor = MemoryMonitor()
+        memory_monitor.start()
+
+    # 按依赖图调度各阶段，相互独立的阶段并发执行
+    graph = build_pipeline_graph(image_dir, output_dir, quality=quality, num_workers=num_workers,
+                                 memory_plan=memory_plan, memory_monitor=memory_monitor,
+                                 extraction_shards=extraction_shards, matching_workers=matching_workers,
+                                 streaming_dense=streaming_dense, max_source_images=max_source_images,
+                                 triage=triage, duplicate_threshold=duplicate_threshold, blur_ratio=blur_ratio)
+    # 起止阶段需存在于实际构建的依赖图中（流式模式与常规模式的阶段不同）
+    invalid = [name for name in (from_stage, to_stage) if name is not None and name not in graph.stages]
+    if invalid:
+        logging.error(f"当前流程中不存在阶段: {', '.join(invalid)}，可选: {', '.join(graph.order)}")
+        if memory_monitor:
+            memory_monitor.stop()
+        return
+    data, durations, critical_path = graph.run(from_stage=from_stage, to_stage=to_stage,
+                                               max_workers=max_parallel_stages, timer=timer_obj)
+
+    if memory_monitor:
+        memory_monitor.stop()
+    if data is None:
+        logging.error("处理流程中止")
+        return
+
+    # 记录并保存计时摘要（含关键路径与实际墙钟耗时）
+    extra_lines = graph.format_critical_path(critical_path)
+    extra_lines.append(f"实际墙钟耗时: {time.time() - wall_start:.2f}秒")
+    extra_lines.extend(logging_utils.format_log_stats())
+    summary = timer_obj.log_summary(extra_lines=extra_lines)
     stats_utils.save_timing_summary(output_dir, summary)
-    
-    # 保存整体统计信息
-    stats_utils.save_overall_stats(output_dir, sfm_stats, mvs_stats)
-    
+
+    # 保存内存预测与观测峰值对比
+    if memory_monitor:
+        save_memory_report(output_dir, memory_plan, memory_monitor.stage_peaks, memory_budget_gb)
+
     logging.info(f"处理流程完成！日志已保存到: {log_file}")
-    
+
     # 返回统计信息
     return {
-        "sfm_stats": sfm_stats,
-        "mvs_stats": mvs_stats
-    }
\ No newline at end of file
+        "sfm_stats": data.get("sfm_stats"),
+        "mvs_stats": data.get("mvs_stats")
+    }
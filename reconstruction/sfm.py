@@ -2,7 +2,7 @@
 Description: 
 Author: Damocles_lin
 Date: 2025-07-06 16:50:16
-LastEditTime: 2025-07-13 17:18:14
+LastEditTime: 2026-10-19 22:27:16
 LastEditors: Damocles_lin
 '''
 import pycolmap
@@ -10,28 +10,30 @@ import numpy as np
 import logging
 import os
 import sqlite3
+import time
+import multiprocessing
 from pathlib import Path
-from utils import stats_utils
+from concurrent.futures import ProcessPoolExecutor
+from utils import stats_utils, logging_utils
+from utils.memory_utils import apply_option_overrides
+from .database_merge import merge_databases
+from .matching import read_image_ids, tile_image_pairs, tile_pair_list, match_blocks_scheduled
+from .analytics import (collect_observations, compute_track_analytics, find_outlier_tracks,
+                        export_outlier_tracks, filter_outlier_tracks)
 
-def extract_features(image_dir, database_path, device=pycolmap.Device.cuda):
-    """特征提取，返回图像信息和特征点统计"""
-    # 特征提取选项
-    sift_options = pycolmap.SiftExtractionOptions()
-    sift_options.num_threads = -1
-    sift_options.use_gpu = True
-    sift_options.gpu_index = "0"
-    
-    if not sift_options.check():
-        logging.error("特征提取选项无效！")
-        return None
-    
-    # 获取图像列表
+IMAGE_EXTENSIONS = ['.jpg', '.jpeg', '.png']  # 支持的图像格式
+
+def list_image_files(image_dir, image_names=None):
+    """获取图像目录下支持格式的图像文件（image_names为空时返回全部）"""
     image_dir = Path(image_dir)
-    image_files = [f for f in image_dir.iterdir() if f.is_file() and f.suffix.lower() in ['.jpg', '.jpeg', '.png']]
-    image_names = [f.name for f in image_files]
-    total_images = len(image_names)
-    
-    # 记录图像分辨率
+    image_files = [f for f in image_dir.iterdir() if f.is_file() and f.suffix.lower() in IMAGE_EXTENSIONS]
+    if image_names is not None:
+        selected_names = set(image_names)
+        image_files = [f for f in image_files if f.name in selected_names]
+    return image_files
+
+def read_image_resolutions(image_files):
+    """读取图像分辨率（仅解析文件头），返回 {图像名: (宽, 高)}"""
     image_resolutions = {}
     try:
         # 使用Pillow获取图像分辨率
@@ -62,6 +64,41 @@ def extract_features(image_dir, database_path, device=pycolmap.Device.cuda):
         for img_file in image_files:
             image_resolutions[img_file.name] = (0, 0)
     
+    return image_resolutions
+
+def build_extraction_options(option_overrides=None):
+    """构建特征提取选项，选项无效时返回None"""
+    sift_options = pycolmap.SiftExtractionOptions()
+    sift_options.num_threads = -1
+    sift_options.use_gpu = True
+    sift_options.gpu_index = "0"
+    apply_option_overrides(sift_options, option_overrides)
+    
+    if not sift_options.check():
+        logging.error("特征提取选项无效！")
+        return None
+    return sift_options
+
+def extract_features(image_dir, database_path, device=pycolmap.Device.cuda, image_names=None,
+                     option_overrides=None):
+    """
+    特征提取，返回图像信息和特征点统计（image_names为空时处理目录下全部图像）
+    option_overrides: 覆盖SiftExtractionOptions的字段，如内存规划得到的max_image_size
+    """
+    # 特征提取选项
+    sift_options = build_extraction_options(option_overrides)
+    if sift_options is None:
+        return None
+    
+    # 获取图像列表
+    image_dir = Path(image_dir)
+    image_files = list_image_files(image_dir, image_names)
+    image_names = [f.name for f in image_files]
+    total_images = len(image_names)
+    
+    # 记录图像分辨率
+    image_resolutions = read_image_resolutions(image_files)
+    
     logging.info(f"找到 {total_images} 张图像进行处理")    
     
     # 调用特征提取函数
@@ -83,6 +120,88 @@ def extract_features(image_dir, database_path, device=pycolmap.Device.cuda):
         "total_keypoints": total_keypoints
     }
 
+def _extract_shard(shard_index, image_dir, shard_database_path, image_names, device_name, option_overrides):
+    """工作进程：将一个分片的图像提取到独立的分片数据库，返回吞吐统计"""
+    start = time.time()
+    device = pycolmap.Device.__members__[device_name]
+    if os.path.exists(shard_database_path):
+        os.remove(shard_database_path)
+    sift_options = build_extraction_options(option_overrides)
+    if sift_options is None:
+        return None
+    pycolmap.extract_features(
+        database_path=shard_database_path,
+        image_path=str(image_dir),
+        image_names=image_names,
+        camera_mode=pycolmap.CameraMode.AUTO,
+        sift_options=sift_options,
+        device=device
+    )
+    conn = sqlite3.connect(shard_database_path)
+    try:
+        num_keypoints = conn.execute("SELECT COALESCE(SUM(rows), 0) FROM keypoints").fetchone()[0]
+    finally:
+        conn.close()
+    return {
+        "name": f"shard_{shard_index}",
+        "items": len(image_names),
+        "keypoints": num_keypoints,
+        "elapsed": time.time() - start
+    }
+
+def extract_features_sharded(image_dir, database_path, num_shards, device=pycolmap.Device.cuda,
+                             option_overrides=None, image_names=None):
+    """
+    分片特征提取：图像列表按分片分配给多个工作进程，各自写入分片数据库，
+    最后合并为一个COLMAP数据库（图像与相机ID统一重新编号）
+    本地工作进程可替代多台机器/容器，分片数据库位于 <输出目录>/shards/
+    """
+    image_dir = Path(image_dir)
+    image_files = sorted(list_image_files(image_dir, image_names), key=lambda f: f.name)
+    image_names = [f.name for f in image_files]
+    total_images = len(image_names)
+    image_resolutions = read_image_resolutions(image_files)
+    
+    num_shards = max(1, min(num_shards, total_images))
+    # 按文件名连续分段，同一采集序列尽量落在同一分片以共享相机
+    bounds = np.linspace(0, total_images, num_shards + 1).astype(int)
+    shard_names = [image_names[bounds[i]:bounds[i + 1]] for i in range(num_shards)]
+    shard_dir = os.path.join(os.path.dirname(database_path), "shards")
+    os.makedirs(shard_dir, exist_ok=True)
+    shard_paths = [os.path.join(shard_dir, f"database_{i}.db") for i in range(num_shards)]
+    logging.info(f"找到 {total_images} 张图像，分为 {num_shards} 个分片进行特征提取")
+    # 各分片同时运行：未给出线程数时按分片数均分CPU（内存规划给出的线程数已是单个分片的）
+    option_overrides = dict(option_overrides or {})
+    option_overrides.setdefault("num_threads", max(1, (os.cpu_count() or 1) // num_shards))
+    
+    # 使用spawn启动工作进程，避免GPU上下文在fork后失效
+    context = multiprocessing.get_context("spawn")
+    records = []
+    with ProcessPoolExecutor(max_workers=num_shards, mp_context=context,
+                             initializer=logging_utils.init_worker_logging,
+                             initargs=(logging_utils.get_log_queue(),)) as executor:
+        futures = [executor.submit(_extract_shard, i, str(image_dir), shard_paths[i], shard_names[i],
+                                   device.name, option_overrides)
+                   for i in range(num_shards)]
+        for future in futures:
+            record = future.result()
+            if record is None:
+                logging.error("分片特征提取失败！")
+                return None
+            records.append(record)
+            logging.info(f"{record['name']}: {record['items']} 张图像，{record['keypoints']} 个特征点，"
+                         f"{record['items'] / max(record['elapsed'], 1e-6):.2f} 张/秒")
+    stats_utils.save_worker_throughput(os.path.dirname(database_path), "extraction_shards.txt",
+                                       "分片特征提取吞吐", records, unit="张")
+    
+    merge_databases(shard_paths, database_path)
+    
+    return {
+        "total_images": total_images,
+        "image_resolutions": image_resolutions,
+        "total_keypoints": get_total_keypoints(database_path)
+    }
+
 def get_total_keypoints(database_path):
     """从数据库获取总特征点数量，并将每张图片的特征点数量输出到文本文件"""
     try:
@@ -116,14 +235,18 @@ def get_total_keypoints(database_path):
         logging.error(f"获取特征点统计失败: {str(e)}")
         return 0
 
-def match_features(database_path, device=pycolmap.Device.cuda):
-    """特征匹配，返回匹配统计信息"""
+def match_features(database_path, device=pycolmap.Device.cuda, option_overrides=None):
+    """特征匹配，返回匹配统计信息（option_overrides可包含max_num_matches、block_size）"""
+    option_overrides = dict(option_overrides or {})
     sift_matcher_options = pycolmap.SiftMatchingOptions()
     sift_matcher_options.num_threads = -1
     sift_matcher_options.use_gpu = True
     sift_matcher_options.gpu_index = "0"
     
     exhaustive_options = pycolmap.ExhaustiveMatchingOptions()
+    if "block_size" in option_overrides:
+        exhaustive_options.block_size = option_overrides.pop("block_size")
+    apply_option_overrides(sift_matcher_options, option_overrides)
     verification_options = pycolmap.TwoViewGeometryOptions()
     
     if not sift_matcher_options.check():
@@ -141,6 +264,30 @@ def match_features(database_path, device=pycolmap.Device.cuda):
     # 获取匹配统计
     return get_matching_stats(database_path)
 
+def match_features_scheduled(database_path, block_size=50, num_workers=None, image_pairs=None,
+                             device=pycolmap.Device.cuda, option_overrides=None):
+    """
+    可恢复的分块特征匹配：将图像对矩阵（或候选图像对列表）切分为分块，
+    由多个工作进程分别以COLMAP匹配器匹配各分块的图像对列表，进度记录在database.db中，
+    中断后重新运行会跳过已完成的分块（option_overrides同match_features）
+    """
+    option_overrides = dict(option_overrides or {})
+    block_size = option_overrides.pop("block_size", block_size)
+    if image_pairs is None:
+        image_ids = sorted(read_image_ids(database_path).values())
+        blocks = tile_image_pairs(image_ids, block_size)
+    else:
+        blocks = tile_pair_list(image_pairs, block_size)
+    
+    worker_stats = match_blocks_scheduled(database_path, blocks, num_workers=num_workers,
+                                          option_overrides=option_overrides, device_name=device.name)
+    if worker_stats:
+        stats_utils.save_worker_throughput(os.path.dirname(database_path), "matching_workers.txt",
+                                           "分块匹配吞吐", worker_stats, unit="对")
+    
+    # 获取匹配统计
+    return get_matching_stats(database_path)
+
 def get_matching_stats(database_path):
     """从数据库获取匹配统计信息（使用正确的COLMAP数据库模式）"""
     try:
@@ -206,8 +353,12 @@ def get_matching_stats(database_path):
         logging.error(f"获取匹配统计失败: {str(e)}")
         return None
 
-def incremental_reconstruction(database_path, image_path, output_path, image_stats, match_stats):
-    """增量重建"""
+def incremental_reconstruction(database_path, image_path, output_path, image_stats, match_stats,
+                               filter_outliers=False):
+    """
+    增量重建（filter_outliers为True时删除异常轨迹后再保存模型）
+    返回 (重建模型, SfM统计, 模型观测)，观测供后续共视图与源图像选取复用
+    """
     mapper_options = pycolmap.IncrementalPipelineOptions()
     
     reconstructions = pycolmap.incremental_mapping(
@@ -223,13 +374,32 @@ def incremental_reconstruction(database_path, image_path, output_path, image_sta
     
     # 取第一个重建模型
     reconstruction = list(reconstructions.values())[0]
+    
+    # 批量分析重投影误差与轨迹，导出异常轨迹
+    observations = collect_observations(reconstruction)
+    analytics = compute_track_analytics(observations)
+    outlier_mask = find_outlier_tracks(analytics)
+    stats_dir = os.path.join(os.path.dirname(output_path), "stats")
+    os.makedirs(stats_dir, exist_ok=True)
+    export_outlier_tracks(os.path.join(stats_dir, "outlier_tracks.npz"), analytics, outlier_mask)
+    stats_utils.save_track_analytics(os.path.dirname(output_path), analytics)
+    if filter_outliers:
+        filter_outlier_tracks(reconstruction, analytics, outlier_mask)
+        observations = collect_observations(reconstruction)
+    
     reconstruction.write(output_path)
     
     # 计算SfM统计信息
     sfm_stats = calculate_sfm_stats(reconstruction)
+    sfm_stats.update({
+        "median_reprojection_error": analytics["median_error"],
+        "mean_track_length": float(analytics["track_length"].mean()) if len(analytics["track_length"]) else 0.0,
+        "outlier_tracks": int(outlier_mask.sum())
+    })
     
     # 添加图像和匹配统计
     sfm_stats.update({
+        "input_images": image_stats.get("input_images", image_stats["total_images"]),
         "total_images": image_stats["total_images"],
         "image_resolutions": image_stats["image_resolutions"],
         "total_keypoints": image_stats["total_keypoints"],
@@ -244,7 +414,7 @@ def incremental_reconstruction(database_path, image_path, output_path, image_sta
     # 保存统计信息
     stats_utils.save_sfm_stats(os.path.dirname(output_path), sfm_stats)
     
-    return reconstruction, sfm_stats
+    return reconstruction, sfm_stats, observations
 
 def calculate_sfm_stats(reconstruction):
     """计算SfM统计信息"""
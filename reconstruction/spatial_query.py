@@ -0,0 +1,307 @@
+'''
+Description: 重建结果的空间查询：持久化体素哈希索引，内存映射读取点数据
+Author: Damocles_lin
+Date: 2026-10-19 18:34:12
+LastEditTime: 2026-10-19 18:34:12
+LastEditors: Damocles_lin
+'''
+import os
+import json
+import time
+import logging
+import numpy as np
+from utils import stats_utils
+from utils.camera_utils import stack_intrinsics
+
+INDEX_DIR_NAME = "spatial_index"
+RESULT_ARRAYS = ("dense_points", "mesh_vertices", "sparse_points")
+CELL_BITS = 21                    # 每个坐标轴的体素索引位数，三轴合并为一个int64键
+MAX_ENUMERATED_CELLS = 1 << 20    # 查询范围内的候选体素数超过该值时改为扫描全部非空体素
+BUILD_CHUNK_SIZE = 10_000_000     # 构建索引时每次处理的点数
+
+def encode_cells(coords):
+    """体素坐标 (N,3) 打包为int64键"""
+    coords = coords.astype(np.int64)
+    return (coords[:, 0] << (2 * CELL_BITS)) | (coords[:, 1] << CELL_BITS) | coords[:, 2]
+
+def decode_cells(keys):
+    """int64键解包为体素坐标 (N,3)"""
+    mask = (1 << CELL_BITS) - 1
+    return np.stack([(keys >> (2 * CELL_BITS)) & mask, (keys >> CELL_BITS) & mask, keys & mask], axis=1)
+
+def _source_signature(points_path):
+    stat = os.stat(points_path)
+    return {"size": stat.st_size, "mtime": stat.st_mtime}
+
+def _concat_ranges(starts, ends):
+    """将若干 [start, end) 区间展开为连续的下标数组"""
+    lengths = ends - starts
+    total = int(lengths.sum())
+    if total == 0:
+        return np.zeros(0, dtype=np.int64)
+    offsets = np.cumsum(lengths) - lengths
+    return np.repeat(starts - offsets, lengths) + np.arange(total)
+
+def _compute_bounds(points, chunk_size=BUILD_CHUNK_SIZE):
+    lower, upper = np.full(3, np.inf), np.full(3, -np.inf)
+    for start in range(0, len(points), chunk_size):
+        chunk = np.asarray(points[start:start + chunk_size], dtype=np.float64)
+        lower = np.minimum(lower, chunk.min(axis=0))
+        upper = np.maximum(upper, chunk.max(axis=0))
+    return lower, upper
+
+class SpatialIndex:
+    """
+    单个点数组的体素哈希索引，目录结构:
+    meta.json（体素尺寸、原点、源文件签名）、cells.npy（非空体素键，升序）、
+    cell_starts.npy（各体素在排序点数组中的起始位置）、points.npy（按体素排序的坐标副本，与源数组同精度）、
+    order.npy（排序后位置到原数组下标的映射）
+    points.npy与order.npy以内存映射方式打开，查询只读取命中体素的数据
+    """
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        with open(os.path.join(index_dir, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.voxel_size = self.meta["voxel_size"]
+        self.origin = np.array(self.meta["origin"])
+        self.dims = np.array(self.meta["dims"], dtype=np.int64)
+        self.cells = np.load(os.path.join(index_dir, "cells.npy"))
+        self.cell_starts = np.load(os.path.join(index_dir, "cell_starts.npy"))
+        self.points = np.load(os.path.join(index_dir, "points.npy"), mmap_mode="r")
+        self.order = np.load(os.path.join(index_dir, "order.npy"), mmap_mode="r")
+
+    def __len__(self):
+        return len(self.order)
+
+    @classmethod
+    def build(cls, points_path, index_dir, voxel_size=None, points_per_cell=32):
+        """
+        为points_path（N×3的npy）构建索引并保存到index_dir
+        voxel_size为空时按包围盒表面积估计，使每个非空体素平均约含points_per_cell个点
+        """
+        start = time.time()
+        points = np.load(points_path, mmap_mode="r")
+        num_points = len(points)
+        os.makedirs(index_dir, exist_ok=True)
+        lower, upper = _compute_bounds(points) if num_points else (np.zeros(3), np.zeros(3))
+        extent = np.maximum(upper - lower, 1e-9)
+        if voxel_size is None:
+            # 重建点大多分布在曲面上，按包围盒表面积而非体积估计体素尺寸
+            area = 2 * (extent[0] * extent[1] + extent[1] * extent[2] + extent[0] * extent[2])
+            voxel_size = float(np.sqrt(area * points_per_cell / max(num_points, 1)))
+        voxel_size = max(voxel_size, float(extent.max()) / ((1 << CELL_BITS) - 1))
+        dims = np.floor(extent / voxel_size).astype(np.int64) + 1
+
+        keys = np.empty(num_points, dtype=np.int64)
+        for chunk_start in range(0, num_points, BUILD_CHUNK_SIZE):
+            chunk = np.asarray(points[chunk_start:chunk_start + BUILD_CHUNK_SIZE], dtype=np.float64)
+            coords = np.clip(np.floor((chunk - lower) / voxel_size), 0, dims - 1)
+            keys[chunk_start:chunk_start + len(chunk)] = encode_cells(coords)
+
+        order_dtype = np.int32 if num_points < np.iinfo(np.int32).max else np.int64
+        order = np.argsort(keys, kind="stable").astype(order_dtype)
+        sorted_keys = keys[order]
+        del keys
+        cells, cell_starts = np.unique(sorted_keys, return_index=True)
+        cell_starts = np.append(cell_starts, num_points).astype(np.int64)
+        del sorted_keys
+
+        # 按体素顺序写出坐标副本，同一体素的点在磁盘上连续
+        sorted_points = np.lib.format.open_memmap(os.path.join(index_dir, "points.npy"), mode="w+",
+                                                  dtype=points.dtype, shape=(num_points, 3))
+        for chunk_start in range(0, num_points, BUILD_CHUNK_SIZE):
+            chunk_order = np.sort(order[chunk_start:chunk_start + BUILD_CHUNK_SIZE])
+            positions = np.argsort(order[chunk_start:chunk_start + BUILD_CHUNK_SIZE], kind="stable")
+            # 以升序下标读取源数组（顺序访问），再放回按体素排序的位置
+            values = np.empty((len(chunk_order), 3), dtype=points.dtype)
+            values[positions] = points[chunk_order]
+            sorted_points[chunk_start:chunk_start + len(chunk_order)] = values
+        sorted_points.flush()
+        del sorted_points
+
+        np.save(os.path.join(index_dir, "order.npy"), order)
+        np.save(os.path.join(index_dir, "cells.npy"), cells)
+        np.save(os.path.join(index_dir, "cell_starts.npy"), cell_starts)
+        meta = {
+            "source": os.path.abspath(points_path),
+            "source_signature": _source_signature(points_path),
+            "num_points": num_points,
+            "voxel_size": voxel_size,
+            "origin": lower.tolist(),
+            "upper": upper.tolist(),
+            "dims": dims.tolist(),
+            "num_cells": len(cells)
+        }
+        with open(os.path.join(index_dir, "meta.json"), "w") as f:
+            json.dump(meta, f, indent=2)
+        logging.info(f"空间索引已构建: {points_path}，{num_points} 个点，{len(cells)} 个非空体素，"
+                     f"体素尺寸 {voxel_size:.4g}，耗时 {time.time() - start:.2f}秒")
+        return cls(index_dir)
+
+    @classmethod
+    def open_or_build(cls, points_path, index_dir, **build_kwargs):
+        """打开已有索引，源文件已变化或索引不存在时重新构建"""
+        meta_path = os.path.join(index_dir, "meta.json")
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                meta = json.load(f)
+            if meta.get("source_signature") == _source_signature(points_path):
+                return cls(index_dir)
+        return cls.build(points_path, index_dir, **build_kwargs)
+
+    def _cell_range(self, box_min, box_max):
+        """包围盒覆盖的体素坐标范围 (lo, hi, 是否完全位于索引范围之外)"""
+        lo = np.floor((np.asarray(box_min, dtype=np.float64) - self.origin) / self.voxel_size).astype(np.int64)
+        hi = np.floor((np.asarray(box_max, dtype=np.float64) - self.origin) / self.voxel_size).astype(np.int64)
+        outside = bool(np.any(hi < 0) or np.any(lo >= self.dims))
+        return np.clip(lo, 0, self.dims - 1), np.clip(hi, 0, self.dims - 1), outside
+
+    def _candidate_positions(self, box_min, box_max):
+        """返回与查询包围盒相交的体素中全部点在排序数组中的位置"""
+        lo, hi, outside = self._cell_range(box_min, box_max)
+        if outside or len(self.cells) == 0:
+            return np.zeros(0, dtype=np.int64)
+        span = hi - lo + 1
+        if int(np.prod(span)) <= MAX_ENUMERATED_CELLS:
+            grid = np.stack(np.meshgrid(*[np.arange(lo[i], hi[i] + 1) for i in range(3)], indexing="ij"),
+                            axis=-1).reshape(-1, 3)
+            keys = encode_cells(grid)
+            hit = np.searchsorted(self.cells, keys)
+            valid = hit < len(self.cells)
+            hit, keys = hit[valid], keys[valid]
+            cell_index = hit[self.cells[hit] == keys]
+        else:
+            coords = decode_cells(self.cells)
+            cell_index = np.nonzero(np.all((coords >= lo) & (coords <= hi), axis=1))[0]
+        return _concat_ranges(self.cell_starts[cell_index], self.cell_starts[cell_index + 1])
+
+    def query_box(self, box_min, box_max):
+        """轴对齐包围盒查询，返回 (原数组下标, 坐标)"""
+        positions = self._candidate_positions(box_min, box_max)
+        points = self.points[positions]
+        inside = np.all((points >= np.asarray(box_min)) & (points <= np.asarray(box_max)), axis=1)
+        return np.asarray(self.order[positions[inside]], dtype=np.int64), points[inside]
+
+    def query_radius(self, center, radius):
+        """球形邻域查询，返回 (原数组下标, 坐标, 距离)，按距离升序"""
+        center = np.asarray(center, dtype=np.float64)
+        positions = self._candidate_positions(center - radius, center + radius)
+        points = self.points[positions]
+        distances = np.linalg.norm(points - center, axis=1)
+        inside = distances <= radius
+        positions, points, distances = positions[inside], points[inside], distances[inside]
+        ranking = np.argsort(distances, kind="stable")
+        return np.asarray(self.order[positions[ranking]], dtype=np.int64), points[ranking], distances[ranking]
+
+    def query_knn(self, point, k=1):
+        """k近邻查询：从一个体素尺寸开始倍增搜索半径，直到找到k个点（半径查询结果精确，故结果正确）"""
+        point = np.asarray(point, dtype=np.float64)
+        diagonal = float(np.linalg.norm(self.dims * self.voxel_size))
+        radius = self.voxel_size
+        while True:
+            indices, points, distances = self.query_radius(point, radius)
+            if len(indices) >= k or radius > diagonal + np.linalg.norm(point - self.origin):
+                return indices[:k], points[:k], distances[:k]
+            radius *= 2
+
+def index_dir_for(results_dir, name):
+    return os.path.join(results_dir, INDEX_DIR_NAME, name)
+
+def build_results_index(results_dir, names=RESULT_ARRAYS, **build_kwargs):
+    """为结果目录中已存在的点数组构建（或复用）空间索引，返回 {数组名: SpatialIndex}"""
+    indexes = {}
+    for name in names:
+        points_path = os.path.join(results_dir, f"{name}.npy")
+        if os.path.exists(points_path):
+            indexes[name] = SpatialIndex.open_or_build(points_path, index_dir_for(results_dir, name), **build_kwargs)
+    return indexes
+
+def open_results_index(results_dir, name="dense_points"):
+    """打开结果目录中某个点数组的空间索引（源文件变化时自动重建）"""
+    return SpatialIndex.open_or_build(os.path.join(results_dir, f"{name}.npy"), index_dir_for(results_dir, name))
+
+def cameras_seeing_point(results_dir, point, margin=0):
+    """
+    根据保存的位姿与相机参数，返回三维点投影落在图像范围内（且位于相机前方）的图像
+    仅做视锥判断，不做遮挡检测；返回 [(图像名, 像素坐标(u, v), 深度), ...]，按深度升序
+    """
+    poses = np.load(os.path.join(results_dir, "poses.npy"), allow_pickle=True).item()
+    cameras = np.load(os.path.join(results_dir, "cameras.npy"), allow_pickle=True).item()
+    if not poses:
+        return []
+    camera_ids, _, K, _ = stack_intrinsics(cameras)
+    sizes = np.array([[cameras[camera_id]["width"], cameras[camera_id]["height"]] for camera_id in camera_ids])
+
+    names = list(poses)
+    rotations = np.stack([poses[name]["rotation"] for name in names])
+    translations = np.stack([np.asarray(poses[name]["translation"]).reshape(3) for name in names])
+    camera_rows = np.searchsorted(camera_ids, [poses[name]["camera_id"] for name in names])
+
+    X_cam = rotations @ np.asarray(point, dtype=np.float64) + translations
+    depth = X_cam[:, 2]
+    safe_depth = np.where(depth > 1e-12, depth, 1.0)
+    uv1 = np.einsum("nij,nj->ni", K[camera_rows], X_cam / safe_depth[:, None])
+    u, v = uv1[:, 0], uv1[:, 1]
+    width, height = sizes[camera_rows, 0], sizes[camera_rows, 1]
+    visible = (depth > 1e-12) & (u >= -margin) & (u < width + margin) & (v >= -margin) & (v < height + margin)
+
+    rows = np.nonzero(visible)[0]
+    rows = rows[np.argsort(depth[rows])]
+    return [(names[i], (float(u[i]), float(v[i])), float(depth[i])) for i in rows]
+
+def write_synthetic_points(points_path, num_points, chunk_size=BUILD_CHUNK_SIZE, seed=0):
+    """生成用于基准测试的合成点云（多个带噪声的曲面片），分块写入npy，不占用完整内存"""
+    rng = np.random.default_rng(seed)
+    output = np.lib.format.open_memmap(points_path, mode="w+", dtype=np.float64, shape=(num_points, 3))
+    for start in range(0, num_points, chunk_size):
+        count = min(chunk_size, num_points - start)
+        u, v = rng.uniform(0, 100, count), rng.uniform(0, 100, count)
+        patch = rng.integers(0, 4, count)
+        height = 5 * np.sin(u / 7 + patch) * np.cos(v / 11) + rng.normal(0, 0.05, count)
+        output[start:start + count] = np.stack([u, v, height + 20 * patch], axis=1)
+    output.flush()
+    return points_path
+
+def benchmark_queries(index, num_queries=200, box_size=1.0, radius=0.5, k=16, seed=0):
+    """以随机选取的已有点为查询中心，测量包围盒、半径与k近邻查询的单次延迟（毫秒）"""
+    rng = np.random.default_rng(seed)
+    centers = np.asarray(index.points[np.sort(rng.integers(0, len(index), num_queries))], dtype=np.float64)
+    queries = {
+        "box": lambda c: index.query_box(c - box_size / 2, c + box_size / 2),
+        "radius": lambda c: index.query_radius(c, radius),
+        "knn": lambda c: index.query_knn(c, k)
+    }
+    results = {}
+    for name, query in queries.items():
+        latencies, hits = [], []
+        for center in centers:
+            start = time.perf_counter()
+            found = query(center)
+            latencies.append((time.perf_counter() - start) * 1000)
+            hits.append(len(found[0]))
+        latencies = np.array(latencies)
+        results[name] = {
+            "p50_ms": float(np.percentile(latencies, 50)),
+            "p95_ms": float(np.percentile(latencies, 95)),
+            "max_ms": float(latencies.max()),
+            "mean_hits": float(np.mean(hits))
+        }
+        logging.info(f"{name}查询: p50 {results[name]['p50_ms']:.3f}ms，p95 {results[name]['p95_ms']:.3f}ms，"
+                     f"平均命中 {results[name]['mean_hits']:.1f} 个点")
+    return results
+
+def run_query_benchmark(output_dir, num_points=100_000_000, num_queries=200):
+    """在合成点云上构建索引并测量查询延迟，结果保存到 stats/spatial_query_benchmark.txt"""
+    benchmark_dir = os.path.join(output_dir, "benchmark")
+    os.makedirs(benchmark_dir, exist_ok=True)
+    points_path = os.path.join(benchmark_dir, "synthetic_points.npy")
+    if not os.path.exists(points_path) or len(np.load(points_path, mmap_mode="r")) != num_points:
+        logging.info(f"生成 {num_points} 个合成点用于基准测试")
+        write_synthetic_points(points_path, num_points)
+
+    start = time.time()
+    index = SpatialIndex.open_or_build(points_path, os.path.join(benchmark_dir, INDEX_DIR_NAME))
+    build_time = time.time() - start
+    results = benchmark_queries(index, num_queries=num_queries)
+    stats_utils.save_query_benchmark(output_dir, len(index), index.meta["num_cells"], build_time, results)
+    return results
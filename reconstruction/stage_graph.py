@@ -0,0 +1,218 @@
+'''
+Description: 声明式阶段依赖图与并发调度器
+Author: Damocles_lin
+Date: 2026-10-19 15:40:02
+LastEditTime: 2026-10-19 20:51:08
+LastEditors: Damocles_lin
+'''
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from utils import logging_utils
+
+class Stage:
+    """
+    流程阶段：声明输入与输出的数据名称
+    func: 以输入数据为关键字参数调用，返回 {输出名: 值}，返回None表示失败
+    load: 阶段未被选中运行时，从磁盘恢复其输出的函数（可选），参数为已有数据字典
+    executor: "thread"（默认）、"process"（函数与输入需可pickle）或"main"（主线程中执行）
+    """
+    def __init__(self, name, func, inputs=(), outputs=(), label=None, executor="thread", load=None):
+        self.name = name
+        self.func = func
+        self.inputs = tuple(inputs)
+        self.outputs = tuple(outputs)
+        self.label = label or name
+        self.executor = executor
+        self.load = load
+
+class StageGraph:
+    """阶段依赖图：按数据依赖并发执行相互独立的阶段"""
+    def __init__(self, stages):
+        self.stages = {}
+        self.producers = {}
+        for stage in stages:
+            if stage.name in self.stages:
+                raise ValueError(f"重复的阶段名称: {stage.name}")
+            self.stages[stage.name] = stage
+            for output in stage.outputs:
+                if output in self.producers:
+                    raise ValueError(f"数据 {output} 被多个阶段产生")
+                self.producers[output] = stage.name
+        for stage in stages:
+            for name in stage.inputs:
+                if name not in self.producers:
+                    raise ValueError(f"阶段 {stage.name} 的输入 {name} 没有产生者")
+        self.order = self._topological_order()
+
+    def dependencies(self, stage_name):
+        """阶段直接依赖的上游阶段"""
+        return {self.producers[name] for name in self.stages[stage_name].inputs}
+
+    def _topological_order(self):
+        order, visiting, done = [], set(), set()
+
+        def visit(name):
+            if name in done:
+                return
+            if name in visiting:
+                raise ValueError(f"阶段依赖存在环: {name}")
+            visiting.add(name)
+            for dep in sorted(self.dependencies(name)):
+                visit(dep)
+            visiting.discard(name)
+            done.add(name)
+            order.append(name)
+
+        for name in self.stages:
+            visit(name)
+        return order
+
+    def _ancestors(self, name):
+        result, stack = set(), [name]
+        while stack:
+            for dep in self.dependencies(stack.pop()):
+                if dep not in result:
+                    result.add(dep)
+                    stack.append(dep)
+        return result
+
+    def select(self, from_stage=None, to_stage=None):
+        """选出需要运行的阶段：from_stage的下游（含自身）与to_stage的上游（含自身）的交集"""
+        for name in (from_stage, to_stage):
+            if name is not None and name not in self.stages:
+                raise ValueError(f"未知阶段: {name}，可选: {', '.join(self.order)}")
+        selected = set(self.stages)
+        if from_stage is not None:
+            selected = {from_stage} | {n for n in self.stages if from_stage in self._ancestors(n)}
+        if to_stage is not None:
+            selected &= {to_stage} | self._ancestors(to_stage)
+        return [name for name in self.order if name in selected]
+
+    def run(self, from_stage=None, to_stage=None, max_workers=4, timer=None):
+        """
+        执行所选阶段：依赖满足的阶段立即提交到线程/进程池，相互独立的阶段并发运行
+        返回 (数据字典, 各阶段耗时, 关键路径)，任一阶段失败时数据字典为None
+        """
+        selected = self.select(from_stage, to_stage)
+        data = {}
+
+        # 未选中但被依赖的上游阶段，从磁盘恢复其输出（先逆序确定需要恢复的阶段）
+        needed = {name for stage in selected for name in self.stages[stage].inputs}
+        to_load = set()
+        for name in reversed(self.order):
+            stage = self.stages[name]
+            if name not in selected and needed & set(stage.outputs):
+                to_load.add(name)
+                needed.update(stage.inputs)
+        for name in self.order:
+            if name not in to_load:
+                continue
+            stage = self.stages[name]
+            loaded = stage.load(data) if stage.load else None
+            if loaded is None:
+                logging.error(f"阶段 {stage.label} 未运行且无法从磁盘恢复其输出，请从该阶段开始运行")
+                return None, {}, []
+            data.update(loaded)
+            logging.info(f"跳过阶段 {stage.label}，已从磁盘恢复其输出")
+
+        durations = {}
+        pending = list(selected)
+        running = {}
+        failed = False
+        thread_pool = ThreadPoolExecutor(max_workers=max_workers)
+        process_pool = None
+        try:
+            while pending or running:
+                # 提交所有依赖已满足的阶段
+                for name in list(pending):
+                    if failed:
+                        break
+                    stage = self.stages[name]
+                    if not all(i in data for i in stage.inputs):
+                        continue
+                    pending.remove(name)
+                    kwargs = {i: data[i] for i in stage.inputs}
+                    logging.info(f"开始阶段: {stage.label}")
+                    start = time.time()
+                    if stage.executor == "main":
+                        outputs = stage.func(**kwargs)
+                        if not self._finish(stage, outputs, time.time() - start, data, durations, timer):
+                            failed = True
+                        continue
+                    if stage.executor == "process":
+                        if process_pool is None:
+                            process_pool = ProcessPoolExecutor(
+                                max_workers=max_workers, initializer=logging_utils.init_worker_logging,
+                                initargs=(logging_utils.get_log_queue(),))
+                        future = process_pool.submit(stage.func, **kwargs)
+                    else:
+                        future = thread_pool.submit(stage.func, **kwargs)
+                    running[future] = (stage, start)
+
+                if failed and not running:
+                    break
+                if not running:
+                    if pending:
+                        # 剩余阶段的输入永远无法满足（上游失败）
+                        break
+                    continue
+
+                done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage, start = running.pop(future)
+                    try:
+                        outputs = future.result()
+                    except Exception as e:
+                        logging.error(f"阶段 {stage.label} 出错: {str(e)}")
+                        outputs = None
+                    if not self._finish(stage, outputs, time.time() - start, data, durations, timer):
+                        failed = True
+        finally:
+            thread_pool.shutdown(wait=True)
+            if process_pool is not None:
+                process_pool.shutdown(wait=True)
+
+        if failed or pending:
+            return None, durations, []
+        return data, durations, self.critical_path(durations)
+
+    def _finish(self, stage, outputs, elapsed, data, durations, timer):
+        durations[stage.name] = elapsed
+        if timer is not None:
+            timer.record(stage.label, elapsed)
+        if outputs is None or not all(o in outputs for o in stage.outputs):
+            logging.error(f"阶段 {stage.label} 失败，停止调度后续阶段")
+            return False
+        data.update(outputs)
+        logging.info(f"完成阶段: {stage.label} | 耗时: {elapsed:.2f}秒")
+        return True
+
+    def critical_path(self, durations):
+        """按实际耗时计算已执行阶段的关键路径（最长依赖链），返回 [(阶段名, 耗时), ...]"""
+        finish, previous = {}, {}
+        for name in self.order:
+            if name not in durations:
+                continue
+            best_dep, best_finish = None, 0.0
+            for dep in self.dependencies(name):
+                if dep in finish and finish[dep] > best_finish:
+                    best_dep, best_finish = dep, finish[dep]
+            finish[name] = best_finish + durations[name]
+            previous[name] = best_dep
+        if not finish:
+            return []
+        name = max(finish, key=finish.get)
+        path = []
+        while name is not None:
+            path.append((name, durations[name]))
+            name = previous[name]
+        return path[::-1]
+
+    def format_critical_path(self, path):
+        """生成用于计时摘要的关键路径说明"""
+        if not path:
+            return []
+        total = sum(elapsed for _, elapsed in path)
+        chain = " -> ".join(f"{self.stages[name].label}({elapsed:.2f}秒)" for name, elapsed in path)
+        return [f"关键路径: {chain}", f"关键路径耗时: {total:.2f}秒"]
@@ -0,0 +1,370 @@
+'''
+Description: 流式稠密重建：按参考图像粒度流水线执行去畸变、立体匹配与增量融合
+Author: Damocles_lin
+Date: 2026-10-19 17:06:23
+LastEditTime: 2026-10-19 22:27:16
+LastEditors: Damocles_lin
+'''
+import os
+import time
+import queue
+import shutil
+import logging
+import threading
+import itertools
+import numpy as np
+import open3d as o3d
+import pycolmap
+from utils import stats_utils
+from utils.memory_utils import apply_option_overrides
+from .undistortion import iter_undistorted_images
+from .mvs import DENSE_QUALITY_PROFILES, write_patch_match_config, write_fusion_config, fuse_depth_maps
+from .covisibility import build_covisibility_graph, select_source_views
+from .analytics import collect_observations
+
+# 立体匹配任务优先级：几何一致性任务优先，使参考图像尽早进入融合
+GEOMETRIC_PRIORITY = 0
+PHOTOMETRIC_PRIORITY = 1
+STOP_PRIORITY = 2
+VOXEL_BITS = 21  # 每个坐标轴的体素索引位数，三轴合并为一个int64键
+
+def estimate_voxel_size(reconstruction, max_image_size=-1, observations=None):
+    """以稀疏观测处单个去畸变像素对应的物方尺寸（中位数）作为去重体素边长"""
+    if observations is None:
+        observations = collect_observations(reconstruction)
+    if len(observations["obs_image_rows"]) == 0:
+        return None
+    img = observations["obs_image_rows"]
+    X = observations["point_xyz"][observations["obs_point_rows"]]
+    depth = (np.einsum("nij,nj->ni", observations["rotations"][img], X) + observations["translations"][img])[:, 2]
+
+    cameras = [reconstruction.cameras[camera_id] for camera_id in observations["camera_ids"]]
+    longest = np.array([max(camera.width, camera.height) for camera in cameras], dtype=np.float64)
+    scale = np.ones_like(longest) if max_image_size <= 0 else np.minimum(1.0, max_image_size / longest)
+    focal = observations["K"][:, 0, 0] * scale
+    cam = observations["image_camera_rows"][img]
+    footprint = depth[depth > 0] / focal[cam][depth > 0]
+    return float(np.median(footprint)) if len(footprint) else None
+
+def voxel_keys(points, origin, voxel_size):
+    """
+    将点坐标量化为体素并打包为int64键
+    返回 (键, 是否在可表示范围内)；超出范围的点键值无意义，由调用方单独处理
+    """
+    index = np.floor((points - origin) / voxel_size).astype(np.int64)
+    in_range = np.all((index >= 0) & (index < (1 << VOXEL_BITS)), axis=1)
+    index[~in_range] = 0
+    return (index[:, 0] << (2 * VOXEL_BITS)) | (index[:, 1] << VOXEL_BITS) | index[:, 2], in_range
+
+def _link_workspace(dense_path, workspace_path):
+    """创建共享去畸变图像、稀疏模型和深度/法向图目录的轻量工作空间（仅配置文件独立）"""
+    os.makedirs(os.path.join(workspace_path, "stereo"), exist_ok=True)
+    links = [("images",), ("sparse",),
+             ("stereo", "depth_maps"), ("stereo", "normal_maps"), ("stereo", "consistency_graphs")]
+    for parts in links:
+        link = os.path.join(workspace_path, *parts)
+        if not os.path.lexists(link):
+            os.symlink(os.path.abspath(os.path.join(dense_path, *parts)), link)
+    return workspace_path
+
+class GrowingPointCloud:
+    """增量融合得到的稠密点云：按体素去重后追加，定期写出到fused.ply"""
+    def __init__(self, output_path, origin, voxel_size, write_interval=30.0):
+        self.output_path = output_path
+        self.origin = origin
+        self.voxel_size = voxel_size
+        self.write_interval = write_interval
+        self.points, self.normals, self.colors = [], [], []
+        self.keys = set()
+        self.num_points = 0
+        self.num_out_of_range = 0
+        self.last_write = 0.0
+
+    def append(self, pcd):
+        """追加一个批次的融合结果，返回新增点数"""
+        points = np.asarray(pcd.points)
+        if len(points) == 0:
+            return 0
+        keep = np.ones(len(points), dtype=bool)
+        if self.voxel_size:
+            keys, in_range = voxel_keys(points, self.origin, self.voxel_size)
+            # 批次内去重后，以哈希集合判断体素是否已被占用（开销只与批次大小相关）
+            _, first = np.unique(np.where(in_range, keys, -1), return_index=True)
+            first = first[in_range[first]]
+            unseen = np.fromiter((key not in self.keys for key in keys[first].tolist()),
+                                 dtype=bool, count=len(first))
+            keep[:] = ~in_range  # 超出体素索引范围的点不去重，直接保留
+            keep[first[unseen]] = True
+            self.keys.update(keys[first[unseen]].tolist())
+            out_of_range = int((~in_range).sum())
+            if out_of_range:
+                self.num_out_of_range += out_of_range
+                logging.warning(f"{out_of_range} 个融合点超出体素索引范围，未去重直接保留")
+        self.points.append(points[keep])
+        self.normals.append(np.asarray(pcd.normals)[keep] if pcd.has_normals() else np.zeros((keep.sum(), 3)))
+        self.colors.append(np.asarray(pcd.colors)[keep] if pcd.has_colors() else np.zeros((keep.sum(), 3)))
+        added = int(keep.sum())
+        self.num_points += added
+        if time.time() - self.last_write >= self.write_interval:
+            self.write()
+        return added
+
+    def write(self):
+        pcd = o3d.geometry.PointCloud()
+        if self.points:
+            pcd.points = o3d.utility.Vector3dVector(np.vstack(self.points))
+            pcd.normals = o3d.utility.Vector3dVector(np.vstack(self.normals))
+            pcd.colors = o3d.utility.Vector3dVector(np.vstack(self.colors))
+        o3d.io.write_point_cloud(self.output_path, pcd)
+        self.last_write = time.time()
+
+def _stereo_worker(tasks, events, option_overrides, gpu_index):
+    """立体匹配工作线程：逐个执行单参考图像的光度/几何一致性任务"""
+    while True:
+        priority, _, task = tasks.get()
+        if priority == STOP_PRIORITY:
+            return
+        pass_type, ref_name, workspace_path = task
+        start = time.time()
+        try:
+            stereo_options = pycolmap.PatchMatchOptions()
+            stereo_options.gpu_index = gpu_index
+            apply_option_overrides(stereo_options, option_overrides)
+            # 光度一致性阶段不过滤，由几何一致性阶段统一过滤
+            stereo_options.geom_consistency = pass_type == "geometric"
+            stereo_options.filter = pass_type == "geometric"
+            pycolmap.patch_match_stereo(
+                workspace_path=workspace_path,
+                workspace_format="COLMAP",
+                options=stereo_options
+            )
+            ok = os.path.exists(os.path.join(workspace_path, "stereo", "depth_maps", f"{ref_name}.{pass_type}.bin"))
+        except Exception as e:
+            logging.error(f"参考图像 {ref_name} {pass_type}立体匹配出错: {str(e)}")
+            ok = False
+        events.put(("stereo", pass_type, ref_name, ok, time.time() - start))
+
+def _fusion_worker(fusion_queue, events, dense_path, cloud, option_overrides, batch_size, batch_timeout):
+    """融合线程：将几何深度图就绪的参考图像按批次融合并追加到增量点云"""
+    finished = False
+    batch_index = 0
+    while not finished:
+        batch, neighbors = [], set()
+        deadline = None
+        while len(batch) < batch_size:
+            timeout = None if deadline is None else max(0.0, deadline - time.time())
+            try:
+                item = fusion_queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if item is None:
+                finished = True
+                break
+            ref_name, ready_neighbors = item
+            batch.append(ref_name)
+            neighbors.update(ready_neighbors)
+            if deadline is None:
+                deadline = time.time() + batch_timeout
+        if not batch:
+            continue
+
+        start = time.time()
+        workspace_path = _link_workspace(dense_path, os.path.join(dense_path, "stream", f"fusion_{batch_index}"))
+        # 邻近图像一同参与融合以满足多视图一致性约束，重复点由体素去重剔除
+        write_fusion_config(workspace_path, sorted(set(batch) | neighbors))
+        batch_path = os.path.join(dense_path, "stream", f"fusion_{batch_index}.ply")
+        added = 0
+        try:
+            fuse_depth_maps(workspace_path, batch_path, option_overrides)
+            if os.path.exists(batch_path):
+                added = cloud.append(o3d.io.read_point_cloud(batch_path))
+                os.remove(batch_path)
+        except Exception as e:
+            logging.error(f"融合批次 {batch_index} 出错: {str(e)}")
+        shutil.rmtree(workspace_path, ignore_errors=True)
+        events.put(("fusion", batch_index, len(batch), added, time.time() - start))
+        batch_index += 1
+
+def streaming_dense_reconstruction(output_dir, sparse_path, image_path, quality="high", num_workers=None,
+                                   memory_plan=None, gpu_indices=("0",), max_sources=10,
+                                   fusion_batch_size=8, fusion_batch_timeout=10.0, queue_size=16,
+                                   undistort_chunk_size=4, observations=None):
+    """
+    流式稠密重建：去畸变、立体匹配与融合之间没有阶段级屏障
+    - 去畸变按小批次在进程池中进行，完成一批即产出
+    - 参考图像及其全部源图像去畸变后立即执行光度一致性立体匹配；
+      参考图像及其源图像的光度深度图就绪后执行几何一致性立体匹配
+    - 几何深度图就绪的参考图像按批次融合并追加到不断增长的点云
+    每个参考图像使用独立的轻量工作空间（共享图像与深度图目录），每次调用仅处理一个参考图像
+    返回统计信息，其中包含首批稠密点耗时与总耗时
+    """
+    memory_plan = memory_plan or {}
+    stereo_overrides = memory_plan.get("stereo", {}).get("options")
+    fusion_overrides = memory_plan.get("fusion", {}).get("options")
+    max_image_size = DENSE_QUALITY_PROFILES[quality]["max_image_size"]
+    dense_path = os.path.join(output_dir, "dense")
+    stream_path = os.path.join(dense_path, "stream")
+    fused_path = os.path.join(dense_path, "fused.ply")
+    shutil.rmtree(stream_path, ignore_errors=True)
+    os.makedirs(stream_path, exist_ok=True)
+    start = time.time()
+
+    # 参考图像的源图像（共视图）与去重体素尺寸均由稀疏模型预先确定
+    reconstruction = pycolmap.Reconstruction(sparse_path)
+    if observations is None:
+        observations = collect_observations(reconstruction)
+    sources = select_source_views(build_covisibility_graph(reconstruction, observations=observations),
+                                  max_sources=max_sources)
+    dependents = {}
+    for ref_name, source_names in sources.items():
+        for source_name in source_names:
+            dependents.setdefault(source_name, set()).add(ref_name)
+    ref_workspaces = {name: os.path.join(stream_path, str(i)) for i, name in enumerate(sorted(sources))}
+
+    voxel_size = estimate_voxel_size(reconstruction, max_image_size, observations=observations)
+    sparse_points = observations["point_xyz"]
+    center = np.median(sparse_points, axis=0) if len(sparse_points) else np.zeros(3)
+    if voxel_size and len(sparse_points):
+        # 体素索引范围需覆盖稀疏点的整体范围（留一倍余量），否则增大体素尺寸
+        half_extent = float(np.abs(sparse_points - center).max())
+        min_voxel_size = 2 * half_extent / (1 << (VOXEL_BITS - 1))
+        if voxel_size < min_voxel_size:
+            logging.warning(f"场景范围超出体素索引范围，去重体素尺寸由 {voxel_size} 增大到 {min_voxel_size}")
+            voxel_size = min_voxel_size
+    origin = center - (1 << (VOXEL_BITS - 1)) * (voxel_size or 0.0)  # 体素索引范围以场景中心对称
+    cloud = GrowingPointCloud(fused_path, origin, voxel_size)
+    logging.info(f"流式稠密重建: {len(sources)} 个参考图像，去重体素尺寸 {voxel_size}")
+
+    events = queue.Queue()
+    tasks = queue.PriorityQueue(maxsize=queue_size)
+    fusion_queue = queue.Queue(maxsize=queue_size)
+    sequence = itertools.count()
+
+    # 生产者：流式去畸变
+    def produce():
+        try:
+            for names in iter_undistorted_images(dense_path, sparse_path, image_path, max_image_size,
+                                                 num_workers=num_workers, chunk_size=undistort_chunk_size):
+                events.put(("undistorted", names))
+        except Exception as e:
+            logging.error(f"流式去畸变出错: {str(e)}")
+        events.put(("undistort_done",))
+
+    threads = [threading.Thread(target=produce, daemon=True)]
+    threads += [threading.Thread(target=_stereo_worker, args=(tasks, events, stereo_overrides, str(gpu)),
+                                 daemon=True) for gpu in gpu_indices]
+    fusion_thread = threading.Thread(target=_fusion_worker, daemon=True, args=(
+        fusion_queue, events, dense_path, cloud, fusion_overrides, fusion_batch_size, fusion_batch_timeout))
+    for thread in threads + [fusion_thread]:
+        thread.start()
+
+    undistorted, photometric, geometric, failed = set(), set(), set(), set()
+    submitted = set()
+    outstanding = 0
+    undistort_done = False
+    pending_fusion = 0
+    first_points_time = None
+    stage_times = {"photometric": 0.0, "geometric": 0.0, "fusion": 0.0}
+    fusion_batches = 0
+
+    def submit(pass_type, ref_name, source_names):
+        nonlocal outstanding
+        workspace_path = _link_workspace(dense_path, ref_workspaces[ref_name])
+        write_patch_match_config(workspace_path, [ref_name], sources={ref_name: source_names})
+        priority = GEOMETRIC_PRIORITY if pass_type == "geometric" else PHOTOMETRIC_PRIORITY
+        tasks.put((priority, next(sequence), (pass_type, ref_name, workspace_path)))
+        submitted.add((pass_type, ref_name))
+        outstanding += 1
+
+    def on_fusion(event):
+        nonlocal pending_fusion, fusion_batches, first_points_time
+        _, batch_index, batch_refs, added, elapsed = event
+        pending_fusion -= batch_refs
+        fusion_batches += 1
+        stage_times["fusion"] += elapsed
+        if added and first_points_time is None:
+            first_points_time = time.time() - start
+            logging.info(f"首批稠密点已生成，耗时 {first_points_time:.2f}秒")
+        logging.info(f"融合批次 {batch_index}: {batch_refs} 个参考图像，新增 {added} 个点，"
+                     f"当前共 {cloud.num_points} 个点")
+
+    def try_photometric(ref_name):
+        if (("photometric", ref_name) not in submitted and ref_name in undistorted
+                and all(name in undistorted for name in sources[ref_name])):
+            submit("photometric", ref_name, sources[ref_name])
+
+    def try_geometric(ref_name):
+        if ("geometric", ref_name) in submitted or ref_name not in photometric:
+            return
+        if not all(name in photometric or name in failed for name in sources[ref_name]):
+            return
+        ready_sources = [name for name in sources[ref_name] if name in photometric]
+        if ready_sources:
+            submit("geometric", ref_name, ready_sources)
+        else:
+            failed.add(ref_name)
+
+    while True:
+        event = events.get()
+        kind = event[0]
+        if kind == "undistorted":
+            undistorted.update(event[1])
+            for name in event[1]:
+                for ref_name in {name} | dependents.get(name, set()):
+                    if ref_name in sources:
+                        try_photometric(ref_name)
+        elif kind == "undistort_done":
+            undistort_done = True
+        elif kind == "stereo":
+            _, pass_type, ref_name, ok, elapsed = event
+            outstanding -= 1
+            stage_times[pass_type] += elapsed
+            if not ok:
+                failed.add(ref_name)
+            elif pass_type == "photometric":
+                photometric.add(ref_name)
+            else:
+                geometric.add(ref_name)
+                neighbors = [name for name in sources[ref_name] if name in geometric]
+                fusion_queue.put((ref_name, neighbors))
+                pending_fusion += 1
+            if pass_type == "photometric":
+                for other in {ref_name} | dependents.get(ref_name, set()):
+                    if other in sources:
+                        try_geometric(other)
+        elif kind == "fusion":
+            on_fusion(event)
+        if undistort_done and outstanding == 0:
+            break
+
+    # 结束立体匹配与融合线程
+    for _ in gpu_indices:
+        tasks.put((STOP_PRIORITY, next(sequence), None))
+    fusion_queue.put(None)
+    while pending_fusion > 0 or fusion_thread.is_alive():
+        try:
+            event = events.get(timeout=1.0)
+        except queue.Empty:
+            continue
+        if event[0] == "fusion":
+            on_fusion(event)
+    cloud.write()
+    shutil.rmtree(stream_path, ignore_errors=True)
+
+    # 标准工作空间配置，便于之后以常规方式重新运行立体匹配或融合
+    write_patch_match_config(dense_path, sorted(sources), sources=sources)
+    write_fusion_config(dense_path, sorted(geometric))
+
+    stats = {
+        "reference_images": len(sources),
+        "geometric_depth_maps": len(geometric),
+        "failed_images": len(failed),
+        "fusion_batches": fusion_batches,
+        "dense_points": cloud.num_points,
+        "out_of_range_points": cloud.num_out_of_range,
+        "time_to_first_points": first_points_time,
+        "wall_time": time.time() - start,
+        "stage_times": stage_times
+    }
+    stats_utils.save_streaming_dense_stats(output_dir, stats)
+    return stats
@@ -0,0 +1,222 @@
+'''
+Description: 匹配前的数据集筛选：近重复帧与模糊图像剔除
+Author: Damocles_lin
+Date: 2026-10-19 18:05:37
+LastEditTime: 2026-10-19 22:11:05
+LastEditors: Damocles_lin
+'''
+import os
+import logging
+import multiprocessing
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from utils import stats_utils, logging_utils
+
+HASH_SIZE = 8           # dHash边长，哈希共64位
+SHARPNESS_SIZE = 512    # 计算清晰度时的缩小尺寸（最长边）
+SELECTION_FILE = "triage_selection.txt"
+SIGNATURE_FILE = "triage_signatures.npz"  # 全部已筛选图像的签名与是否选中，供监控模式筛选新图像
+
+# 0-255每个字节中置位的个数，用于批量计算汉明距离
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+def compute_image_signature(image_file, sharpness_size=SHARPNESS_SIZE):
+    """
+    工作进程：以缩小解码的灰度图计算差值感知哈希（dHash）与清晰度（拉普拉斯方差）
+    JPEG通过draft模式在解码时直接降采样，不解码全分辨率图像
+    返回 (图像名, 哈希(int), 清晰度)，读取失败时哈希为None
+    """
+    from PIL import Image
+    name = os.path.basename(image_file)
+    try:
+        with Image.open(image_file) as img:
+            img.draft("L", (sharpness_size, sharpness_size))
+            gray = img.convert("L")
+            gray.thumbnail((sharpness_size, sharpness_size))
+
+            pixels = np.asarray(gray, dtype=np.float32)
+            laplacian = (4 * pixels[1:-1, 1:-1] - pixels[:-2, 1:-1] - pixels[2:, 1:-1]
+                         - pixels[1:-1, :-2] - pixels[1:-1, 2:])
+            sharpness = float(laplacian.var())
+
+            small = np.asarray(gray.resize((HASH_SIZE + 1, HASH_SIZE), Image.BILINEAR), dtype=np.int16)
+            bits = (small[:, 1:] > small[:, :-1]).flatten()
+            image_hash = int(np.packbits(bits).view(">u8")[0])
+        return name, image_hash, sharpness
+    except Exception as e:
+        logging.warning(f"无法计算图像签名: {image_file} - {str(e)}")
+        return name, None, 0.0
+
+def compute_signatures(image_files, num_workers=None):
+    """多进程并行计算全部图像的哈希与清晰度，返回 {图像名: (哈希, 清晰度)}"""
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+    paths = [str(f) for f in image_files]
+    chunk_size = max(1, len(paths) // (num_workers * 4))
+    with ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context("spawn"),
+                             initializer=logging_utils.init_worker_logging,
+                             initargs=(logging_utils.get_log_queue(),)) as executor:
+        results = executor.map(compute_image_signature, paths, chunksize=chunk_size)
+        return {name: (image_hash, sharpness) for name, image_hash, sharpness in results}
+
+def hamming_distances(hash_value, hashes):
+    """一个64位哈希与一组哈希之间的汉明距离"""
+    xor = np.bitwise_xor(hashes, np.uint64(hash_value))
+    return _POPCOUNT[xor.view(np.uint8).reshape(-1, 8)].sum(axis=1)
+
+def select_representatives(signatures, duplicate_threshold=6, blur_ratio=0.3, min_sharpness=None,
+                           reference=None):
+    """
+    按阈值筛选代表性图像子集
+    - 清晰度低于 blur_ratio × 中位清晰度（或低于min_sharpness）的图像视为模糊并剔除
+    - 其余图像按清晰度从高到低贪心聚类：与已选代表的汉明距离不超过duplicate_threshold的
+      图像归入该代表的近重复簇（不做传递合并，缓慢平移的序列不会被整体合并）
+    reference: 已有筛选结果 {图像名: (哈希, 清晰度, 是否选中)}，给定时中位清晰度取自已有图像，
+      已选中的图像作为初始代表（增量筛选新图像）
+    返回 (选中图像名列表, 剔除记录列表)
+    """
+    dropped = []
+    valid = {name: sig for name, sig in signatures.items() if sig[0] is not None}
+    for name in sorted(set(signatures) - set(valid)):
+        dropped.append({"image_name": name, "reason": "unreadable", "detail": "无法解码"})
+    if not valid:
+        return [], dropped
+
+    reference = reference or {}
+    reference_valid = [sig for sig in reference.values() if sig[0] is not None]
+    sharpness = np.array([sig[1] for sig in (reference_valid or list(valid.values()))])
+    threshold = blur_ratio * float(np.median(sharpness))
+    if min_sharpness is not None:
+        threshold = max(threshold, min_sharpness)
+
+    candidates = []
+    for name, (image_hash, score) in valid.items():
+        if score < threshold:
+            dropped.append({"image_name": name, "reason": "blur",
+                            "detail": f"清晰度 {score:.1f} < 阈值 {threshold:.1f}"})
+        else:
+            candidates.append((score, name, image_hash))
+    candidates.sort(key=lambda c: (-c[0], c[1]))
+
+    representatives = [name for name, sig in sorted(reference.items()) if sig[2]]
+    rep_hashes = np.array([reference[name][0] for name in representatives], dtype=np.uint64)
+    num_reference = len(representatives)
+    for score, name, image_hash in candidates:
+        if len(rep_hashes):
+            distances = hamming_distances(image_hash, rep_hashes)
+            nearest = int(np.argmin(distances))
+            if distances[nearest] <= duplicate_threshold:
+                dropped.append({"image_name": name, "reason": "duplicate",
+                                "detail": f"与 {representatives[nearest]} 的汉明距离 {int(distances[nearest])}"})
+                continue
+        representatives.append(name)
+        rep_hashes = np.append(rep_hashes, np.uint64(image_hash))
+
+    return sorted(representatives[num_reference:]), dropped
+
+def triage_images(image_files, output_dir, duplicate_threshold=6, blur_ratio=0.3, min_sharpness=None,
+                  num_workers=None):
+    """
+    特征提取前筛选图像：剔除近重复帧与模糊图像，保存剔除报告、选中列表与图像签名
+    返回 {"input_images": 输入图像数, "image_names": 选中图像名列表}
+    """
+    image_files = sorted(image_files, key=lambda f: os.path.basename(str(f)))
+    all_names = [os.path.basename(str(f)) for f in image_files]
+    try:
+        import PIL  # noqa: F401
+    except ImportError:
+        logging.warning("Pillow未安装，跳过图像筛选")
+        return {"input_images": len(all_names), "image_names": all_names}
+
+    signatures = compute_signatures(image_files, num_workers=num_workers)
+    selected, dropped = select_representatives(signatures, duplicate_threshold=duplicate_threshold,
+                                               blur_ratio=blur_ratio, min_sharpness=min_sharpness)
+    save_selection(output_dir, selected)
+    save_signatures(output_dir, signatures, selected)
+    stats_utils.save_triage_report(output_dir, len(all_names), selected, dropped)
+    logging.info(f"图像筛选: 输入 {len(all_names)} 张，保留 {len(selected)} 张，剔除 {len(dropped)} 张")
+    return {"input_images": len(all_names), "image_names": selected}
+
+def triage_new_images(image_files, output_dir, duplicate_threshold=6, blur_ratio=0.3, num_workers=None):
+    """
+    监控模式下按已有筛选结果筛选新到达的图像：与已选代表比较近重复，模糊阈值沿用已有图像的中位清晰度
+    筛选结果追加到选中列表与签名文件，尚无筛选结果时不做筛选
+    返回选中的新图像名列表
+    """
+    image_files = sorted(image_files, key=lambda f: os.path.basename(str(f)))
+    all_names = [os.path.basename(str(f)) for f in image_files]
+    selection = load_selection(output_dir)
+    if selection is None or not all_names:
+        return all_names
+    try:
+        import PIL  # noqa: F401
+    except ImportError:
+        logging.warning("Pillow未安装，跳过新图像筛选")
+        return all_names
+
+    reference = load_signatures(output_dir)
+    if reference is None:
+        # 旧版筛选结果没有签名文件：由选中图像重新计算代表签名
+        image_dir = os.path.dirname(str(image_files[0]))
+        selected_files = [os.path.join(image_dir, name) for name in selection
+                          if os.path.exists(os.path.join(image_dir, name))]
+        reference = {name: (image_hash, sharpness, True) for name, (image_hash, sharpness)
+                     in compute_signatures(selected_files, num_workers=num_workers).items()
+                     if image_hash is not None}
+
+    signatures = compute_signatures(image_files, num_workers=num_workers)
+    selected, dropped = select_representatives(signatures, duplicate_threshold=duplicate_threshold,
+                                               blur_ratio=blur_ratio, reference=reference)
+    for record in dropped:
+        logging.info(f"新图像被筛选剔除: {record['image_name']} ({record['reason']}: {record['detail']})")
+
+    save_selection(output_dir, sorted(set(selection) | set(selected)))
+    reference.update({name: (sig[0], sig[1], name in selected) for name, sig in signatures.items()})
+    _write_signatures(output_dir, reference)
+    logging.info(f"新图像筛选: 输入 {len(all_names)} 张，保留 {len(selected)} 张，剔除 {len(dropped)} 张")
+    return selected
+
+def save_selection(output_dir, image_names):
+    """保存筛选后的图像列表（每行一个图像名）"""
+    with open(os.path.join(output_dir, SELECTION_FILE), "w") as f:
+        for name in image_names:
+            f.write(f"{name}\n")
+
+def load_selection(output_dir):
+    """读取筛选后的图像列表，不存在时返回None"""
+    selection_path = os.path.join(output_dir, SELECTION_FILE)
+    if not os.path.exists(selection_path):
+        return None
+    with open(selection_path) as f:
+        return [line.strip() for line in f if line.strip()]
+
+def save_signatures(output_dir, signatures, selected):
+    """保存全部已筛选图像的哈希、清晰度与是否选中"""
+    selected = set(selected)
+    _write_signatures(output_dir, {name: (sig[0], sig[1], name in selected) for name, sig in signatures.items()})
+
+def _write_signatures(output_dir, records):
+    names = sorted(records)
+    np.savez(
+        os.path.join(output_dir, SIGNATURE_FILE),
+        names=np.array(names, dtype=str),
+        hashes=np.array([records[name][0] or 0 for name in names], dtype=np.uint64),
+        readable=np.array([records[name][0] is not None for name in names], dtype=bool),
+        sharpness=np.array([records[name][1] for name in names], dtype=np.float64),
+        selected=np.array([records[name][2] for name in names], dtype=bool)
+    )
+
+def load_signatures(output_dir):
+    """读取图像签名 {图像名: (哈希, 清晰度, 是否选中)}，不存在时返回None"""
+    signature_path = os.path.join(output_dir, SIGNATURE_FILE)
+    if not os.path.exists(signature_path):
+        return None
+    with np.load(signature_path) as data:
+        return {str(name): (int(image_hash) if readable else None, float(sharpness), bool(selected))
+                for name, image_hash, readable, sharpness, selected
+                in zip(data["names"], data["hashes"], data["readable"], data["sharpness"], data["selected"])}
+
+def load_rejected(output_dir):
+    """读取筛选剔除的图像名集合，没有签名文件时返回空集合"""
+    records = load_signatures(output_dir) or {}
+    return {name for name, (_, _, selected) in records.items() if not selected}
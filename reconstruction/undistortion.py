@@ -0,0 +1,230 @@
+'''
+Description: 分片并行去畸变，输出标准COLMAP稠密工作空间
+Author: Damocles_lin
+Date: 2026-10-19 11:52:16
+LastEditTime: 2026-10-19 22:11:05
+LastEditors: Damocles_lin
+'''
+import os
+import json
+import time
+import shutil
+import logging
+import multiprocessing
+import pycolmap
+from utils import logging_utils
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+MANIFEST_NAME = "undistort_manifest.json"
+STEREO_OUTPUT_DIRS = ("depth_maps", "normal_maps", "consistency_graphs")
+
+def _undistort_shard(shard_path, input_path, image_path, image_names, max_image_size):
+    """子进程：将一个分片的图像去畸变到独立的临时工作空间"""
+    start = time.time()
+    undistort_options = pycolmap.UndistortCameraOptions()
+    undistort_options.max_image_size = max_image_size
+    pycolmap.undistort_images(
+        output_path=shard_path,
+        input_path=input_path,
+        image_path=image_path,
+        image_names=image_names,
+        undistort_options=undistort_options
+    )
+    return len(image_names), time.time() - start
+
+def _image_signature(image_path, image_name, camera, max_image_size):
+    """生成判断去畸变结果是否最新的签名（源图像修改时间、相机参数、尺寸上限）"""
+    return {
+        "src_mtime": os.path.getmtime(os.path.join(image_path, image_name)),
+        "camera": [int(camera.model), camera.width, camera.height, [float(p) for p in camera.params]],
+        "max_image_size": max_image_size
+    }
+
+def _model_mtime(model_path):
+    """稀疏模型目录中文件的最新修改时间"""
+    return max(os.path.getmtime(os.path.join(model_path, f)) for f in os.listdir(model_path))
+
+def load_manifest(dense_path):
+    """读取去畸变清单 {"sparse_mtime": float, "images": {name: signature}}"""
+    manifest_path = os.path.join(dense_path, MANIFEST_NAME)
+    if not os.path.exists(manifest_path):
+        return {"sparse_mtime": None, "images": {}}
+    with open(manifest_path) as f:
+        return json.load(f)
+
+def save_manifest(dense_path, manifest):
+    """保存去畸变清单"""
+    with open(os.path.join(dense_path, MANIFEST_NAME), "w") as f:
+        json.dump(manifest, f)
+
+def find_stale_images(dense_path, image_path, reconstruction, image_names, max_image_size):
+    """返回需要重新去畸变的图像及其最新签名"""
+    manifest = load_manifest(dense_path)
+    stale, signatures = [], {}
+    for image in reconstruction.images.values():
+        if image.name not in image_names:
+            continue
+        signature = _image_signature(image_path, image.name, reconstruction.cameras[image.camera_id],
+                                     max_image_size)
+        signatures[image.name] = signature
+        output_file = os.path.join(dense_path, "images", image.name)
+        if manifest["images"].get(image.name) != signature or not os.path.exists(output_file):
+            stale.append(image.name)
+    return stale, signatures
+
+def remove_stereo_outputs(dense_path, image_names):
+    """
+    删除指定图像的立体匹配输出（深度图、法向图、一致性图）
+    PatchMatch会跳过输出已存在的问题，图像重新去畸变后必须删除旧结果才会重新计算
+    返回删除的文件数
+    """
+    removed = 0
+    for sub_dir in STEREO_OUTPUT_DIRS:
+        for image_name in image_names:
+            for suffix in (".photometric.bin", ".geometric.bin"):
+                output_file = os.path.join(dense_path, "stereo", sub_dir, image_name + suffix)
+                if os.path.exists(output_file):
+                    os.remove(output_file)
+                    removed += 1
+    return removed
+
+def _plan_undistortion(output_path, input_path, image_path, max_image_size, image_names):
+    """确定需要去畸变的图像：返回 (参与图像集合, 待处理图像, 签名, 稀疏模型修改时间, 稀疏模型是否最新)"""
+    reconstruction = pycolmap.Reconstruction(input_path)
+    registered_names = sorted(image.name for image in reconstruction.images.values())
+    if image_names is None:
+        image_names = registered_names
+    image_names = set(image_names) & set(registered_names)
+
+    stale, signatures = find_stale_images(output_path, image_path, reconstruction, image_names, max_image_size)
+    sparse_mtime = _model_mtime(input_path)
+    sparse_current = (os.path.isdir(os.path.join(output_path, "sparse"))
+                      and load_manifest(output_path)["sparse_mtime"] == sparse_mtime)
+    return image_names, stale, signatures, sparse_mtime, sparse_current
+
+def _merge_shard(shard_path, output_path, copy_sparse):
+    """将一个分片工作空间的去畸变图像移动到标准目录，必要时复制稀疏模型（各分片相同）"""
+    images_out = os.path.join(output_path, "images")
+    shard_images = os.path.join(shard_path, "images")
+    for root, _, files in os.walk(shard_images):
+        for file_name in files:
+            src = os.path.join(root, file_name)
+            dst = os.path.join(images_out, os.path.relpath(src, shard_images))
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            os.replace(src, dst)
+    if copy_sparse:
+        shutil.copytree(os.path.join(shard_path, "sparse"), os.path.join(output_path, "sparse"),
+                        dirs_exist_ok=True)
+        for sub_dir in STEREO_OUTPUT_DIRS:
+            os.makedirs(os.path.join(output_path, "stereo", sub_dir), exist_ok=True)
+    shutil.rmtree(shard_path, ignore_errors=True)
+
+def undistort_images_sharded(output_path, input_path, image_path, max_image_size=-1,
+                             num_workers=None, image_names=None):
+    """
+    分片并行去畸变
+    将已注册图像分配到多个工作进程，每个分片写入临时工作空间后合并到标准布局:
+    output_path/images, output_path/sparse, output_path/stereo
+    已是最新的去畸变图像会被跳过
+    """
+    image_names, stale, signatures, sparse_mtime, sparse_current = _plan_undistortion(
+        output_path, input_path, image_path, max_image_size, image_names)
+
+    logging.info(f"去畸变: {len(image_names)} 张图像，其中 {len(image_names) - len(stale)} 张已是最新")
+    removed = remove_stereo_outputs(output_path, stale)
+    if removed:
+        logging.info(f"删除 {removed} 个过期的立体匹配输出")
+    if not stale and sparse_current:
+        return {"undistorted": 0, "skipped": len(image_names)}
+    if not stale:
+        # 稀疏模型已更新但图像均为最新：仍需处理一张图像以写出新的稀疏模型
+        stale = [sorted(image_names)[0]]
+
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+    num_shards = max(1, min(num_workers, len(stale)))
+    shards = [stale[i::num_shards] for i in range(num_shards)]
+    shard_root = os.path.join(output_path, ".undistort_shards")
+    shutil.rmtree(shard_root, ignore_errors=True)
+    shard_paths = [os.path.join(shard_root, str(i)) for i in range(num_shards)]
+
+    start = time.time()
+    with ProcessPoolExecutor(max_workers=num_shards, mp_context=multiprocessing.get_context("spawn"),
+                             initializer=logging_utils.init_worker_logging,
+                             initargs=(logging_utils.get_log_queue(),)) as executor:
+        futures = [executor.submit(_undistort_shard, shard_path, input_path, image_path, shard, max_image_size)
+                   for shard_path, shard in zip(shard_paths, shards)]
+        for shard_index, future in enumerate(futures):
+            count, elapsed = future.result()
+            logging.info(f"去畸变分片 {shard_index}: {count} 张图像，耗时 {elapsed:.2f}秒")
+
+    # 合并分片：图像移动到标准目录，稀疏模型取第一个分片
+    for shard_index, shard_path in enumerate(shard_paths):
+        _merge_shard(shard_path, output_path, copy_sparse=shard_index == 0)
+    shutil.rmtree(shard_root, ignore_errors=True)
+
+    manifest = load_manifest(output_path)
+    manifest["sparse_mtime"] = sparse_mtime
+    manifest["images"].update({name: signatures[name] for name in stale})
+    save_manifest(output_path, manifest)
+
+    logging.info(f"分片去畸变完成: {len(stale)} 张图像，{num_shards} 个分片，耗时 {time.time() - start:.2f}秒")
+    return {"undistorted": len(stale), "skipped": len(image_names) - len(stale)}
+
+def iter_undistorted_images(output_path, input_path, image_path, max_image_size=-1, num_workers=None,
+                            chunk_size=4, image_names=None):
+    """
+    流式去畸变：图像按小批次提交到进程池，每个批次合并到标准布局后立即产出其图像名称列表
+    进程池中同时处理的批次数有上限，已是最新的图像在稀疏模型就绪后随第一个批次产出
+    """
+    image_names, stale, signatures, sparse_mtime, sparse_current = _plan_undistortion(
+        output_path, input_path, image_path, max_image_size, image_names)
+    current = sorted(image_names - set(stale))
+    logging.info(f"流式去畸变: {len(image_names)} 张图像，其中 {len(current)} 张已是最新")
+    removed = remove_stereo_outputs(output_path, stale)
+    if removed:
+        logging.info(f"删除 {removed} 个过期的立体匹配输出")
+    if not sparse_current and not stale and current:
+        # 稀疏模型已更新但图像均为最新：仍需处理一张图像以写出新的稀疏模型
+        stale, current = current[:1], current[1:]
+    if not stale:
+        if current:
+            yield current
+        return
+
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+    chunks = [stale[i:i + chunk_size] for i in range(0, len(stale), chunk_size)]
+    shard_root = os.path.join(output_path, ".undistort_shards")
+    shutil.rmtree(shard_root, ignore_errors=True)
+    max_in_flight = 2 * num_workers
+    copy_sparse = not sparse_current
+    if not copy_sparse and current:
+        yield current
+        current = []
+
+    manifest = load_manifest(output_path)
+    with ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context("spawn"),
+                             initializer=logging_utils.init_worker_logging,
+                             initargs=(logging_utils.get_log_queue(),)) as executor:
+        running = {}
+        next_chunk = 0
+        while next_chunk < len(chunks) or running:
+            while next_chunk < len(chunks) and len(running) < max_in_flight:
+                shard_path = os.path.join(shard_root, str(next_chunk))
+                future = executor.submit(_undistort_shard, shard_path, input_path, image_path,
+                                         chunks[next_chunk], max_image_size)
+                running[future] = (shard_path, chunks[next_chunk])
+                next_chunk += 1
+            done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in done:
+                shard_path, chunk = running.pop(future)
+                future.result()
+                _merge_shard(shard_path, output_path, copy_sparse=copy_sparse)
+                manifest["sparse_mtime"] = sparse_mtime
+                manifest["images"].update({name: signatures[name] for name in chunk})
+                save_manifest(output_path, manifest)
+                ready = chunk + current if copy_sparse else chunk
+                copy_sparse, current = False, []
+                yield ready
+    shutil.rmtree(shard_root, ignore_errors=True)
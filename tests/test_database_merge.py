@@ -0,0 +1,132 @@
+'''
+Description: 分片数据库合并的测试：相机、图像、rig、frame、frame_data与pair_id的重新编号以及重复合并
+Author: Damocles_lin
+Date: 2026-10-19 21:40:09
+LastEditTime: 2026-10-19 21:40:09
+LastEditors: Damocles_lin
+'''
+import os
+import sys
+import sqlite3
+import pytest
+
+pytest.importorskip("pycolmap")
+pytest.importorskip("open3d")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from reconstruction.database_merge import merge_databases  # noqa: E402
+from reconstruction.matching import image_ids_to_pair_id, pair_id_to_image_ids  # noqa: E402
+
+SCHEMA = [
+    "CREATE TABLE cameras (camera_id INTEGER PRIMARY KEY NOT NULL, model INTEGER NOT NULL, "
+    "width INTEGER NOT NULL, height INTEGER NOT NULL, params BLOB, prior_focal_length INTEGER NOT NULL)",
+    "CREATE TABLE images (image_id INTEGER PRIMARY KEY NOT NULL, name TEXT NOT NULL UNIQUE, "
+    "camera_id INTEGER NOT NULL)",
+    "CREATE TABLE rigs (rig_id INTEGER PRIMARY KEY NOT NULL, ref_sensor_id INTEGER NOT NULL, "
+    "ref_sensor_type INTEGER NOT NULL)",
+    "CREATE TABLE rig_sensors (rig_id INTEGER NOT NULL, sensor_id INTEGER NOT NULL, "
+    "sensor_type INTEGER NOT NULL, sensor_from_rig BLOB)",
+    "CREATE TABLE frames (frame_id INTEGER PRIMARY KEY NOT NULL, rig_id INTEGER NOT NULL)",
+    "CREATE TABLE frame_data (frame_id INTEGER NOT NULL, data_id INTEGER NOT NULL, "
+    "sensor_id INTEGER NOT NULL, sensor_type INTEGER NOT NULL)",
+    "CREATE TABLE keypoints (image_id INTEGER PRIMARY KEY NOT NULL, rows INTEGER NOT NULL, "
+    "cols INTEGER NOT NULL, data BLOB)",
+    "CREATE TABLE matches (pair_id INTEGER PRIMARY KEY NOT NULL, rows INTEGER NOT NULL, "
+    "cols INTEGER NOT NULL, data BLOB)",
+    "CREATE TABLE two_view_geometries (pair_id INTEGER PRIMARY KEY NOT NULL, rows INTEGER NOT NULL, "
+    "cols INTEGER NOT NULL, data BLOB, config INTEGER NOT NULL)",
+]
+
+def _make_shard(path, image_names):
+    """构建分片数据库：每张图像一个相机（CameraMode.AUTO）、单相机rig与frame，相邻图像之间有匹配"""
+    conn = sqlite3.connect(path)
+    for sql in SCHEMA:
+        conn.execute(sql)
+    for i, name in enumerate(image_names, start=1):
+        # 所有相机参数相同：只有share_cameras时才允许合并
+        conn.execute("INSERT INTO cameras VALUES (?, 1, 640, 480, ?, 0)", (i, b"params"))
+        conn.execute("INSERT INTO images VALUES (?, ?, ?)", (i, name, i))
+        conn.execute("INSERT INTO rigs VALUES (?, ?, 0)", (i, i))
+        conn.execute("INSERT INTO rig_sensors VALUES (?, ?, 0, NULL)", (i, i))
+        conn.execute("INSERT INTO frames VALUES (?, ?)", (i, i))
+        conn.execute("INSERT INTO frame_data VALUES (?, ?, ?, 0)", (i, i, i))
+        conn.execute("INSERT INTO keypoints VALUES (?, 1, 2, ?)", (i, name.encode()))
+    for i in range(1, len(image_names)):
+        pair_id = image_ids_to_pair_id(i, i + 1)
+        data = f"{image_names[i - 1]}-{image_names[i]}".encode()
+        conn.execute("INSERT INTO matches VALUES (?, 1, 2, ?)", (pair_id, data))
+        conn.execute("INSERT INTO two_view_geometries VALUES (?, 1, 2, ?, 2)", (pair_id, data))
+    conn.commit()
+    conn.close()
+
+def _read_merged(path):
+    conn = sqlite3.connect(path)
+    try:
+        return {table: conn.execute(f"SELECT * FROM {table}").fetchall()
+                for table in ("cameras", "images", "rigs", "rig_sensors", "frames", "frame_data",
+                              "keypoints", "matches", "two_view_geometries")}
+    finally:
+        conn.close()
+
+@pytest.fixture
+def shards(tmp_path):
+    paths = [str(tmp_path / "shard_0.db"), str(tmp_path / "shard_1.db")]
+    _make_shard(paths[0], ["a.jpg", "b.jpg"])
+    _make_shard(paths[1], ["c.jpg", "d.jpg"])
+    return paths, str(tmp_path / "database.db")
+
+def test_merge_remaps_ids(shards):
+    shard_paths, merged_path = shards
+    merge_databases(shard_paths, merged_path)
+    merged = _read_merged(merged_path)
+
+    # 每个分片相机都获得新ID，参数相同也不共享
+    assert [row[0] for row in merged["cameras"]] == [1, 2, 3, 4]
+    images = {name: (image_id, camera_id) for image_id, name, camera_id in merged["images"]}
+    assert images == {"a.jpg": (1, 1), "b.jpg": (2, 2), "c.jpg": (3, 3), "d.jpg": (4, 4)}
+
+    # rig、rig_sensors、frame与frame_data指向重新编号后的相机与图像
+    assert sorted(merged["rigs"]) == [(1, 1, 0), (2, 2, 0), (3, 3, 0), (4, 4, 0)]
+    assert sorted(row[:3] for row in merged["rig_sensors"]) == [(1, 1, 0), (2, 2, 0), (3, 3, 0), (4, 4, 0)]
+    assert sorted(merged["frames"]) == [(1, 1), (2, 2), (3, 3), (4, 4)]
+    assert sorted(merged["frame_data"]) == [(1, 1, 1, 0), (2, 2, 2, 0), (3, 3, 3, 0), (4, 4, 4, 0)]
+    keypoints = {image_id: data for image_id, _, _, data in merged["keypoints"]}
+    assert keypoints == {1: b"a.jpg", 2: b"b.jpg", 3: b"c.jpg", 4: b"d.jpg"}
+
+    # 分片内匹配按新图像ID重新计算pair_id
+    for table in ("matches", "two_view_geometries"):
+        pairs = {pair_id_to_image_ids(row[0]): row[3] for row in merged[table]}
+        assert pairs == {(1, 2): b"a.jpg-b.jpg", (3, 4): b"c.jpg-d.jpg"}
+
+def test_merge_shares_cameras_when_requested(shards):
+    shard_paths, merged_path = shards
+    merge_databases(shard_paths, merged_path, share_cameras=True)
+    merged = _read_merged(merged_path)
+    assert len(merged["cameras"]) == 1
+    assert {row[2] for row in merged["images"]} == {1}
+    assert len(merged["rigs"]) == 1
+    assert {row[1] for row in merged["frames"]} == {1}
+    assert {row[2] for row in merged["frame_data"]} == {1}
+
+def test_merge_twice_into_same_target(shards, tmp_path):
+    shard_paths, merged_path = shards
+    merge_databases(shard_paths, merged_path)
+    first = _read_merged(merged_path)
+
+    # 重复合并相同分片不产生任何新行
+    merge_databases(shard_paths, merged_path)
+    assert _read_merged(merged_path) == first
+
+    # 追加新分片：ID接在已有最大ID之后，已存在的图像被跳过
+    extra_path = str(tmp_path / "shard_2.db")
+    _make_shard(extra_path, ["d.jpg", "e.jpg"])
+    merge_databases([extra_path], merged_path)
+    merged = _read_merged(merged_path)
+    images = {name: (image_id, camera_id) for image_id, name, camera_id in merged["images"]}
+    assert images["e.jpg"] == (5, 5)
+    assert len(merged["images"]) == 5
+    assert len(merged["cameras"]) == 5
+    assert (5, 5, 5, 0) in merged["frame_data"]
+    assert len(merged["frames"]) == 5
+    # d.jpg已存在：跨越旧图像的d-e匹配被丢弃，由后续匹配重新计算
+    assert len(merged["matches"]) == 2
@@ -0,0 +1,114 @@
+'''
+Description: 分块可恢复匹配调度的测试：跳过已完成分块、签名变化的分块失效、matched到verified的状态转换
+Author: Damocles_lin
+Date: 2026-10-19 21:18:26
+LastEditTime: 2026-10-19 21:18:26
+LastEditors: Damocles_lin
+'''
+import os
+import sys
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pytest
+
+pytest.importorskip("pycolmap")
+pytest.importorskip("open3d")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from reconstruction import matching  # noqa: E402
+
+class _InlineExecutor(ThreadPoolExecutor):
+    """以线程代替工作进程，使测试中替换的_match_block生效"""
+    def __init__(self, max_workers=None, **kwargs):
+        super().__init__(max_workers=max_workers)
+
+def _make_database(path, num_images):
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE images (image_id INTEGER PRIMARY KEY NOT NULL, name TEXT NOT NULL UNIQUE, "
+                 "camera_id INTEGER NOT NULL)")
+    conn.execute("CREATE TABLE matches (pair_id INTEGER PRIMARY KEY NOT NULL, rows INTEGER NOT NULL, "
+                 "cols INTEGER NOT NULL, data BLOB)")
+    conn.execute("CREATE TABLE two_view_geometries (pair_id INTEGER PRIMARY KEY NOT NULL, rows INTEGER NOT NULL, "
+                 "cols INTEGER NOT NULL, data BLOB, config INTEGER NOT NULL)")
+    conn.executemany("INSERT INTO images VALUES (?, ?, 1)", [(i, f"{i:04d}.jpg") for i in range(1, num_images + 1)])
+    conn.commit()
+    conn.close()
+
+@pytest.fixture
+def scheduler(tmp_path, monkeypatch):
+    """替换进程池与COLMAP匹配器，记录被匹配的分块与被几何验证的图像对"""
+    calls = {"matched": [], "verified": [], "with_geometry": True}
+
+    def fake_match_block(database_path, block_id, pairs, scratch_dir, option_overrides, device_name):
+        calls["matched"].append(list(pairs))
+        data = np.zeros((3, 2), dtype=np.uint32).tobytes()
+        matches = [(matching.image_ids_to_pair_id(a, b), 3, 2, data) for a, b in pairs]
+        geometries = [row + (2,) for row in matches] if calls["with_geometry"] else []
+        return block_id, "pid-test", {
+            "matches": (["pair_id", "rows", "cols", "data"], matches),
+            "two_view_geometries": (["pair_id", "rows", "cols", "data", "config"], geometries)
+        }, 0.01
+
+    def fake_verify(database_path, image_pairs, id_to_name):
+        calls["verified"].extend(image_pairs)
+
+    monkeypatch.setattr(matching, "ProcessPoolExecutor", _InlineExecutor)
+    monkeypatch.setattr(matching, "_match_block", fake_match_block)
+    monkeypatch.setattr(matching, "verify_image_pairs", fake_verify)
+    database_path = str(tmp_path / "database.db")
+    _make_database(database_path, 6)
+    return database_path, calls
+
+def _statuses(database_path):
+    return {block_id: status for block_id, (_, status) in matching.read_progress(database_path).items()}
+
+def test_finished_blocks_are_skipped(scheduler):
+    database_path, calls = scheduler
+    blocks = matching.tile_image_pairs(range(1, 7), 3)
+    matching.match_blocks_scheduled(database_path, blocks, num_workers=2)
+    assert len(calls["matched"]) == len(blocks)
+    assert set(_statuses(database_path).values()) == {"verified"}
+
+    calls["matched"].clear()
+    matching.match_blocks_scheduled(database_path, blocks, num_workers=2)
+    assert calls["matched"] == []
+
+def test_changed_block_signature_invalidates_block(scheduler):
+    database_path, calls = scheduler
+    matching.match_blocks_scheduled(database_path, matching.tile_image_pairs(range(1, 7), 3), num_workers=2)
+
+    # 新增图像后重新切分：只有图像对内容变化的分块重新匹配
+    conn = sqlite3.connect(database_path)
+    conn.execute("INSERT INTO images VALUES (7, '0007.jpg', 1)")
+    conn.commit()
+    conn.close()
+    calls["matched"].clear()
+    blocks = matching.tile_image_pairs(range(1, 8), 3)
+    matching.match_blocks_scheduled(database_path, blocks, num_workers=2)
+    rematched = sorted(tuple(pairs) for pairs in calls["matched"])
+    changed = sorted(tuple(pairs) for pairs in blocks if any(7 in pair for pair in pairs))
+    assert rematched == changed
+    assert len(matching.read_matched_pair_ids(database_path)) == sum(len(pairs) for pairs in blocks)
+
+def test_matched_blocks_are_verified(scheduler, monkeypatch):
+    database_path, calls = scheduler
+    blocks = matching.tile_image_pairs(range(1, 7), 3)
+
+    # 匹配器未给出几何验证结果且验证前中断：分块停留在matched状态
+    def interrupted(*args):
+        raise KeyboardInterrupt()
+
+    calls["with_geometry"] = False
+    with monkeypatch.context() as patch:
+        patch.setattr(matching, "verify_image_pairs", interrupted)
+        with pytest.raises(KeyboardInterrupt):
+            matching.match_blocks_scheduled(database_path, blocks, num_workers=2)
+    assert set(_statuses(database_path).values()) == {"matched"}
+
+    # 重新运行：不重新匹配，只对matched分块执行几何验证并标记为verified
+    calls["matched"].clear()
+    matching.match_blocks_scheduled(database_path, blocks, num_workers=2)
+    assert calls["matched"] == []
+    assert sorted(calls["verified"]) == sorted(pair for pairs in blocks for pair in pairs)
+    assert set(_statuses(database_path).values()) == {"verified"}
@@ -0,0 +1,64 @@
+'''
+Description: 去畸变增量判断与过期立体匹配输出清理的测试
+Author: Damocles_lin
+Date: 2026-10-19 19:12:40
+LastEditTime: 2026-10-19 19:12:40
+LastEditors: Damocles_lin
+'''
+import os
+import sys
+from types import SimpleNamespace
+import pytest
+
+pytest.importorskip("pycolmap")
+pytest.importorskip("open3d")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from reconstruction.undistortion import (STEREO_OUTPUT_DIRS, find_stale_images, load_manifest,  # noqa: E402
+                                         save_manifest, remove_stereo_outputs)
+
+def _make_workspace(tmp_path, image_names):
+    """构建源图像目录与已有立体匹配输出的稠密工作空间"""
+    image_path = tmp_path / "images"
+    dense_path = tmp_path / "dense"
+    image_path.mkdir()
+    (dense_path / "images").mkdir(parents=True)
+    for name in image_names:
+        (image_path / name).write_bytes(b"src")
+        (dense_path / "images" / name).write_bytes(b"undistorted")
+        for sub_dir in STEREO_OUTPUT_DIRS:
+            map_dir = dense_path / "stereo" / sub_dir
+            map_dir.mkdir(parents=True, exist_ok=True)
+            for suffix in (".photometric.bin", ".geometric.bin"):
+                (map_dir / (name + suffix)).write_bytes(b"map")
+    return str(image_path), str(dense_path)
+
+def _make_reconstruction(image_names):
+    """仅包含find_stale_images所需字段的稀疏模型"""
+    camera = SimpleNamespace(model=1, width=640, height=480, params=[500.0, 500.0, 320.0, 240.0])
+    images = {i + 1: SimpleNamespace(name=name, camera_id=1) for i, name in enumerate(image_names)}
+    return SimpleNamespace(images=images, cameras={1: camera})
+
+def test_stale_image_stereo_outputs_removed(tmp_path):
+    image_names = ["a.jpg", "b.jpg"]
+    image_path, dense_path = _make_workspace(tmp_path, image_names)
+    reconstruction = _make_reconstruction(image_names)
+
+    # 清单记录的尺寸上限与本次不同：a.jpg过期，b.jpg最新
+    _, signatures = find_stale_images(dense_path, image_path, reconstruction, set(image_names), 2000)
+    manifest = load_manifest(dense_path)
+    manifest["images"] = {name: dict(signature) for name, signature in signatures.items()}
+    manifest["images"]["a.jpg"]["max_image_size"] = 1000
+    save_manifest(dense_path, manifest)
+
+    stale, _ = find_stale_images(dense_path, image_path, reconstruction, set(image_names), 2000)
+    assert stale == ["a.jpg"]
+
+    removed = remove_stereo_outputs(dense_path, stale)
+    assert removed == 2 * len(STEREO_OUTPUT_DIRS)
+    for sub_dir in STEREO_OUTPUT_DIRS:
+        map_dir = os.path.join(dense_path, "stereo", sub_dir)
+        assert sorted(os.listdir(map_dir)) == ["b.jpg.geometric.bin", "b.jpg.photometric.bin"]
+
+def test_remove_stereo_outputs_missing_files(tmp_path):
+    assert remove_stereo_outputs(str(tmp_path), ["missing.jpg"]) == 0
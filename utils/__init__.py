@@ -2,11 +2,11 @@
 Description: 
 Author: Damocles_lin
 Date: 2025-07-06 16:49:28
-LastEditTime: 2025-07-06 16:57:31
+LastEditTime: 2026-10-19 18:52:30
 LastEditors: Damocles_lin
 '''
 # utils/__init__.py
-from .logging_utils import configure_logging
+from .logging_utils import configure_logging, set_stage_verbosity, shutdown_logging
 from .timer import Timer
-from .stats_utils import save_sfm_stats, save_mvs_stats, save_overall_stats, save_timing_summary
-from .camera_utils import print_camera_example
\ No newline at end of file
+from .stats_utils import save_sfm_stats, save_mvs_stats, save_overall_stats, save_timing_summary, save_ingest_latency, save_track_analytics, save_worker_throughput, save_streaming_dense_stats, save_triage_report, save_query_benchmark
+from .camera_utils import print_camera_example, intrinsic_matrix, stack_intrinsics
\ No newline at end of file
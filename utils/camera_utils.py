@@ -2,14 +2,69 @@
 Description: 
 Author: Damocles_lin
 Date: 2025-07-06 16:51:27
-LastEditTime: 2025-07-14 14:02:17
+LastEditTime: 2026-10-19 20:17:52
 LastEditors: Damocles_lin
 '''
+import numpy as np
+
+# 各相机模型内参 (fx, fy, cx, cy) 在params中的索引，单焦距模型fx与fy共用同一参数
+INTRINSIC_PARAM_INDICES = {
+    0: (0, 0, 1, 2),  # SIMPLE_PINHOLE
+    1: (0, 1, 2, 3),  # PINHOLE
+    2: (0, 0, 1, 2),  # SIMPLE_RADIAL
+    3: (0, 0, 1, 2),  # RADIAL
+    4: (0, 1, 2, 3),  # OPENCV
+    5: (0, 1, 2, 3),  # OPENCV_FISHEYE
+    6: (0, 1, 2, 3),  # FULL_OPENCV
+    7: (0, 1, 2, 3),  # FOV
+    8: (0, 0, 1, 2),  # SIMPLE_RADIAL_FISHEYE
+    9: (0, 0, 1, 2),  # RADIAL_FISHEYE
+    10: (0, 1, 2, 3),  # THIN_PRISM_FISHEYE
+    11: (0, 1, 2, 3),  # RAD_TAN_THIN_PRISM_FISHEYE
+}
+
+# 各相机模型畸变参数在params中的起始索引（仅限批量投影支持的畸变模型）
+DISTORTION_PARAM_OFFSETS = {2: 3, 3: 3, 4: 4, 5: 4, 8: 3, 9: 3}
+
+# 按入射角计算畸变的鱼眼模型（OPENCV_FISHEYE、SIMPLE_RADIAL_FISHEYE、RADIAL_FISHEYE）
+FISHEYE_MODEL_IDS = (5, 8, 9)
+
+# 批量投影支持的相机模型：无畸变模型与上述畸变模型
+PROJECTION_MODEL_IDS = (0, 1) + tuple(DISTORTION_PARAM_OFFSETS)
+
+def intrinsic_matrix(model_id, params):
+    """根据相机模型构建内参矩阵K，参数不足或模型未知时返回None"""
+    params = np.asarray(params, dtype=np.float64)
+    indices = INTRINSIC_PARAM_INDICES.get(model_id)
+    if indices is None or len(params) <= max(indices):
+        return None
+    fx, fy, cx, cy = params[list(indices)]
+    return np.array([[fx, 0, cx], [0, fy, cy], [0, 0, 1]])
+
+def stack_intrinsics(cameras):
+    """
+    将相机字典批量堆叠为数组，便于向量化投影
+    cameras: {camera_id: {"model": int, "params": array, ...}}
+    返回 (camera_ids (C,), model_ids (C,), K (C,3,3), distortion (C,4))
+    """
+    camera_ids = np.array(sorted(cameras), dtype=np.int64)
+    model_ids = np.array([cameras[i]["model"] for i in camera_ids], dtype=np.int64)
+    K = np.zeros((len(camera_ids), 3, 3))
+    distortion = np.zeros((len(camera_ids), 4))
+    for row, camera_id in enumerate(camera_ids):
+        params = np.asarray(cameras[camera_id]["params"], dtype=np.float64)
+        camera_K = intrinsic_matrix(int(model_ids[row]), params)
+        K[row] = camera_K if camera_K is not None else np.eye(3)
+        offset = DISTORTION_PARAM_OFFSETS.get(int(model_ids[row]))
+        if offset is not None:
+            extra = params[offset:offset + 4]
+            distortion[row, :len(extra)] = extra
+    return camera_ids, model_ids, K, distortion
+
 def print_camera_example(results_dir):
     """加载并打印所有相机和位姿信息，生成总结文件"""
     try:
         import os
-        import numpy as np
         import logging
         
         # 加载相机参数
@@ -51,25 +106,7 @@ def print_camera_example(results_dir):
                 summary_file.write(f"相机参数: {params}\n")
                 
                 try:
-                    if model_id == 0:  # SIMPLE_PINHOLE
-                        focal, cx, cy = params
-                        K = np.array([[focal, 0, cx], [0, focal, cy], [0, 0, 1]])
-                    elif model_id == 1:  # PINHOLE
-                        fx, fy, cx, cy = params
-                        K = np.array([[fx, 0, cx], [0, fy, cy], [0, 0, 1]])
-                    elif model_id in [2, 3]:  # RADIAL类型
-                        focal, cx, cy, *_ = params
-                        K = np.array([[focal, 0, cx], [0, focal, cy], [0, 0, 1]])
-                    elif model_id == 4:  # OPENCV
-                        fx, fy, cx, cy, *_ = params
-                        K = np.array([[fx, 0, cx], [0, fy, cy], [0, 0, 1]])
-                    else:
-                        if len(params) >= 4:
-                            # 取前四个参数，假设为fx, fy, cx, cy
-                            fx, fy, cx, cy = params[:4]
-                            K = np.array([[fx, 0, cx], [0, fy, cy], [0, 0, 1]])
-                        else:
-                            K = None
+                    K = intrinsic_matrix(model_id, params)
                     
                     if K is not None:
                         summary_file.write(f"内参矩阵K:\n{np.array2string(K, precision=6, suppress_small=True)}\n\n")
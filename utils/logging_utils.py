@@ -2,62 +2,227 @@
 Description: 
 Author: Damocles_lin
 Date: 2025-07-06 16:49:53
-LastEditTime: 2025-07-08 21:08:58
+LastEditTime: 2026-10-19 20:51:08
 LastEditors: Damocles_lin
 '''
+import time
+import atexit
 import logging
+import threading
+import multiprocessing
+import logging.handlers
 import pycolmap
 import sys
 from pathlib import Path
 from datetime import datetime
 
-def configure_logging(output_dir):
-    """配置pycolmap日志系统和文件日志"""
-    # 创建日志目录
+# 各阶段的pycolmap日志详细级别（0为仅必要信息，4为最高详细级别）
+DEFAULT_STAGE_VERBOSITY = {
+    "default": 1,
+    "extraction": 0,
+    "matching": 0,
+    "mapping": 1,
+    "dense": 1
+}
+
+LOG_FILE_MAX_BYTES = 50 * 1024 * 1024  # 单个日志文件最大50MB
+LOG_FILE_BACKUP_COUNT = 5              # 保留的轮转日志文件数量
+
+# 全局日志状态，保证重复调用configure_logging时不会重复添加处理器
+_state = {
+    "log_file": None,
+    "queue": None,
+    "queue_handler": None,
+    "listener": None,
+    "stage_verbosity": dict(DEFAULT_STAGE_VERBOSITY),
+    "stats": None
+}
+
+class LogStats:
+    """日志量与开销统计（多个线程同时记录日志，计数在锁内累加）"""
+    def __init__(self):
+        self.records = 0
+        self.bytes = 0
+        self.enqueue_time = 0.0   # 调用线程中入队耗时（前台开销）
+        self.write_time = 0.0     # 后台线程中格式化与写入耗时
+        self._lock = threading.Lock()
+
+    def add(self, records=0, num_bytes=0, enqueue_time=0.0, write_time=0.0):
+        """累加一次日志记录的统计"""
+        with self._lock:
+            self.records += records
+            self.bytes += num_bytes
+            self.enqueue_time += enqueue_time
+            self.write_time += write_time
+
+    def snapshot(self):
+        """返回当前统计的一致快照"""
+        with self._lock:
+            return {
+                "records": self.records,
+                "bytes": self.bytes,
+                "enqueue_time": self.enqueue_time,
+                "write_time": self.write_time
+            }
+
+class PillowFilter(logging.Filter):
+    """过滤掉Pillow的调试日志"""
+    def filter(self, record):
+        if record.name.startswith('PIL.'):
+            return record.levelno >= logging.WARNING
+        return True
+
+class MeteredQueueHandler(logging.handlers.QueueHandler):
+    """记录入队次数与耗时的队列处理器"""
+    def __init__(self, log_queue, stats):
+        super().__init__(log_queue)
+        self.stats = stats
+
+    def emit(self, record):
+        start = time.perf_counter()
+        super().emit(record)
+        self.stats.add(records=1, enqueue_time=time.perf_counter() - start)
+
+class MeteredRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """按大小轮转并记录写入字节数与耗时的文件处理器"""
+    def __init__(self, filename, stats, **kwargs):
+        super().__init__(filename, **kwargs)
+        self.stats = stats
+
+    def emit(self, record):
+        start = time.perf_counter()
+        before = self.stream.tell() if self.stream else 0
+        super().emit(record)
+        after = self.stream.tell() if self.stream else 0
+        # 发生轮转时文件从头写入
+        self.stats.add(num_bytes=after - before if after >= before else after,
+                       write_time=time.perf_counter() - start)
+
+def configure_logging(output_dir, stage_verbosity=None, max_bytes=LOG_FILE_MAX_BYTES,
+                      backup_count=LOG_FILE_BACKUP_COUNT):
+    """
+    配置pycolmap日志系统和异步文件日志
+    日志记录在调用线程中仅入队，由后台线程写入按大小轮转的文件和控制台；
+    同一输出目录重复调用时直接返回已有日志文件
+    """
     log_dir = Path(output_dir) / "logs"
+    if _state["listener"] is not None:
+        if Path(_state["log_file"]).parent == log_dir:
+            return _state["log_file"]
+        # 输出目录变化时先关闭旧的日志管线
+        shutdown_logging()
+
+    # 创建日志目录
     log_dir.mkdir(parents=True, exist_ok=True)
-    
+
     # 生成带时间戳的日志文件名
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     log_file = log_dir / f"colmap_log_{timestamp}.txt"
-    
+
     # 配置pycolmap日志
+    if stage_verbosity:
+        _state["stage_verbosity"].update(stage_verbosity)
     pycolmap.logging.logtostderr = True     # 设置日志输出到控制台
-    pycolmap.logging.verbose_level = 4      # 设置日志详细级别，最高详细级别
-    pycolmap.logging.alsologtostderr = True
+    pycolmap.logging.alsologtostderr = False
     pycolmap.logging.minloglevel = pycolmap.logging.Level.INFO.value
+    set_stage_verbosity("default")
 
-    # 添加Pillow日志过滤器
-    class PillowFilter(logging.Filter):
-        def filter(self, record):
-            # 过滤掉Pillow的调试日志
-            if record.name.startswith('PIL.'):
-                return record.levelno >= logging.WARNING
-            return True    
-    
-    # 创建文件日志处理器
-    file_handler = logging.FileHandler(log_file)
-    file_handler.setLevel(logging.DEBUG)
-    
-    # 创建日志格式化器
+    stats = LogStats()
     formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    # 创建按大小轮转的文件日志处理器
+    file_handler = MeteredRotatingFileHandler(log_file, stats, maxBytes=max_bytes,
+                                              backupCount=backup_count, encoding="utf-8")
+    file_handler.setLevel(logging.DEBUG)
     file_handler.setFormatter(formatter)
     file_handler.addFilter(PillowFilter())
-    
-    # 获取根日志记录器并添加文件处理器
-    root_logger = logging.getLogger()
-    root_logger.setLevel(logging.DEBUG)
-    root_logger.addHandler(file_handler)
-    
+
     # 添加控制台处理器
     console_handler = logging.StreamHandler(sys.stdout)
     console_handler.setLevel(logging.INFO)
     console_handler.setFormatter(formatter)
     console_handler.addFilter(PillowFilter())
-    root_logger.addHandler(console_handler)
+
+    # 根日志记录器只挂载队列处理器，实际写入由后台监听线程完成
+    # 使用进程间队列，工作进程通过init_worker_logging将日志发送到同一监听线程
+    # （spawn上下文创建的队列同时适用于fork与spawn启动的工作进程）
+    log_queue = multiprocessing.get_context("spawn").Queue()
+    queue_handler = MeteredQueueHandler(log_queue, stats)
+    listener = logging.handlers.QueueListener(log_queue, file_handler, console_handler,
+                                              respect_handler_level=True)
+    root_logger = logging.getLogger()
+    root_logger.setLevel(logging.DEBUG)
+    root_logger.addHandler(queue_handler)
+    listener.start()
+
+    _state.update({
+        "log_file": log_file,
+        "queue": log_queue,
+        "queue_handler": queue_handler,
+        "listener": listener,
+        "stats": stats
+    })
 
     # 同时设置Pillow的日志级别
     logging.getLogger('PIL').setLevel(logging.WARNING)
-    
+
     logging.info(f"日志文件已创建: {log_file}")
-    return log_file
\ No newline at end of file
+    return log_file
+
+def set_stage_verbosity(stage):
+    """切换到指定阶段的pycolmap日志详细级别，返回生效的级别"""
+    verbosity = _state["stage_verbosity"].get(stage, _state["stage_verbosity"]["default"])
+    pycolmap.logging.verbose_level = verbosity
+    return verbosity
+
+def get_log_queue():
+    """返回日志队列，供进程池的initializer传给工作进程；日志未配置时返回None"""
+    return _state["queue"]
+
+def init_worker_logging(log_queue):
+    """
+    进程池工作进程的initializer：根日志记录器改为只挂载指向主进程日志队列的处理器
+    fork继承的处理器指向主进程对象的副本，直接替换；log_queue为None时保持原样
+    """
+    if log_queue is None:
+        return
+    root_logger = logging.getLogger()
+    for handler in list(root_logger.handlers):
+        root_logger.removeHandler(handler)
+    root_logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    root_logger.setLevel(logging.DEBUG)
+    logging.getLogger('PIL').setLevel(logging.WARNING)
+
+def get_log_stats():
+    """返回当前日志量与开销统计（工作进程的入队不计入记录数）"""
+    stats = _state["stats"]
+    if stats is None:
+        return None
+    return stats.snapshot()
+
+def format_log_stats():
+    """生成用于计时摘要的日志量与开销说明"""
+    stats = get_log_stats()
+    if stats is None:
+        return []
+    return [
+        f"日志记录数: {stats['records']}",
+        f"日志写入量: {stats['bytes'] / 1024:.1f}KB",
+        f"日志前台开销: {stats['enqueue_time']:.3f}秒",
+        f"日志后台写入耗时: {stats['write_time']:.3f}秒"
+    ]
+
+def shutdown_logging():
+    """停止后台日志线程并移除队列处理器（会先写完队列中剩余的日志）"""
+    listener = _state["listener"]
+    if listener is None:
+        return
+    listener.stop()
+    for handler in listener.handlers:
+        handler.close()
+    logging.getLogger().removeHandler(_state["queue_handler"])
+    _state["queue"].close()
+    _state["queue"].join_thread()
+    _state.update({"log_file": None, "queue": None, "queue_handler": None, "listener": None})
+
+atexit.register(shutdown_logging)
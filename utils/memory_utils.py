@@ -0,0 +1,97 @@
+'''
+Description: 内存监控与选项覆盖工具
+Author: Damocles_lin
+Date: 2026-10-19 13:22:05
+LastEditTime: 2026-10-19 22:18:42
+LastEditors: Damocles_lin
+'''
+import os
+import logging
+import resource
+import threading
+import importlib.util
+
+def apply_option_overrides(options, overrides):
+    """将字典中的字段覆盖到pycolmap选项对象上，忽略该版本不存在的字段"""
+    for name, value in (overrides or {}).items():
+        if hasattr(options, name):
+            setattr(options, name, value)
+        else:
+            logging.warning(f"{type(options).__name__} 不支持选项 {name}，已忽略")
+    return options
+
+def has_current_rss():
+    """是否能采样当前常驻内存（需要psutil），否则采样值只是进程历史峰值，无法区分各阶段"""
+    return importlib.util.find_spec("psutil") is not None
+
+def current_rss_bytes():
+    """当前进程及其子进程的常驻内存（字节）"""
+    try:
+        import psutil
+        process = psutil.Process(os.getpid())
+        rss = process.memory_info().rss
+        for child in process.children(recursive=True):
+            try:
+                rss += child.memory_info().rss
+            except psutil.Error:
+                pass
+        return rss
+    except ImportError:
+        # 没有psutil时退化为历史峰值（Linux下ru_maxrss单位为KB）
+        self_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        child_peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        return max(self_peak, child_peak) * 1024
+
+class MemoryMonitor:
+    """
+    后台线程定时采样内存，记录每个阶段的观测峰值
+    多个阶段可同时进行（并发执行的阶段），采样值计入所有进行中的阶段
+    """
+    def __init__(self, interval=0.2):
+        self.interval = interval
+        self.stage_peaks = {}
+        self._active = {}  # 进行中的阶段 -> 当前观测峰值
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """启动采样线程"""
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """结束所有进行中的阶段并停止采样线程"""
+        self.end_stage()
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def start_stage(self, stage_name):
+        """开始记录一个阶段的内存峰值（不影响其他进行中的阶段）"""
+        rss = current_rss_bytes()
+        with self._lock:
+            self._active[stage_name] = rss
+
+    def end_stage(self, stage_name=None):
+        """
+        结束指定阶段（未指定时结束所有进行中的阶段）
+        返回该阶段观测到的峰值（字节），阶段未在进行中时返回None
+        """
+        rss = current_rss_bytes()
+        with self._lock:
+            names = list(self._active) if stage_name is None else [stage_name]
+            peak = None
+            for name in names:
+                if name not in self._active:
+                    continue
+                peak = max(self._active.pop(name), rss)
+                self.stage_peaks[name] = peak
+            return peak
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            rss = current_rss_bytes()
+            with self._lock:
+                for name, peak in self._active.items():
+                    self._active[name] = max(peak, rss)
@@ -2,7 +2,7 @@
 Description: 
 Author: Damocles_lin
 Date: 2025-07-06 16:50:59
-LastEditTime: 2025-07-08 14:18:11
+LastEditTime: 2026-10-19 20:17:52
 LastEditors: Damocles_lin
 '''
 import logging
@@ -19,7 +19,9 @@ def save_sfm_stats(output_dir, stats):
     
     with open(stats_file, "w") as f:
         f.write("===== SfM重建统计信息 =====\n")
-        f.write(f"总图像数量: {stats['total_images']}\n")
+        if 'input_images' in stats:
+            f.write(f"输入图像数量: {stats['input_images']}\n")
+        f.write(f"总图像数量(处理): {stats['total_images']}\n")
         
         # 记录图像分辨率
         if stats['image_resolutions']:
@@ -42,6 +44,10 @@ def save_sfm_stats(output_dir, stats):
         f.write(f"注册图像数量: {stats['registered_images']}\n")
         f.write(f"稀疏点云数量: {stats['sparse_points']}\n")
         f.write(f"平均重投影误差: {stats['mean_reprojection_error']:.6f} 像素\n")
+        if 'median_reprojection_error' in stats:
+            f.write(f"重投影误差中位数: {stats['median_reprojection_error']:.6f} 像素\n")
+            f.write(f"平均轨迹长度: {stats['mean_track_length']:.2f}\n")
+            f.write(f"异常轨迹数量: {stats['outlier_tracks']}\n")
     
     logging.info(f"SfM统计信息已保存到: {stats_file}")
 
@@ -76,7 +82,9 @@ def save_overall_stats(output_dir, sfm_stats, mvs_stats):
     with open(stats_file, "w") as f:
         f.write("===== 三维重建统计摘要 =====\n")
         f.write("--- 输入图像 ---\n")
-        f.write(f"总图像数量: {sfm_stats['total_images']}\n")
+        if 'input_images' in sfm_stats:
+            f.write(f"输入图像数量: {sfm_stats['input_images']}\n")
+        f.write(f"总图像数量(处理): {sfm_stats['total_images']}\n")
         
         # 分辨率信息
         if sfm_stats['image_resolutions']:
@@ -101,6 +109,10 @@ def save_overall_stats(output_dir, sfm_stats, mvs_stats):
         f.write(f"注册图像数量: {sfm_stats['registered_images']}\n")
         f.write(f"稀疏点云数量: {sfm_stats['sparse_points']}\n")
         f.write(f"平均重投影误差: {sfm_stats['mean_reprojection_error']:.6f} 像素\n")
+        if 'median_reprojection_error' in sfm_stats:
+            f.write(f"重投影误差中位数: {sfm_stats['median_reprojection_error']:.6f} 像素\n")
+            f.write(f"平均轨迹长度: {sfm_stats['mean_track_length']:.2f}\n")
+            f.write(f"异常轨迹数量: {sfm_stats['outlier_tracks']}\n")
         
         f.write("\n--- MVS重建 ---\n")
         f.write(f"稠密点云数量: {mvs_stats['dense_points']}\n")
@@ -109,6 +121,64 @@ def save_overall_stats(output_dir, sfm_stats, mvs_stats):
     
     logging.info(f"整体统计信息已保存到: {stats_file}")
 
+def save_track_analytics(output_dir, analytics):
+    """保存重投影误差与轨迹分析结果（汇总与每图像明细）"""
+    stats_dir = Path(output_dir) / "stats"
+    stats_dir.mkdir(parents=True, exist_ok=True)
+    
+    stats_file = stats_dir / "track_analytics.txt"
+    with open(stats_file, "w") as f:
+        f.write("===== 轨迹分析 =====\n")
+        f.write(f"观测数量: {analytics['num_observations']}\n")
+        f.write(f"参与误差统计的观测数量: {analytics['num_valid_observations']}\n")
+        f.write(f"重投影误差均值: {analytics['mean_error']:.6f} 像素\n")
+        f.write(f"重投影误差中位数: {analytics['median_error']:.6f} 像素\n")
+        
+        f.write("\n--- 重投影误差分布 ---\n")
+        bins = analytics['error_bins']
+        for lo, hi, count in zip(bins[:-1], bins[1:], analytics['error_histogram']):
+            f.write(f"  [{lo:g}, {hi:g}) 像素: {count}\n")
+        
+        f.write("\n--- 轨迹长度分布 ---\n")
+        for length, count in enumerate(analytics['track_length_histogram']):
+            if count > 0:
+                f.write(f"  长度 {length}: {count} 条\n")
+        
+        f.write("\n--- 三角化角度分布 ---\n")
+        angle_bins = [0, 1, 2, 5, 10, 20, 45, 180]
+        for lo, hi, count in zip(angle_bins[:-1], angle_bins[1:], analytics['tri_angle_histogram']):
+            f.write(f"  [{lo}, {hi}) 度: {count}\n")
+    
+    per_image_file = stats_dir / "per_image_errors.txt"
+    with open(per_image_file, "w") as f:
+        f.write("image_id, image_name, observations, mean_error, median_error, p90_error, max_error\n")
+        for row, image_id in enumerate(analytics['image_ids']):
+            f.write(f"{image_id}, {analytics['image_names'][row]}, "
+                    f"{analytics['image_num_observations'][row]}, "
+                    f"{analytics['image_mean_error'][row]:.4f}, {analytics['image_median_error'][row]:.4f}, "
+                    f"{analytics['image_p90_error'][row]:.4f}, {analytics['image_max_error'][row]:.4f}\n")
+    
+    logging.info(f"轨迹分析已保存到: {stats_file}")
+
+def save_worker_throughput(output_dir, file_name, title, records, unit="项"):
+    """保存各工作进程/分片的处理量与吞吐率"""
+    stats_dir = Path(output_dir) / "stats"
+    stats_dir.mkdir(parents=True, exist_ok=True)
+    
+    stats_file = stats_dir / file_name
+    total_items = sum(record['items'] for record in records)
+    wall_time = max((record['elapsed'] for record in records), default=0.0)
+    
+    with open(stats_file, "w") as f:
+        f.write(f"===== {title} =====\n")
+        for record in records:
+            rate = record['items'] / max(record['elapsed'], 1e-6)
+            f.write(f"{record['name']}: {record['items']} {unit}，耗时 {record['elapsed']:.2f}秒，"
+                    f"{rate:.2f} {unit}/秒\n")
+        f.write(f"合计: {total_items} {unit}，{total_items / max(wall_time, 1e-6):.2f} {unit}/秒\n")
+    
+    logging.info(f"{title}已保存到: {stats_file}")
+
 def save_timing_summary(output_dir, summary):
     """保存计时摘要到文件"""
     timing_dir = Path(output_dir) / "logs"
@@ -120,4 +190,86 @@ def save_timing_summary(output_dir, summary):
     with open(timing_file, "w") as f:
         f.write(summary)
     
-    logging.info(f"计时摘要已保存到: {timing_file}")
\ No newline at end of file
+    logging.info(f"计时摘要已保存到: {timing_file}")
+
+def save_ingest_latency(output_dir, records):
+    """追加保存实时增量注册的单张图像端到端延迟"""
+    stats_dir = Path(output_dir) / "stats"
+    stats_dir.mkdir(parents=True, exist_ok=True)
+    
+    stats_file = stats_dir / "ingest_latency.txt"
+    write_header = not stats_file.exists()
+    
+    with open(stats_file, "a") as f:
+        if write_header:
+            f.write("timestamp, image_name, registered, latency_s, extract_s, match_s, register_s, dense_s\n")
+        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        for record in records:
+            f.write(f"{timestamp}, {record['image_name']}, {int(record['registered'])}, "
+                    f"{record['latency']:.2f}, {record['extract']:.2f}, {record['match']:.2f}, "
+                    f"{record['register']:.2f}, {record['dense']:.2f}\n")
+    
+    logging.info(f"增量注册延迟已保存到: {stats_file}")
+
+def save_triage_report(output_dir, input_images, selected, dropped):
+    """保存图像筛选报告：剔除的图像及原因"""
+    stats_dir = Path(output_dir) / "stats"
+    stats_dir.mkdir(parents=True, exist_ok=True)
+    
+    from collections import Counter
+    stats_file = stats_dir / "triage_report.txt"
+    reasons = Counter(record['reason'] for record in dropped).most_common()
+    
+    with open(stats_file, "w") as f:
+        f.write("===== 图像筛选报告 =====\n")
+        f.write(f"输入图像数量: {input_images}\n")
+        f.write(f"保留图像数量: {len(selected)}\n")
+        f.write(f"剔除图像数量: {len(dropped)}\n")
+        for reason, count in reasons:
+            f.write(f"  - {reason}: {count} 张\n")
+        f.write("\nimage_name, reason, detail\n")
+        for record in sorted(dropped, key=lambda r: r['image_name']):
+            f.write(f"{record['image_name']}, {record['reason']}, {record['detail']}\n")
+    
+    logging.info(f"图像筛选报告已保存到: {stats_file}")
+
+def save_streaming_dense_stats(output_dir, stats):
+    """保存流式稠密重建统计信息（首批稠密点耗时与总耗时）"""
+    stats_dir = Path(output_dir) / "stats"
+    stats_dir.mkdir(parents=True, exist_ok=True)
+    
+    stats_file = stats_dir / "streaming_dense.txt"
+    first_points = stats['time_to_first_points']
+    
+    with open(stats_file, "w") as f:
+        f.write("===== 流式稠密重建统计信息 =====\n")
+        f.write(f"参考图像数量: {stats['reference_images']}\n")
+        f.write(f"完成几何深度图数量: {stats['geometric_depth_maps']}\n")
+        f.write(f"失败图像数量: {stats['failed_images']}\n")
+        f.write(f"融合批次数量: {stats['fusion_batches']}\n")
+        f.write(f"稠密点云数量: {stats['dense_points']}\n")
+        f.write(f"超出体素范围未去重的点数: {stats['out_of_range_points']}\n")
+        f.write(f"首批稠密点耗时: {f'{first_points:.2f}秒' if first_points is not None else '未生成'}\n")
+        f.write(f"总耗时: {stats['wall_time']:.2f}秒\n")
+        for stage, elapsed in stats['stage_times'].items():
+            f.write(f"{stage}累计耗时: {elapsed:.2f}秒\n")
+    
+    logging.info(f"流式稠密重建统计信息已保存到: {stats_file}")
+
+def save_query_benchmark(output_dir, num_points, num_cells, build_time, results):
+    """保存空间查询基准测试结果（单次查询延迟）"""
+    stats_dir = Path(output_dir) / "stats"
+    stats_dir.mkdir(parents=True, exist_ok=True)
+    
+    stats_file = stats_dir / "spatial_query_benchmark.txt"
+    
+    with open(stats_file, "w") as f:
+        f.write("===== 空间查询基准测试 =====\n")
+        f.write(f"点数量: {num_points}\n")
+        f.write(f"非空体素数量: {num_cells}\n")
+        f.write(f"索引构建/打开耗时: {build_time:.2f}秒\n")
+        for name, result in results.items():
+            f.write(f"{name}: p50 {result['p50_ms']:.3f}ms, p95 {result['p95_ms']:.3f}ms, "
+                    f"max {result['max_ms']:.3f}ms, 平均命中 {result['mean_hits']:.1f} 个点\n")
+    
+    logging.info(f"空间查询基准测试结果已保存到: {stats_file}")
@@ -2,11 +2,12 @@
 Description: 
 Author: Damocles_lin
 Date: 2025-07-06 16:50:16
-LastEditTime: 2025-07-06 16:50:25
+LastEditTime: 2026-10-19 16:01:12
 LastEditors: Damocles_lin
 '''
 import time
 import logging
+import threading
 
 class Timer:
     """计时器类，用于记录各步骤耗时"""
@@ -15,6 +16,7 @@ class Timer:
         self.step_times = {}
         self.current_step = None
         self.step_start_times = {}
+        self._lock = threading.Lock()
     
     def start(self, step_name):
         """开始一个新步骤的计时"""
@@ -35,6 +37,11 @@ class Timer:
             self.current_step = None
             self.start_time = None
     
+    def record(self, step_name, elapsed):
+        """直接记录一个步骤的耗时（线程安全，用于并发执行的步骤）"""
+        with self._lock:
+            self.step_times[step_name] = elapsed
+    
     def get_step_time(self, step_name):
         """获取特定步骤的耗时"""
         return self.step_times.get(step_name, 0.0)
@@ -43,12 +50,15 @@ class Timer:
         """计算总耗时"""
         return sum(self.step_times.values())
     
-    def log_summary(self):
-        """记录所有步骤的耗时摘要"""
+    def log_summary(self, extra_lines=None):
+        """记录所有步骤的耗时摘要（extra_lines为附加在总耗时之后的说明行）"""
+        extra_lines = extra_lines or []
         logging.info("\n===== 处理步骤耗时摘要 =====")
         for step, elapsed in self.step_times.items():
             logging.info(f"{step}: {elapsed:.2f}秒")
         logging.info(f"总耗时: {self.total_time():.2f}秒")
+        for line in extra_lines:
+            logging.info(line)
         logging.info("===========================\n")
         
         # 返回摘要字符串，可用于保存到文件
@@ -56,5 +66,6 @@ class Timer:
         for step, elapsed in self.step_times.items():
             summary_lines.append(f"{step}: {elapsed:.2f}秒")
         summary_lines.append(f"总耗时: {self.total_time():.2f}秒")
+        summary_lines.extend(extra_lines)
         summary_lines.append("===========================\n")
         return "\n".join(summary_lines)
\ No newline at end of file